@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 """
 """
 import sys
@@ -7,27 +7,118 @@ import zabbix
 
 def main():
   arguments = parse_arguments()
-  monitor = zabbix.Sender(**arguments)
+  monitor = zabbix.Sender(ns=arguments['with_ns'], **arguments)
   if 'zabbix_key' in arguments:
     if 'item_file' in arguments:
-      print 'Sending failed.  -k and -i cannot be used together.'
+      print('Sending failed.  -k and -i cannot be used together.')
       return 1
     if 'zabbix_value' not in arguments:
-      print 'Sending failed.  -k requires -o.'
+      print('Sending failed.  -k requires -o.')
       return 1
 
     monitor.add_item(key=arguments['zabbix_key'], value=arguments['zabbix_value'])
 
-  if 'item_file' in arguments:
-    split_count = 3 if arguments['with_timestamps'] else 2
+  if 'item_file' in arguments or arguments['real_time']:
+    return send_input_file(monitor, arguments)
 
   retval = monitor.send(print_values=False)
   if arguments['verbose']:
-    print retval[0][1]['info']
-#    print retval[0][1][0]
+    print(retval[0][1]['info'])
   return retval[0][0]
 
 
+def send_input_file(monitor, arguments):
+  """
+  Stream the input file to the server, chunk_items lines at a time, so
+  memory use stays the same however large the file is.  In real time mode
+  a smaller batch is sent as soon as its oldest line has waited for
+  max_latency milliseconds, over the same pooled connection.
+  """
+  from zabbix.sender import SendSummary
+  from zabbix.tools.sender_input import InputError, InputReader, open_input
+
+  if arguments['workers'] > 1 and not arguments['real_time']:
+    return send_input_file_parallel(monitor, arguments)
+
+  reader = InputReader(
+      open_input(arguments.get('item_file', '-')),
+      with_timestamps=arguments['with_timestamps'],
+      with_ns=arguments['with_ns']
+      )
+  max_latency = None
+  if arguments['real_time']:
+    max_latency = arguments['max_latency'] / 1000.0
+
+  summary = SendSummary(0)
+  try:
+    for batch in reader.batches(monitor.chunk_items, max_latency):
+      monitor.add_items(batch)
+      result = monitor.send()[0]
+      monitor.__list_item__.clear()
+      if arguments['verbose'] > 1:
+        print(result[1]['info'])
+      if not summary.add(result, len(batch)):
+        break
+  except InputError as err:
+    summary.retcode = max(summary.retcode, 2)
+    sys.stderr.write(u'{0}\n'.format(err))
+  except KeyboardInterrupt:
+    pass
+
+  summary.item_count = reader.items
+  (retcode, response) = summary.result()
+  print_summary(arguments, reader.stats(), response)
+  return retcode
+
+
+def send_input_file_parallel(monitor, arguments):
+  """
+  Parse and encode the input file in a pool of worker processes, and send
+  the requests they produce in input order.
+  """
+  from zabbix.tools.sender_input import ParallelEncoder
+
+  encoder = ParallelEncoder(
+      workers=arguments['workers'],
+      sender=monitor,
+      with_timestamps=arguments['with_timestamps'],
+      with_ns=arguments['with_ns']
+      )
+  packets = encoder.packets(arguments.get('item_file', '-'))
+  try:
+    (retcode, response) = monitor.send_packets(packets)
+  except KeyboardInterrupt:
+    (retcode, response) = (1, {'info': 'Interrupted', 'chunks': 0})
+  finally:
+    packets.close()
+
+  if encoder.error is not None:
+    retcode = max(retcode, 2)
+    sys.stderr.write(u'{0}\n'.format(encoder.error))
+
+  print_summary(arguments, encoder.stats(), response)
+  return retcode
+
+
+def print_summary(arguments, stats, response):
+  if arguments['quiet']:
+    return
+  sent = response.get('total', 0)
+  print(response['info'])
+  print('sent: {0}; skipped: {1}; total: {2}'.format(
+      sent,
+      stats['items'] - sent,
+      stats['items']
+      ))
+  print('read: {0} lines; {1} bytes; {2:.3f} seconds; {3:.0f} lines/s; {4:.0f} bytes/s'.format(
+      stats['lines'],
+      stats['bytes'],
+      stats['seconds'],
+      stats['lines_per_sec'],
+      stats['bytes_per_sec']
+      ))
+
+
 def parse_arguments():
   """
   Collect and collate command line arguments.
@@ -92,7 +183,7 @@ def parse_arguments():
   parser.add_argument(
       '-s', '--host',
       action='store',
-      help='Specify host name. Host IP address and DNS name will not work. Default is {}'.format(zabbix.__zabbix_node_name__),
+      help='Specify host name. Host IP address and DNS name will not work. Default is the Hostname from the agent configuration file',
       dest='zabbix_host',
       nargs='?',
       default=argparse.SUPPRESS,
@@ -144,17 +235,43 @@ def parse_arguments():
       help='Load values from input file. Specify - for standard input. Each line of file contains whitespace delimited: <hostname> <key> <value>. Specify - in <hostname> to use hostname from configuration file or --host argument. All entries are sent in a sequential order top-down.',
       dest='with_timestamps',
       )
+  sendmode_multiple.add_argument(
+      '-N', '--with-ns',
+      action='store_true',
+      help='Stamp values with nanoseconds. With -T, each line of the input file contains whitespace delimited: <hostname> <key> <timestamp> <ns> <value>.',
+      dest='with_ns',
+      )
+  sendmode_multiple.add_argument(
+      '--workers',
+      action='store',
+      help='Parse and encode the input file in this many processes. Values are still sent in the order they appear in the file. Default is 1',
+      dest='workers',
+      default=1,
+      metavar='<count>',
+      type=int,
+      )
 
   sendmode_realtime = parser.add_argument_group('Real Time Items')
   sendmode_realtime.add_argument(
       '-r', '--real-time',
       action='store_true',
-      help='Send values one by one as soon as they are received. This can be used when reading from standard input.',
-      dest='real-time',
+      help='Send values as soon as they are received, in batches of at most --max-latency milliseconds. This can be used when reading from standard input, which is the default input in this mode.',
+      dest='real_time',
+      )
+  sendmode_realtime.add_argument(
+      '--max-latency',
+      action='store',
+      help='Longest time, in milliseconds, a value waits for its batch to be sent in real time mode. Default is 200',
+      dest='max_latency',
+      default=200,
+      metavar='<milliseconds>',
+      type=float,
       )
 
   cliargs = {key: value for key, value in vars(parser.parse_args()).items() if value is not None}
-  cnfargs = vars(zabbix.get_AgentConfig(**cliargs))
+  cnfargs = dict(zabbix.GetAgentConfig(**cliargs))
+  # Values are stamped when they are read, not when the configuration was.
+  cnfargs.pop('zabbix_time', None)
 
   retval = cnfargs.copy()
   retval.update(cliargs)
@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 """
 Set the version number of this package / module.
 """
@@ -6,4 +6,4 @@ __version__ = '0.0.10'
 
 
 if __name__ == '__main__':
-  print __version__
+  print(__version__)
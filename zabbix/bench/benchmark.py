@@ -0,0 +1,727 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Micro benchmarks for the python-zabbix package, run against the local fakes
+of zabbix.tools._fakes so no real Zabbix server is needed.  From the
+directory holding setup.py;
+    python3 -m bench.benchmark <name> [options]
+
+Run without a name for the list of available benchmarks.
+"""
+import json
+import os
+import sys
+import threading
+import time
+
+from zabbix.tools._fakes import FakeAgent, FakeFrontend, FakeTrapper
+
+# Upper bound for the time 'import zabbix' may take, in microseconds.
+IMPORT_BUDGET_US = 20000
+
+
+def bench_compression(**kwargs):
+  """
+  Compare bytes on the wire and end-to-end latency of uncompressed and
+  compressed sends at several batch sizes.
+  """
+  import zabbix
+
+  batch_sizes = kwargs.get('batch_sizes', (10, 100, 1000, 10000, 50000))
+  rounds = int(kwargs.get('rounds', 5))
+  trapper = FakeTrapper(link_mbps=kwargs.get('link_mbps', 0))
+  (host, port) = trapper.start()
+
+  print('{0:>8} {1:>6} {2:>12} {3:>8} {4:>12}'.format(
+      'items', 'mode', 'wire bytes', 'ratio', 'latency ms'))
+  for batch_size in batch_sizes:
+    baseline = None
+    for compress in (False, True):
+      monitor = zabbix.Sender(
+          read_config=False,
+          zabbix_serv=host,
+          zabbix_port=port,
+          zabbix_host='bench.example.org',
+          compress=compress,
+          chunk_items=batch_size,
+          chunk_bytes=1 << 30
+          )
+      for count in range(batch_size):
+        monitor.add_item(
+            key='bench.key[{0},{1}]'.format(count % 50, count),
+            value=str(count * 7919 % 100000)
+            )
+
+      trapper.reset()
+      started = time.time()
+      for _ in range(rounds):
+        monitor.send()
+      latency = (time.time() - started) / rounds * 1000
+      wire = (trapper.bytes_in + trapper.bytes_out) // rounds
+      baseline = baseline or wire
+
+      print('{0:>8} {1:>6} {2:>12} {3:>8.2f} {4:>12.3f}'.format(
+          batch_size,
+          'zlib' if compress else 'plain',
+          wire,
+          baseline / float(wire),
+          latency
+          ))
+
+  trapper.stop()
+
+
+def bench_itembuffer(**kwargs):
+  """
+  Compare memory use and throughput of the list of dicts the sender used to
+  buffer items in with the column oriented ItemBuffer, for a minute worth
+  of high cardinality metrics.
+  """
+  import json
+  import tracemalloc
+  from zabbix.itembuffer import ItemBuffer
+
+  count = int(kwargs.get('items', 500000))
+  hosts = ['host{0:04d}.example.org'.format(x) for x in range(1000)]
+  keys = ['net.if.in[eth{0},bytes]'.format(x) for x in range(count // 1000 or 1)]
+  values = [str(x * 7919 % 1000003) for x in range(count)]
+  clock = int(time.time())
+
+  def fill_list():
+    retval = []
+    for index in range(count):
+      retval.append({
+        'host': hosts[index % len(hosts)],
+        'key': keys[index // len(hosts) % len(keys)],
+        'value': values[index],
+        'clock': clock,
+        })
+    return retval
+
+  def fill_buffer():
+    retval = ItemBuffer()
+    retval.add_items(
+        (hosts[x % len(hosts)], keys[x // len(hosts) % len(keys)], values[x], clock)
+        for x in range(count)
+        )
+    return retval
+
+  def encode_list(items):
+    return sum(len(json.dumps(x).encode('utf-8')) for x in items)
+
+  def encode_buffer(items):
+    return sum(len(x) for x in items.iter_encoded())
+
+  print('{0:>12} {1:>12} {2:>10} {3:>14} {4:>14}'.format(
+      'buffer', 'items', 'bytes/item', 'add items/s', 'encode items/s'))
+  for (name, fill, encode) in (
+      ('list', fill_list, encode_list),
+      ('ItemBuffer', fill_buffer, encode_buffer),
+      ):
+    tracemalloc.start()
+    started = time.time()
+    items = fill()
+    fill_time = time.time() - started
+    (used, _) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    started = time.time()
+    encode(items)
+    encode_time = time.time() - started
+
+    print('{0:>12} {1:>12} {2:>10.1f} {3:>14.0f} {4:>14.0f}'.format(
+        name,
+        count,
+        used / float(count),
+        count / fill_time,
+        count / encode_time
+        ))
+    del items
+
+
+def bench_pipeline(**kwargs):
+  """
+  Compare the time it takes to send items one per request, with and without
+  pipelining, over a simulated round trip.
+  """
+  import zabbix
+
+  count = int(kwargs.get('items', 2000))
+  windows = kwargs.get('windows', (1, 4, 8, 32))
+  trapper = FakeTrapper(rtt_ms=kwargs.get('rtt_ms', 0) or 2)
+  (host, port) = trapper.start()
+
+  monitor = zabbix.Sender(
+      read_config=False,
+      zabbix_serv=host,
+      zabbix_port=port,
+      zabbix_host='bench.example.org'
+      )
+  for index in range(count):
+    monitor.add_item(key='bench.key[{0}]'.format(index), value=str(index))
+
+  print('rtt {0:.1f} ms'.format(trapper.rtt_ms))
+  print('{0:>8} {1:>8} {2:>10} {3:>12}'.format('window', 'items', 'seconds', 'items/s'))
+  for window in windows:
+    started = time.time()
+    results = monitor.send(iterate_values=True, pipeline_window=window)
+    elapsed = time.time() - started
+    assert all(x[0] == 0 for x in results)
+    print('{0:>8} {1:>8} {2:>10.3f} {3:>12.0f}'.format(
+        window,
+        count,
+        elapsed,
+        count / elapsed
+        ))
+
+  trapper.stop()
+
+
+def _serve_trapper(addresses, **kwargs):
+  trapper = FakeTrapper(**kwargs)
+  addresses.put(trapper.start())
+  while True:
+    time.sleep(60)
+
+
+def bench_workers(**kwargs):
+  """
+  Measure how parsing and sending a large sender input file scales with the
+  number of worker processes.  The fake trapper runs in a process of its
+  own, so it does not compete with the sender for the interpreter lock.
+  """
+  import multiprocessing
+  import os
+  import tempfile
+  import zabbix
+  from zabbix.tools.sender_input import ParallelEncoder
+
+  count = int(kwargs.get('lines', 1000000))
+  cpus = multiprocessing.cpu_count()
+  workers = kwargs.get('workers', sorted(set([1, 2, 4, 8, cpus]) & set(range(1, max(cpus, 2) + 1))))
+
+  (fd, filename) = tempfile.mkstemp(suffix='.txt')
+  with os.fdopen(fd, 'w') as f:
+    for index in range(count):
+      f.write('host{0:03d}.example.org app.metric[{1}] {2}\n'.format(
+          index % 500,
+          index % 1000,
+          index * 7919 % 1000003
+          ))
+
+  addresses = multiprocessing.Queue()
+  server = multiprocessing.Process(target=_serve_trapper, args=(addresses,))
+  server.daemon = True
+  server.start()
+  (host, port) = addresses.get()
+
+  print('{0} lines, {1} bytes, {2} CPUs'.format(count, os.path.getsize(filename), cpus))
+  print('{0:>8} {1:>10} {2:>12} {3:>8}'.format('workers', 'seconds', 'lines/s', 'speedup'))
+  baseline = None
+  try:
+    for worker_count in workers:
+      monitor = zabbix.Sender(
+          read_config=False,
+          zabbix_serv=host,
+          zabbix_port=port,
+          zabbix_host='bench.example.org'
+          )
+      encoder = ParallelEncoder(workers=worker_count, sender=monitor)
+      started = time.time()
+      (retcode, response) = monitor.send_packets(encoder.packets(filename))
+      elapsed = time.time() - started
+      assert retcode == 0 and response['total'] == count
+      baseline = baseline or elapsed
+      print('{0:>8} {1:>10.3f} {2:>12.0f} {3:>8.2f}'.format(
+          worker_count,
+          elapsed,
+          count / elapsed,
+          baseline / elapsed
+          ))
+  finally:
+    server.terminate()
+    os.unlink(filename)
+
+
+def _serve_agents(addresses, **kwargs):
+  agents = FakeAgent(**kwargs)
+  addresses.put(agents.start())
+  while True:
+    time.sleep(60)
+
+
+def bench_agents(**kwargs):
+  """
+  Poll a pool of fake agents, which take a few milliseconds to answer like
+  agents across a network do, one request at a time with query_agent()
+  and concurrently with poll_agents().
+  """
+  import multiprocessing
+  import zabbix.get
+
+  hosts = int(kwargs.get('hosts', 5000))
+  keys = kwargs.get('keys', ('agent.ping', 'system.uptime'))
+  delay_ms = kwargs.get('rtt_ms', 0) or 5
+  sequential = int(kwargs.get('sequential', 200))
+
+  addresses = multiprocessing.Queue()
+  server = multiprocessing.Process(
+      target=_serve_agents,
+      args=(addresses,),
+      kwargs={'agents': 50, 'delay_ms': delay_ms}
+      )
+  server.daemon = True
+  server.start()
+  agents = addresses.get()
+  targets = [agents[x % len(agents)] for x in range(hosts)]
+
+  print('{0} hosts, {1} keys each, agents answer in {2} ms'.format(hosts, len(keys), delay_ms))
+  print('{0:>24} {1:>10} {2:>10} {3:>12} {4:>8}'.format(
+      'mode', 'requests', 'seconds', 'requests/s', 'errors'))
+  try:
+    started = time.time()
+    errors = 0
+    for (host, port) in targets[:sequential]:
+      for key in keys:
+        errors += zabbix.get.query_agent(query_host=host, query_port=port, query_string=key)[0] != 0
+    elapsed = time.time() - started
+    print('{0:>24} {1:>10} {2:>10.3f} {3:>12.0f} {4:>8}'.format(
+        'query_agent', sequential * len(keys), elapsed, sequential * len(keys) / elapsed, errors))
+
+    for max_in_flight in (100, 500, 1000):
+      started = time.time()
+      results = list(zabbix.get.poll_agents(targets, keys=keys, max_in_flight=max_in_flight, timeout=10))
+      elapsed = time.time() - started
+      print('{0:>24} {1:>10} {2:>10.3f} {3:>12.0f} {4:>8}'.format(
+          'poll_agents({0})'.format(max_in_flight),
+          len(results),
+          elapsed,
+          len(results) / elapsed,
+          sum(1 for x in results if x.error is not None)
+          ))
+  finally:
+    server.terminate()
+
+
+def _serve_frontend(addresses, **kwargs):
+  frontend = FakeFrontend(**kwargs)
+  addresses.put(frontend.start())
+  while True:
+    time.sleep(60)
+
+
+def bench_api(**kwargs):
+  """
+  Measure API calls per second against a fake frontend (in a process of its
+  own), opening a connection per call like urllib does, through the pooled
+  ZabbixAPI client from one and from several threads, with a response
+  cache, and in batches.
+  """
+  import multiprocessing
+  import urllib.request
+  import zabbix.api
+
+  calls = int(kwargs.get('calls', 2000))
+  threads = kwargs.get('threads', (1, 4, 16))
+  delay_ms = kwargs.get('rtt_ms', 0)
+
+  addresses = multiprocessing.Queue()
+  server = multiprocessing.Process(
+      target=_serve_frontend,
+      args=(addresses,),
+      kwargs={
+        'objects': {'host': [{'hostid': str(10000 + x), 'host': 'host{0}'.format(x)} for x in range(10)]},
+        'delay_ms': delay_ms,
+        }
+      )
+  server.daemon = True
+  server.start()
+  url = addresses.get()
+
+  def urllib_calls(count):
+    api = zabbix.api.ZabbixAPI(zabbix_url=url, zabbix_user='Admin')
+    auth = api.login()
+    for index in range(count):
+      body = json.dumps({
+        'jsonrpc': '2.0', 'method': 'host.get', 'params': {}, 'auth': auth, 'id': index
+        }).encode('utf-8')
+      request = urllib.request.Request(url, body, {'Content-Type': 'application/json-rpc'})
+      with urllib.request.urlopen(request) as response:
+        json.loads(response.read().decode('utf-8'))['result']
+
+  print('{0} calls of host.get, frontend answers in {1} ms'.format(calls, delay_ms))
+  print('{0:>24} {1:>10} {2:>10} {3:>12}'.format('client', 'threads', 'seconds', 'calls/s'))
+  try:
+    started = time.time()
+    urllib_calls(calls)
+    elapsed = time.time() - started
+    print('{0:>24} {1:>10} {2:>10.3f} {3:>12.0f}'.format('urllib', 1, elapsed, calls / elapsed))
+
+    for thread_count in threads:
+      api = zabbix.api.ZabbixAPI(zabbix_url=url, zabbix_user='Admin', pool_size=thread_count)
+      api.login()
+
+      def run(count):
+        for _ in range(count):
+          api.request('host.get')
+
+      workers = [
+        threading.Thread(target=run, args=(calls // thread_count,))
+        for _ in range(thread_count)
+        ]
+      started = time.time()
+      for worker in workers:
+        worker.start()
+      for worker in workers:
+        worker.join()
+      elapsed = time.time() - started
+      done = calls // thread_count * thread_count
+      print('{0:>24} {1:>10} {2:>10.3f} {3:>12.0f}'.format('ZabbixAPI', thread_count, elapsed, done / elapsed))
+      api.close()
+
+    api = zabbix.api.ZabbixAPI(zabbix_url=url, zabbix_user='Admin', cache=True)
+    api.login()
+    started = time.time()
+    for _ in range(calls):
+      api.request('host.get')
+    elapsed = time.time() - started
+    print('{0:>24} {1:>10} {2:>10.3f} {3:>12.0f}'.format('ZabbixAPI(cache)', 1, elapsed, calls / elapsed))
+    api.close()
+
+    for batch_size in (10, 100, 1000):
+      api = zabbix.api.ZabbixAPI(zabbix_url=url, zabbix_user='Admin', batch_size=batch_size)
+      api.login()
+      started = time.time()
+      results = api.batch([('host.get', {})] * calls)
+      elapsed = time.time() - started
+      assert not any(x.error for x in results)
+      print('{0:>24} {1:>10} {2:>10.3f} {3:>12.0f}'.format(
+          'ZabbixAPI.batch({0})'.format(batch_size), 1, elapsed, calls / elapsed))
+      api.close()
+  finally:
+    server.terminate()
+
+
+def bench_history(**kwargs):
+  """
+  Measure the peak memory and rows per second of reading history.get from a
+  fake frontend (in a process of its own) in one request, and page by page
+  with ZabbixAPI.iterate(), with and without prefetching.
+  """
+  import multiprocessing
+  import tracemalloc
+  import zabbix.api
+
+  rows = int(kwargs.get('rows', 200000))
+  page_size = int(kwargs.get('page_size', 10000))
+  delay_ms = kwargs.get('rtt_ms', 0)
+
+  addresses = multiprocessing.Queue()
+  server = multiprocessing.Process(
+      target=_serve_frontend,
+      args=(addresses,),
+      kwargs={
+        'objects': {'history': [
+          {'itemid': str(23296 + x % 100), 'clock': str(1700000000 + x // 100), 'value': '0.{0}'.format(x), 'ns': '0'}
+          for x in range(rows)
+          ]},
+        'delay_ms': delay_ms,
+        }
+      )
+  server.daemon = True
+  server.start()
+  url = addresses.get()
+
+  def read_all(api):
+    return len(api.request('history.get', {'output': 'extend'}))
+
+  def read_pages(api, prefetch):
+    return sum(1 for _ in api.iterate('history.get', {'output': 'extend'}, page_size=page_size, prefetch=prefetch))
+
+  print('{0} history rows, pages of {1}, frontend answers in {2} ms'.format(rows, page_size, delay_ms))
+  print('{0:>24} {1:>10} {2:>12} {3:>12}'.format('client', 'seconds', 'rows/s', 'peak MiB'))
+  try:
+    for (name, read) in (
+        ('request', read_all),
+        ('iterate', lambda api: read_pages(api, False)),
+        ('iterate(prefetch)', lambda api: read_pages(api, True)),
+        ):
+      api = zabbix.api.ZabbixAPI(zabbix_url=url, zabbix_user='Admin', timeout=120)
+      api.login()
+      tracemalloc.start()
+      started = time.time()
+      count = read(api)
+      elapsed = time.time() - started
+      peak = tracemalloc.get_traced_memory()[1]
+      tracemalloc.stop()
+      assert count == rows, count
+      print('{0:>24} {1:>10.3f} {2:>12.0f} {3:>12.1f}'.format(name, elapsed, rows / elapsed, peak / 1048576.0))
+      api.close()
+  finally:
+    server.terminate()
+
+
+def bench_provision(**kwargs):
+  """
+  Measure objects per second creating hosts and their items on a fake
+  frontend (in a process of its own), one call at a time and with
+  zabbix.api.Provisioner, planning included, and checking them again once
+  they exist.
+  """
+  import multiprocessing
+  import zabbix.api
+
+  hosts = int(kwargs.get('hosts', 500))
+  items = int(kwargs.get('items', 5))
+  delay_ms = kwargs.get('rtt_ms', 0)
+
+  def declaration(prefix):
+    return [
+      {'host': '{0}{1}'.format(prefix, x), 'groups': [{'groupid': '2'}], 'items': [
+        {'key_': 'key[{0}]'.format(y), 'type': 2, 'value_type': 0} for y in range(items)
+        ]}
+      for x in range(hosts)
+      ]
+
+  addresses = multiprocessing.Queue()
+  server = multiprocessing.Process(
+      target=_serve_frontend,
+      args=(addresses,),
+      kwargs={'objects': {'host': [], 'item': []}, 'delay_ms': delay_ms}
+      )
+  server.daemon = True
+  server.start()
+  url = addresses.get()
+
+  print('{0} hosts with {1} items each, frontend answers in {2} ms'.format(hosts, items, delay_ms))
+  print('{0:>24} {1:>10} {2:>12}'.format('client', 'seconds', 'objects/s'))
+  try:
+    api = zabbix.api.ZabbixAPI(zabbix_url=url, zabbix_user='Admin')
+    started = time.time()
+    for host in declaration('single'):
+      hostid = api.request('host.create', dict((x, y) for (x, y) in host.items() if x != 'items'))['hostids'][0]
+      for item in host['items']:
+        api.request('item.create', dict(item, hostid=hostid))
+    elapsed = time.time() - started
+    print('{0:>24} {1:>10.3f} {2:>12.0f}'.format('request', elapsed, hosts * (items + 1) / elapsed))
+
+    for (name, workers, prefix) in (
+        ('Provisioner(1)', 1, 'batch1-'),
+        ('Provisioner(4)', 4, 'batch4-'),
+        ('Provisioner (no change)', 4, 'batch4-'),
+        ):
+      provisioner = zabbix.api.Provisioner(api, workers=workers)
+      started = time.time()
+      (plan, report) = provisioner.provision(declaration(prefix))
+      elapsed = time.time() - started
+      assert not report['errors'], report['errors'][:1]
+      print('{0:>24} {1:>10.3f} {2:>12.0f}'.format(name, elapsed, hosts * (items + 1) / elapsed))
+    api.close()
+  finally:
+    server.terminate()
+
+
+def _legacy_parse_file_kvp(filename, filter_by=('#', ';')):
+  """
+  The line by line parser parse_file_kvp() used to be, as a baseline.
+  """
+  should_filter = lambda x,y: x.lstrip().startswith(y) or x == ''
+  lines = []
+  if os.access(filename, os.R_OK):
+    with open(filename, 'r') as f:
+      lines = [x.rstrip('\n') for x in f if not should_filter(x, filter_by)]
+
+  retval = {}
+  for line in lines:
+    if '#' in line:
+      line = line.split('#', 1)[0]
+    if '=' in line:
+      option, value = line.split('=', 1)
+      retval[option.strip()] = value.strip()
+  return retval
+
+
+def bench_parse(**kwargs):
+  """
+  Compare the legacy line by line config parser with the regex based one,
+  file by file and with parse_tree(), on a synthetic tree of agent
+  configuration files.
+  """
+  import multiprocessing
+  import shutil
+  import tempfile
+  from zabbix.tools import parse_file
+
+  count = int(kwargs.get('files', 50000))
+  cpus = multiprocessing.cpu_count()
+  path = tempfile.mkdtemp()
+  try:
+    for index in range(count):
+      directory = os.path.join(path, 'host{0:03d}'.format(index % 500))
+      if not os.path.isdir(directory):
+        os.mkdir(directory)
+      with open(os.path.join(directory, 'agent{0:05d}.conf'.format(index)), 'w') as f:
+        f.write(
+            '# This is a configuration file for Zabbix agent daemon (Unix)\n'
+            '# To get more information about Zabbix, visit http://www.zabbix.com\n\n'
+            '### Option: PidFile\n#\tName of PID file.\n#\n# PidFile=/tmp/zabbix_agentd.pid\n'
+            'PidFile=/run/zabbix/zabbix_agentd.pid\n'
+            'LogFile=/var/log/zabbix/zabbix_agentd.log\n'
+            'LogFileSize=0\n'
+            'Server=zabbix{0}.example.org\n'
+            'ServerActive=zabbix{0}.example.org:10051\n'
+            'Hostname=host{1:05d}.example.org\n'
+            'Timeout = 10   # seconds\n'
+            'Include=/etc/zabbix/zabbix_agentd.d/*.conf\n'
+            '{2}'.format(
+                index % 4,
+                index,
+                ''.join(
+                  '# Option: UserParameter\nUserParameter=app.metric{0}[*],/usr/local/bin/metric {0} $1\n'.format(x)
+                  for x in range(index % 20)
+                  )
+                ))
+
+    filenames = list(parse_file.iter_tree(path, '*.conf'))
+    total_bytes = sum(os.path.getsize(x) for x in filenames)
+    print('{0} files, {1} bytes, {2} CPUs'.format(len(filenames), total_bytes, cpus))
+    print('{0:>24} {1:>10} {2:>12} {3:>8}'.format('parser', 'seconds', 'files/s', 'speedup'))
+
+    runs = [
+      ('legacy', lambda: dict((x, _legacy_parse_file_kvp(x)) for x in filenames)),
+      ('parse_file_kvp', lambda: dict((x, parse_file.parse_file_kvp(filename=x)) for x in filenames)),
+      ]
+    for workers in sorted(set([1, cpus])):
+      runs.append((
+          'parse_tree workers={0}'.format(workers),
+          lambda workers=workers: parse_file.parse_tree(path, '*.conf', workers=workers)
+          ))
+
+    baseline = None
+    expected = None
+    for (name, run) in runs:
+      started = time.time()
+      result = run()
+      elapsed = time.time() - started
+      expected = expected or result
+      assert result == expected
+      baseline = baseline or elapsed
+      print('{0:>24} {1:>10.3f} {2:>12.0f} {3:>8.2f}'.format(
+          name,
+          elapsed,
+          len(filenames) / elapsed,
+          baseline / elapsed
+          ))
+  finally:
+    shutil.rmtree(path)
+
+
+def import_time(module, runs=3):
+  """
+  Import module in a fresh interpreter with -X importtime, and return a dict
+  holding the 'modules' the import pulled in and the 'total_us' it took,
+  the best of several runs.  Modules the interpreter imported before are
+  not counted.
+  """
+  import subprocess
+  import zabbix
+
+  env = dict(os.environ)
+  env['PYTHONPATH'] = os.pathsep.join(
+      [os.path.dirname(os.path.dirname(os.path.abspath(zabbix.__file__)))] +
+      [x for x in env.get('PYTHONPATH', '').split(os.pathsep) if x]
+      )
+
+  retval = {'modules': {}, 'total_us': None}
+  for _ in range(runs):
+    stderr = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import {0}'.format(module)],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        check=True
+        ).stderr.decode('utf-8', 'replace')
+
+    modules = {}
+    for line in stderr.splitlines():
+      if not line.startswith('import time:') or 'cumulative' in line:
+        continue
+      (_, cumulative, name) = line[len('import time:'):].split('|')
+      modules[name.strip()] = int(cumulative)
+      if name.strip() == module and not name.startswith('  '):
+        break
+      if not name.startswith('  '):
+        modules = {}
+
+    if retval['total_us'] is None or modules[module] < retval['total_us']:
+      retval = {'modules': modules, 'total_us': modules[module]}
+  return retval
+
+
+def bench_import(**kwargs):
+  """
+  Show what importing the package and its main modules costs, the slowest
+  imports first.
+  """
+  modules = kwargs.get('modules', ('zabbix', 'zabbix.sender', 'zabbix.asyncsender', 'zabbix.get'))
+  print('{0:<20} {1:>8} {2:>10}  {3}'.format('module', 'modules', 'import ms', 'slowest'))
+  for module in modules:
+    report = import_time(module)
+    slowest = sorted(
+        (x for x in report['modules'] if x != module),
+        key=lambda x: -report['modules'][x]
+        )[:3]
+    print('{0:<20} {1:>8} {2:>10.2f}  {3}'.format(
+        module,
+        len(report['modules']),
+        report['total_us'] / 1000.0,
+        ', '.join(slowest)
+        ))
+  print('budget for zabbix: {0:.2f} ms'.format(IMPORT_BUDGET_US / 1000.0))
+
+
+BENCHMARKS = {
+  'agents': bench_agents,
+  'api': bench_api,
+  'compression': bench_compression,
+  'history': bench_history,
+  'import': bench_import,
+  'itembuffer': bench_itembuffer,
+  'parse': bench_parse,
+  'pipeline': bench_pipeline,
+  'provision': bench_provision,
+  'workers': bench_workers,
+  }
+
+
+def main(argv=None):
+  import argparse
+
+  parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+  parser.add_argument('benchmark', nargs='?', choices=sorted(BENCHMARKS))
+  parser.add_argument(
+      '--link-mbps',
+      type=float,
+      default=0,
+      help='Simulated link speed for network benchmarks (0 = unlimited)',
+      )
+  parser.add_argument(
+      '--rtt-ms',
+      type=float,
+      default=0,
+      help='Simulated round trip for network benchmarks, where supported',
+      )
+  arguments = parser.parse_args(argv)
+  if arguments.benchmark is None:
+    parser.print_help()
+    return 1
+
+  BENCHMARKS[arguments.benchmark](
+      link_mbps=arguments.link_mbps,
+      rtt_ms=arguments.rtt_ms
+      )
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
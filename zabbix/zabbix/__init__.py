@@ -2,58 +2,151 @@
 # -*- coding: utf-8 -*-
 """
 This initializes the zabbix module and provides a few minor tools.
+
+Importing the package is kept cheap, as it is imported by short lived
+collectors spawned from cron.  Submodules are only imported once one of
+their names is used, and the host name, FQDN and current time are looked up
+on first use rather than at import time (see __getattr__);
+    >>> import os
+    >>> import subprocess
+    >>> import sys
+    >>> print(subprocess.run(
+    ...     [sys.executable, '-c', 'import sys, zabbix; print(sorted(x for x in sys.modules if x.startswith("zabbix")))'],
+    ...     cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    ...     stdout=subprocess.PIPE,
+    ...     check=True
+    ...     ).stdout.decode('utf-8').strip())
+    ['zabbix', 'zabbix.version']
+
+How long that takes depends on the machine; the import benchmark reports it.
+
+A name whose module can not be imported, like docopt when it is not
+installed, is simply missing; hasattr() and getattr() with a default work as
+usual.
 """
-from zabbix.misc import *
-from zabbix.getagentconfig import GetAgentConfig
-from zabbix.sender import Sender
 from zabbix.version import __version__
-from zabbix.zlog import zlog,  DEBUG, INFO, WARNING, ERROR, CRITICAL
-from zabbix.tools.docopt import docopt
 
-import os
-import socket
-import time
+
+__zabbix_serv_conf__ = '/etc/zabbix/zabbix_server.conf'
+__zabbix_serv_addr__ = 'server1.example.org'
+__zabbix_serv_port__ = 10051
+
+__zabbix_agnt_conf__ = '/etc/zabbix/zabbix_agentd.conf'
+__zabbix_agnt_addr__ = 'client1.example.org'
+__zabbix_agnt_port__ = 10050
+
+__script_log_dir__ = '/var/log/zabbix'
+
+# Attributes looked up on first use, and the function computing each.
+__lazy_values = {
+  '__zabbix_agnt_name__': lambda: __import__('socket').gethostname().split('.', 1)[0],
+  '__zabbix_node_name__': lambda: __import__('socket').getfqdn(),
+  '__zabbix_time_curr__': lambda: int(round(__import__('time').time())),
+  }
+
+# Public names and the submodule providing each.
+__lazy_names = {
+  'GetAgentConfig': 'zabbix.getagentconfig',
+  'Sender': 'zabbix.sender',
+  'AsyncSender': 'zabbix.asyncsender',
+  'version_compare': 'zabbix.misc',
+  'flatten': 'zabbix.misc',
+  'docopt': 'docopt',
+  'DEBUG': 'logging',
+  'INFO': 'logging',
+  'WARNING': 'logging',
+  'ERROR': 'logging',
+  'CRITICAL': 'logging',
+  }
+
+__submodules = (
+  'api',
+  'asyncsender',
+  'encoder',
+  'get',
+  'get_ActiveItemsList',
+  'getagentconfig',
+  'itembuffer',
+  'misc',
+  'protocol',
+  'sender',
+  'spool',
+  'tools',
+  'transport',
+  )
+
+
+def __getattr__(name):
+  """
+  Compute lazy values and import lazy names / submodules on first access,
+  then keep them as plain module attributes.
+  """
+  import importlib
+
+  if name in __lazy_values:
+    value = __lazy_values[name]()
+  elif name in __lazy_names:
+    try:
+      module = importlib.import_module(__lazy_names[name])
+    except ImportError as err:
+      raise AttributeError('module {0!r} has no attribute {1!r} ({2})'.format(__name__, name, err))
+    value = getattr(module, name)
+  elif name in __submodules:
+    value = importlib.import_module('{0}.{1}'.format(__name__, name))
+  else:
+    raise AttributeError('module {0!r} has no attribute {1!r}'.format(__name__, name))
+
+  globals()[name] = value
+  return value
+
+
+def __dir__():
+  return sorted(set(globals()) | set(__lazy_values) | set(__lazy_names) | set(__submodules))
+
+
+class _LazyValue(object):
+  """
+  Class attribute resolved through the module __getattr__.
+  """
+
+  def __init__(self, name):
+    self.name = name
+
+  def __get__(self, instance, owner):
+    try:
+      return globals()[self.name]
+    except KeyError:
+      return __getattr__(self.name)
 
 
 class Zabbix(object):
-  __zabbix_serv_conf__ = '/etc/zabbix/zabbix_server.conf'
-  __zabbix_serv_addr__ = 'server1.example.org'
-  __zabbix_serv_port__ = 10051
+  __zabbix_serv_conf__ = __zabbix_serv_conf__
+  __zabbix_serv_addr__ = __zabbix_serv_addr__
+  __zabbix_serv_port__ = __zabbix_serv_port__
 
-  __zabbix_agnt_conf__ = '/etc/zabbix/zabbix_agentd.conf'
-  __zabbix_agnt_addr__ = 'client1.example.org'
-  __zabbix_agnt_name__ = socket.gethostname().split('.', 1)[0]
-  __zabbix_agnt_port__ = 10050
+  __zabbix_agnt_conf__ = __zabbix_agnt_conf__
+  __zabbix_agnt_addr__ = __zabbix_agnt_addr__
+  __zabbix_agnt_name__ = _LazyValue('__zabbix_agnt_name__')
+  __zabbix_agnt_port__ = __zabbix_agnt_port__
 
-  __zabbix_node_name__ = socket.getfqdn()
+  __zabbix_node_name__ = _LazyValue('__zabbix_node_name__')
 
-  __zabbix_time_curr__ = int(round(time.time()))
+  __zabbix_time_curr__ = _LazyValue('__zabbix_time_curr__')
 
-  __script_log_dir__ = '/var/log/zabbix'
+  __script_log_dir__ = __script_log_dir__
 
   def __init__(self, **kwargs):
-    logfile = kwargs.get(
+    import logging
+    import os
+
+    self.logfile = kwargs.get(
         'logfile',
         os.path.join(
             os.path.expanduser('~'),
             'python-zabbix.log'
             )
         )
-    self.logger = ZLog(**kwargs)
-
-
-__zabbix_serv_conf__ = '/etc/zabbix/zabbix_server.conf'
-__zabbix_serv_addr__ = 'server1.example.org'
-__zabbix_serv_port__ = 10051
-
-__zabbix_agnt_conf__ = '/etc/zabbix/zabbix_agentd.conf'
-__zabbix_agnt_addr__ = 'client1.example.org'
-__zabbix_agnt_name__ = socket.gethostname().split('.', 1)[0]
-__zabbix_agnt_port__ = 10050
-
-__zabbix_node_name__ = socket.getfqdn()
-
-__zabbix_time_curr__ = int(round(time.time()))
+    self.logger = logging.getLogger(__name__)
 
 
 def printvers(caller, version):
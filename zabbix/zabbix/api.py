@@ -1,10 +1,108 @@
 #!/usr/bin/env python3
 """
+A client for the Zabbix JSON-RPC API.
+
+Requests go over persistent HTTP/1.1 connections, kept in a small pool that
+is shared by every thread using the client.  The session token of the first
+login is reused for every later call, and the client logs in again by
+itself when the frontend ends the session;
+    >>> import zabbix.api
+    >>> import zabbix.tools._fakes
+    >>> frontend = zabbix.tools._fakes.FakeFrontend(objects={
+    ...   'host': [{'hostid': '10084', 'host': 'Zabbix server'}],
+    ...   })
+    >>> url = frontend.start()
+    >>> api = zabbix.api.ZabbixAPI(zabbix_url=url, zabbix_user='Admin', zabbix_pass='zabbix')
+    >>> api.api_version()
+    '6.0.0'
+    >>> api.request('host.get', {'output': ['hostid', 'host']})
+    [{'hostid': '10084', 'host': 'Zabbix server'}]
+    >>> frontend.expire_sessions()
+    >>> api.request('host.get')
+    [{'hostid': '10084', 'host': 'Zabbix server'}]
+    >>> api.request('nothing.get')
+    Traceback (most recent call last):
+    ...
+    zabbix.api.ZabbixAPIException: Method not found. (-32601): Incorrect API "nothing".
+    >>> api.stats()['logins'], frontend.connections
+    (2, 1)
+    >>> api.close()
+    >>> frontend.stop()
 """
-import hashlib
+import collections
+import concurrent.futures
+import http.client
+import itertools
 import json
 import logging
-import sys
+import queue
+import socket
+import threading
+import time
+import urllib.parse
+
+
+# Rows asked for per request by ZabbixAPI.pages().
+PAGE_SIZE = 10000
+
+# trend.get returns one row per item and hour.
+TREND_PERIOD = 3600
+
+# Objects whose id field is not named after the object.
+ID_FIELDS = {
+  'discoveryrule': 'itemid',
+  'graphprototype': 'graphid',
+  'hostgroup': 'groupid',
+  'hostprototype': 'hostid',
+  'itemprototype': 'itemid',
+  'problem': 'eventid',
+  'templategroup': 'groupid',
+  'triggerprototype': 'triggerid',
+  'usergroup': 'usrgrpid',
+  'usermacro': 'hostmacroid',
+  }
+
+# Object types ResponseCache does not keep, as their data changes all the
+# time.
+VOLATILE_OBJECTS = ('alert', 'auditlog', 'event', 'history', 'problem', 'trend')
+
+# Actions that change objects, and so invalidate cached results;  every
+# other call, e.g. history.get or apiinfo.version, leaves the cache alone.
+MUTATING_ACTIONS = (
+  'create', 'createglobal', 'delete', 'deleteglobal', 'import', 'massadd',
+  'massremove', 'massupdate', 'replacehostinterfaces', 'update', 'updateglobal',
+  )
+
+# Calls that may change objects of any type.
+GLOBAL_MUTATIONS = ('configuration.import',)
+
+# Cached results that changes to an object type may make stale, besides
+# those of the type itself;  e.g. deleting a host deletes its items.
+DEPENDENT_OBJECTS = {
+  'host': ('discoveryrule', 'graph', 'hostinterface', 'httptest', 'item', 'trigger', 'usermacro'),
+  'hostgroup': ('host', 'template'),
+  'item': ('graph', 'trigger'),
+  'template': ('discoveryrule', 'graph', 'host', 'httptest', 'item', 'trigger', 'usermacro'),
+  'templategroup': ('template',),
+  }
+
+
+def id_field(object_type):
+  """
+  The name of the id field of an API object, which is also the name of the
+  <field>s parameter selecting objects by id in <object>.get.
+
+    >>> id_field('item'), id_field('hostgroup')
+    ('itemid', 'groupid')
+  """
+  return ID_FIELDS.get(object_type, object_type + 'id')
+
+
+BatchResult = collections.namedtuple('BatchResult', ('method', 'params', 'result', 'error'))
+BatchResult.__doc__ = """
+The outcome of one call of a batch;  result is None when the call failed,
+and error is then the ZabbixAPIException it failed with.
+"""
 
 
 class ZabbixAPIException(Exception):
@@ -13,8 +111,16 @@ class ZabbixAPIException(Exception):
   Error Codes:
     -32602 - Invalid Parameters
     -32500 - No Permission
+
+  The JSON-RPC error code, the error data and the method called are kept in
+  the code, data and method attributes.
   """
-  pass
+
+  def __init__(self, message, code=None, data=None, method=None):
+    Exception.__init__(self, message)
+    self.code = code
+    self.data = data
+    self.method = method
 
 
 class AlreadyExists(ZabbixAPIException):
@@ -38,73 +144,1246 @@ class APITimeout(ZabbixAPIException):
   pass
 
 
-class ZabbixAPI(object):
+class NotAuthorized(ZabbixAPIException):
+  """
+  The login failed, or the session is no longer valid.
+  """
+  pass
+
+
+def api_error(method, error):
+  """
+  Turn the 'error' member of a JSON-RPC response into the matching
+  ZabbixAPIException.
+
+    >>> api_error('host.create', {'code': -32602, 'message': 'Invalid params.', 'data': 'Host with the same name "a" already exists.'})
+    AlreadyExists('Invalid params. (-32602): Host with the same name "a" already exists.')
+  """
+  code = error.get('code', None)
+  data = u'{0}'.format(error.get('data', ''))
+  message = u'{0} ({1}): {2}'.format(error.get('message', 'Unknown error.'), code, data)
+
+  lowered = data.lower()
+  if 're-login' in lowered or 'not authori' in lowered or 'incorrect user name or password' in lowered:
+    exception = NotAuthorized
+  elif 'already exist' in lowered:
+    exception = AlreadyExists
+  elif code in (-32700, -32600):
+    exception = InvalidProtocolError
+  else:
+    exception = ZabbixAPIException
+  return exception(message, code, data, method)
+
+
+class HTTPConnectionPool(object):
   """
+  A small pool of persistent HTTP/1.1 connections to one frontend, the HTTP
+  sibling of zabbix.transport.ConnectionPool.
+
+  The class object supports the following keyword arguments at instantiation;
+    max_size      -- (Integer) Maximum number of idle connections kept open.
+                     Defaults to 8.
+
+    timeout       -- (Number) Socket timeout in seconds.  Defaults to 10.
+
+    ssl_context   -- (ssl.SSLContext) Used for https URLs.  Defaults to the
+                     system default context.
   """
-  zabbix = {}
 
-  method = None
-  params = {}
+  def __init__(self, url, **kwargs):
+    parts = urllib.parse.urlsplit(url)
+    self.scheme = parts.scheme or 'http'
+    self.host = parts.hostname
+    self.port = parts.port
+    self.path = parts.path or '/'
+    if parts.query:
+      self.path = '{0}?{1}'.format(self.path, parts.query)
+
+    self.max_size = int(kwargs.get('max_size', 8))
+    self.timeout = kwargs.get('timeout', 10)
+    self.ssl_context = kwargs.get('ssl_context', None)
+
+    self.__lock = threading.Lock()
+    self.__idle = []
+    self.__stats = {'opened': 0, 'reused': 0, 'retried': 0, 'closed': 0}
+
+  def __count(self, counter):
+    with self.__lock:
+      self.__stats[counter] += 1
+
+  def __connect(self):
+    """
+    Open a new connection.  http.client writes the headers and the body of
+    a request separately, so Nagle's algorithm is turned off;  it would hold
+    the body back until the headers are acknowledged.
+    """
+    if self.scheme == 'https':
+      connection = http.client.HTTPSConnection(
+          self.host, self.port, timeout=self.timeout, context=self.ssl_context)
+    else:
+      connection = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+    connection.connect()
+    connection.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    self.__count('opened')
+    return connection
+
+  def acquire(self):
+    """
+    Return a (connection, reused) tuple, preferring an idle connection.
+    """
+    with self.__lock:
+      if self.__idle:
+        self.__stats['reused'] += 1
+        return self.__idle.pop(), True
+    return self.__connect(), False
+
+  def release(self, connection, reusable=True):
+    """
+    Hand a connection back to the pool, or close it if it can not be reused
+    or the pool is full.
+    """
+    if reusable:
+      with self.__lock:
+        if len(self.__idle) < self.max_size:
+          self.__idle.append(connection)
+          return
+    connection.close()
+    self.__count('closed')
+
+  @staticmethod
+  def __unread(err, sending):
+    """
+    Whether the failure err shows that the frontend closed the connection
+    without reading the request; a reset or broken pipe while sending, or the
+    connection closed before the first byte of the status line.
+    """
+    if sending:
+      return isinstance(err, (BrokenPipeError, ConnectionResetError))
+    return isinstance(err, http.client.RemoteDisconnected)
+
+  def post(self, body, headers):
+    """
+    POST body to the API URL and return (status, response body).  When a
+    reused connection turns out to have been closed by the frontend before it
+    read the request, the request is retried once over a fresh connection.
+    Anything else, timeouts and truncated responses included, is raised as
+    is; the frontend may have carried the call out already.
+    """
+    (connection, reused) = self.acquire()
+    while True:
+      sending = True
+      try:
+        connection.request('POST', self.path, body, headers)
+        sending = False
+        response = connection.getresponse()
+        data = response.read()
+      except (http.client.HTTPException, socket.error) as err:
+        self.release(connection, reusable=False)
+        if not reused or not self.__unread(err, sending):
+          raise
+        logging.debug('Pooled HTTP connection went away, reconnecting: %s', err)
+        self.__count('retried')
+        (connection, reused) = (self.__connect(), False)
+        continue
+
+      self.release(connection, reusable=not response.will_close)
+      return response.status, data
+
+  def close(self):
+    """
+    Close every idle connection.
+    """
+    with self.__lock:
+      idle = self.__idle
+      self.__idle = []
+    for connection in idle:
+      connection.close()
+      self.__count('closed')
+
+  def stats(self):
+    """
+    Return the pool counters as a dict.
+    """
+    with self.__lock:
+      retval = dict(self.__stats)
+      retval['idle'] = len(self.__idle)
+    return retval
+
+
+class ResponseCache(object):
+  """
+  A cache of <object>.get results for ZabbixAPI, keyed by the method and
+  its parameters in canonical form, so the order of their keys does not
+  matter.  Entries expire after ttl seconds, and the least recently used
+  ones are evicted beyond max_entries, or once the results take more than
+  max_bytes.  Results are kept as JSON text, which is what the memory cap
+  counts, and every hit decodes a copy of its own.
 
-  timeout = 10
+  Calls that change objects of a type (see MUTATING_ACTIONS), e.g.
+  host.update, drop the cached results of that type and of the types it
+  affects (see DEPENDENT_OBJECTS);  configuration.import drops everything.
+  Results of a type are only stored when no such call happened since they
+  were asked for, as they may predate the change.
 
-  id = None
+  The class object supports the following keyword arguments at instantiation;
+    ttl           -- (Number) Seconds a result is used.  Defaults to 60.
+
+    max_entries   -- (Integer) Number of results kept.  Defaults to 1024.
+
+    max_bytes     -- (Integer) Size of the results kept, as JSON text.
+                     Defaults to 16 MiB.
+
+    uncached      -- (List) Object types never cached.  Defaults to
+                     VOLATILE_OBJECTS.
+
+    >>> cache = ResponseCache(max_entries=2)
+    >>> cache.put('host.get', {'output': ['host'], 'hostids': ['10084']}, [{'host': 'a'}])
+    >>> cache.get('host.get', {'hostids': ['10084'], 'output': ['host']})
+    [{'host': 'a'}]
+    >>> cache.put('item.get', {}, [])
+    >>> cache.put('template.get', {}, [])
+    >>> cache.get('host.get', {'hostids': ['10084'], 'output': ['host']}) is None
+    True
+    >>> cache.invalidate('template.delete')
+    2
+    >>> stats = cache.stats()
+    >>> stats['hits'], stats['misses'], stats['evictions'], stats['entries']
+    (1, 1, 1, 0)
+    >>> cache.mutates('history.get'), cache.mutates('host.massadd')
+    (False, True)
+    >>> generation = cache.generation('host.get')
+    >>> cache.invalidate('trigger.update')
+    0
+    >>> cache.put('host.get', {}, [], generation)
+    >>> cache.invalidate('hostgroup.delete')
+    1
+    >>> cache.put('host.get', {}, [], generation)
+    >>> cache.stats()['entries']
+    0
+  """
+
+  def __init__(self, **kwargs):
+    self.ttl = float(kwargs.get('ttl', 60))
+    self.max_entries = int(kwargs.get('max_entries', 1024))
+    self.max_bytes = int(kwargs.get('max_bytes', 16 << 20))
+    self.uncached = frozenset(kwargs.get('uncached', VOLATILE_OBJECTS))
+
+    self.__lock = threading.Lock()
+    self.__epoch = 0
+    self.__generations = collections.Counter()
+    self.__entries = collections.OrderedDict()
+    self.__bytes = 0
+    self.__stats = {'hits': 0, 'misses': 0, 'expired': 0, 'evictions': 0, 'invalidations': 0}
+
+  @staticmethod
+  def key(method, params):
+    """
+    The cache key of a call.
+    """
+    return method, json.dumps(params, sort_keys=True, separators=(',', ':'))
+
+  def cacheable(self, method):
+    """
+    Whether the results of method are cached.
+    """
+    (object_type, _, action) = method.partition('.')
+    return action == 'get' and object_type not in self.uncached
+
+  @staticmethod
+  def mutates(method):
+    """
+    Whether a call of method may change objects, and so cached results.
+    """
+    return method in GLOBAL_MUTATIONS or method.partition('.')[2] in MUTATING_ACTIONS
+
+  def generation(self, method):
+    """
+    The generation of the object type of method, to hand to put() with a
+    result asked for now.  It changes whenever results of the type are
+    invalidated.
+    """
+    with self.__lock:
+      return self.__epoch, self.__generations[method.partition('.')[0]]
+
+  def __remove(self, key):
+    (_, _, text) = self.__entries.pop(key)
+    self.__bytes -= len(text)
+
+  def get(self, method, params):
+    """
+    The cached result of a call, or None.
+    """
+    key = self.key(method, params)
+    with self.__lock:
+      entry = self.__entries.get(key, None)
+      if entry is not None and entry[0] <= time.time():
+        self.__remove(key)
+        self.__stats['expired'] += 1
+        entry = None
+      if entry is None:
+        self.__stats['misses'] += 1
+        return None
+      self.__entries.move_to_end(key)
+      self.__stats['hits'] += 1
+    return json.loads(entry[2])
+
+  def put(self, method, params, result, generation=None):
+    """
+    Cache the result of a call.  When generation is given, the result is
+    only kept if results of its type were not invalidated since
+    generation() returned it, as it may predate the change.
+    """
+    if result is None or not self.cacheable(method):
+      return
+    text = json.dumps(result, separators=(',', ':'))
+    if len(text) > self.max_bytes:
+      return
+
+    key = self.key(method, params)
+    with self.__lock:
+      object_type = method.partition('.')[0]
+      if generation is not None and generation != (self.__epoch, self.__generations[object_type]):
+        return
+      if key in self.__entries:
+        self.__remove(key)
+      self.__entries[key] = (time.time() + self.ttl, object_type, text)
+      self.__bytes += len(text)
+      while len(self.__entries) > self.max_entries or self.__bytes > self.max_bytes:
+        self.__remove(next(iter(self.__entries)))
+        self.__stats['evictions'] += 1
+
+  def invalidate(self, method=None):
+    """
+    Drop the results a call of method may have made stale, or every result,
+    and return the number of results dropped.  Only the generations of the
+    object types affected change.
+    """
+    with self.__lock:
+      if method is None or method in GLOBAL_MUTATIONS:
+        self.__epoch += 1
+        keys = list(self.__entries)
+      else:
+        object_type = method.partition('.')[0]
+        affected = set((object_type,) + DEPENDENT_OBJECTS.get(object_type, ()))
+        for name in affected:
+          self.__generations[name] += 1
+        keys = [x for (x, entry) in self.__entries.items() if entry[1] in affected]
+      for key in keys:
+        self.__remove(key)
+      self.__stats['invalidations'] += len(keys)
+    return len(keys)
+
+  def stats(self):
+    """
+    Return the hit, miss, expiry, eviction and invalidation counters, the
+    number of entries and their size as a dict.
+    """
+    with self.__lock:
+      retval = dict(self.__stats)
+      retval['entries'] = len(self.__entries)
+      retval['bytes'] = self.__bytes
+    return retval
+
+
+class ZabbixAPI(object):
+  """
+  A Zabbix API client, safe to share between threads.
+
+  The class object supports the following keyword arguments at instantiation;
+    zabbix_url    -- (String) The full URL of api_jsonrpc.php.  Defaults to
+                     zabbix_http followed by zabbix_path.
+
+    zabbix_http   -- (String) The URL of the frontend.  Defaults to
+                     http://localhost/zabbix
+
+    zabbix_path   -- (String) Path of the API below zabbix_http.  Defaults
+                     to /api_jsonrpc.php
+
+    zabbix_port   -- (Integer) Port of the frontend, when it is not part of
+                     the URL.
+
+    zabbix_user   -- (String) User to log in as.  Defaults to admin.
+
+    zabbix_pass   -- (String) Password of the user.  Defaults to zabbix.
+
+    zabbix_token  -- (String) An API token to use instead of logging in.
+
+    timeout       -- (Number) Seconds a single HTTP request may take.
+                     Defaults to 10.
+
+    pool_size     -- (Integer) Maximum number of idle connections kept open;
+                     roughly the number of threads expected to share the
+                     client.  Defaults to 8.
+
+    batch_size    -- (Integer) Calls sent per HTTP request by batch().
+                     Defaults to 100.
+
+    ssl_context   -- (ssl.SSLContext) Used for https URLs.
+
+    cache         -- (ResponseCache) Cache <object>.get results in it, see
+                     ResponseCache;  True creates one with the default
+                     limits.  Defaults to None (no caching).
+
+  Sessions are passed as an Authorization header to frontends of version
+  6.4 and later, and in the 'auth' member of the request otherwise;  the
+  version is asked for before the first call that needs a session, API
+  token or not.
+
+    >>> import zabbix.tools._fakes
+    >>> frontend = zabbix.tools._fakes.FakeFrontend(
+    ...   objects={'host': []}, version='7.2.0', tokens=['0123456789abcdef'])
+    >>> api = ZabbixAPI(zabbix_url=frontend.start(), zabbix_token='0123456789abcdef')
+    >>> api.request('host.get')
+    []
+    >>> frontend.last_auth
+    ('0123456789abcdef', None)
+    >>> api.stats()['logins']
+    0
+    >>> frontend.stop()
+  """
 
   def __init__(self, **kwargs):
     """
     """
     self.log_level = kwargs.get('log_level', logging.WARNING)
-    self.logger = logging.StreamHandler(sys.stdout)
+    self.logger = logging.getLogger(__name__)
 
     self.timeout = kwargs.get('timeout', 10)
 
+    self.zabbix = {}
     self.zabbix['host'] = kwargs.get('zabbix_host', 'localhost')
     self.zabbix['http'] = kwargs.get('zabbix_http', 'http://localhost/zabbix')
     self.zabbix['path'] = kwargs.get('zabbix_path', '/api_jsonrpc.php')
-    self.zabbix['port'] = kwargs.get('zabbix_port', 80)
+    self.zabbix['port'] = kwargs.get('zabbix_port', None)
     self.zabbix['user'] = kwargs.get('zabbix_user', 'admin')
-    self.zabbix['pass'] = "md5({})".format(
-        hashlib.md5(
-            kwargs.get('zabbix_pass', 'zabbix').encode('utf-8')
-            ).hexdigest()
+    self.zabbix['pass'] = kwargs.get('zabbix_pass', 'zabbix')
+    self.zabbix['token'] = kwargs.get('zabbix_token', None)
+    self.zabbix['url'] = kwargs.get(
+        'zabbix_url',
+        self.zabbix['http'].rstrip('/') + self.zabbix['path']
+        )
+    if self.zabbix['port'] is not None and urllib.parse.urlsplit(self.zabbix['url']).port is None:
+      parts = urllib.parse.urlsplit(self.zabbix['url'])
+      self.zabbix['url'] = urllib.parse.urlunsplit(parts._replace(
+          netloc='{0}:{1}'.format(parts.netloc, int(self.zabbix['port']))
+          ))
+
+    self.pool = HTTPConnectionPool(
+        self.zabbix['url'],
+        max_size=kwargs.get('pool_size', 8),
+        timeout=self.timeout,
+        ssl_context=kwargs.get('ssl_context', None)
         )
 
-    self.debug(self.log_level, "url: {}".format(self.zabbix['http']))
+    self.batch_size = int(kwargs.get('batch_size', 100))
+    self.cache = kwargs.get('cache', None)
+    if self.cache is True:
+      self.cache = ResponseCache()
+    elif self.cache is False:
+      self.cache = None
+
+    self.auth = self.zabbix['token']
+    self.__version = None
+    self.__version_text = None
+    self.__ids = itertools.count(1)
+    self.__lock = threading.Lock()
+    self.__login_lock = threading.Lock()
+    self.__stats = {'requests': 0, 'calls': 0, 'errors': 0, 'logins': 0, 'seconds': 0.0}
 
-#    print self.zabbix['pass']
+    self.debug(logging.DEBUG, "url: {}".format(self.zabbix['url']))
 
-  def debug(self, log_level="info", var="", msg=None):
+  def debug(self, log_level=logging.INFO, var="", msg=None):
     """
     """
-    log_entry = "{}: {} {}".format(log_level, var, msg)
+    log_entry = "{} {}".format(var, msg) if msg is not None else "{}".format(var)
     self.logger.log(log_level, log_entry)
 
-  def json_obj(self, method, params={}, auth=True):
-    """
-    """
+  def __count(self, counter, value=1):
+    with self.__lock:
+      self.__stats[counter] += value
+
+  def __request_obj(self, method, params, auth):
     obj = {
         'jsonrpc': '2.0',
         'method': method,
         'params': params,
-        'id': self.id
+        'id': next(self.__ids)
         }
-    if auth:
+    if auth and self.auth and not self.__header_auth():
       obj['auth'] = self.auth
+    return obj
 
-    return json.dumps(obj)
+  def json_obj(self, method, params={}, auth=True):
+    """
+    Build the JSON-RPC request for one call, with an id of its own, and
+    return it as JSON text.
+    """
+    return json.dumps(self.__request_obj(method, params, auth))
+
+  def __header_auth(self):
+    """
+    Whether the session goes in an Authorization header (6.4 and later).
+    """
+    return self.__version is not None and self.__version >= (6, 4)
+
+  def __check_version(self):
+    """
+    Ask for the API version before the first authenticated call, as it
+    decides where the session goes;  login() does so too, but an API token
+    is used without logging in.
+    """
+    if self.__version is None:
+      with self.__login_lock:
+        if self.__version is None:
+          self.api_version()
+
+  def __headers(self, auth):
+    headers = {'Content-Type': 'application/json-rpc'}
+    if auth and self.auth and self.__header_auth():
+      headers['Authorization'] = 'Bearer {0}'.format(self.auth)
+    return headers
+
+  def post(self, body, auth=True):
+    """
+    POST a JSON-RPC request (or batch) and return the decoded response.
+    Raises APITimeout, or InvalidProtocolError when the frontend does not
+    answer with JSON.
+    """
+    started = time.time()
+    try:
+      (status, data) = self.pool.post(body.encode('utf-8'), self.__headers(auth))
+    except socket.timeout:
+      self.__count('errors')
+      raise APITimeout('No response from {0} within {1}s'.format(self.zabbix['url'], self.timeout))
+    finally:
+      self.__count('requests')
+      self.__count('seconds', time.time() - started)
+
+    if status != 200:
+      self.__count('errors')
+      raise InvalidProtocolError('HTTP status {0} from {1}'.format(status, self.zabbix['url']), code=status)
+    try:
+      return json.loads(data.decode('utf-8'))
+    except ValueError:
+      self.__count('errors')
+      raise InvalidProtocolError(
+          'Invalid JSON from {0}: {1!r}'.format(self.zabbix['url'], data[:200])
+          )
+
+  def __call(self, method, params, auth):
+    request = self.__request_obj(method, params, auth)
+    request_id = request['id']
+    self.debug(logging.DEBUG, 'request:', method)
+    self.__count('calls')
+    response = self.post(json.dumps(request), auth)
+
+    if not isinstance(response, dict) or response.get('id', None) != request_id:
+      self.__count('errors')
+      raise InvalidProtocolError('Response does not match request {0}'.format(request_id), method=method)
+    if 'error' in response:
+      self.__count('errors')
+      raise api_error(method, response['error'])
+    return response.get('result', None)
+
+  def request(self, method, params=None, auth=True):
+    """
+    Call an API method and return its result.  Errors reported by the API
+    are raised as ZabbixAPIException subclasses.  When the session has
+    expired, the client logs in again and repeats the call once.
+
+    With a cache, <object>.get results are answered from it when possible,
+    and calls that change objects invalidate the cached results they may
+    affect, whether they succeeded or not;
+      >>> import zabbix.tools._fakes
+      >>> frontend = zabbix.tools._fakes.FakeFrontend(objects={'host': [{'hostid': '10084', 'status': '0'}]})
+      >>> api = ZabbixAPI(zabbix_url=frontend.start(), zabbix_user='Admin', cache=True)
+      >>> for _ in range(3):
+      ...   hosts = api.request('host.get', {'output': ['status'], 'hostids': ['10084']})
+      >>> hosts, frontend.requests
+      ([{'status': '0'}], 3)
+      >>> api.request('host.update', {'hostid': '10084', 'status': '1'})
+      {'hostids': ['10084']}
+      >>> api.request('host.get', {'hostids': ['10084'], 'output': ['status']})
+      [{'status': '1'}]
+      >>> stats = api.stats()['cache']
+      >>> stats['hits'], stats['misses'], stats['invalidations']
+      (2, 2, 1)
+      >>> frontend.stop()
+    """
+    params = {} if params is None else params
+    if self.cache is None:
+      return self.__request(method, params, auth)
+
+    if self.cache.mutates(method):
+      try:
+        return self.__request(method, params, auth)
+      finally:
+        self.cache.invalidate(method)
+    if not self.cache.cacheable(method):
+      return self.__request(method, params, auth)
+
+    result = self.cache.get(method, params)
+    if result is None:
+      generation = self.cache.generation(method)
+      result = self.__request(method, params, auth)
+      self.cache.put(method, params, result, generation)
+    return result
+
+  def __request(self, method, params, auth=True):
+    if not auth:
+      return self.__call(method, params, False)
+
+    self.__check_version()
+    session = self.auth
+    if session is None:
+      session = self.login()
+    try:
+      return self.__call(method, params, True)
+    except NotAuthorized:
+      if self.zabbix['token'] is not None:
+        raise
+      self.debug(logging.INFO, 'Session expired, logging in again')
+      self.login(expired=session)
+      return self.__call(method, params, True)
+
+  def __call_batch(self, calls):
+    """
+    Send (method, params) calls as one JSON-RPC batch, and return the result
+    of every call, or the ZabbixAPIException it failed with, in order.
+    Responses are matched to calls by id, as the frontend may answer them
+    in any order.
+    """
+    requests = [self.__request_obj(method, params, True) for (method, params) in calls]
+    self.debug(logging.DEBUG, 'batch:', len(requests))
+    self.__count('calls', len(requests))
+    try:
+      response = self.post(json.dumps(requests), True)
+    except ZabbixAPIException as err:
+      return [err] * len(calls)
+    except (http.client.HTTPException, socket.error) as err:
+      self.__count('errors')
+      return [ZabbixAPIException(u'{0}'.format(err))] * len(calls)
+
+    if not isinstance(response, list):
+      if isinstance(response, dict) and 'error' in response:
+        error = api_error(None, response['error'])
+      else:
+        error = InvalidProtocolError('Batch answered with {0!r}'.format(response)[:200])
+      self.__count('errors')
+      return [error] * len(calls)
+
+    responses = dict((x.get('id', None), x) for x in response if isinstance(x, dict))
+    retval = []
+    for (request, (method, _)) in zip(requests, calls):
+      answer = responses.get(request['id'], None)
+      if answer is None:
+        retval.append(InvalidProtocolError('No response to request {0}'.format(request['id']), method=method))
+      elif 'error' in answer:
+        retval.append(api_error(method, answer['error']))
+      else:
+        retval.append(answer.get('result', None))
+    self.__count('errors', sum(1 for x in retval if isinstance(x, ZabbixAPIException)))
+    return retval
+
+  def batch(self, calls, **kwargs):
+    """
+    Make many calls in as few HTTP requests as possible, and return a
+    BatchResult per call, in order.  calls is an iterable of (method,
+    params) tuples;  they are sent chunk_size (by default batch_size) at a
+    time as JSON-RPC batches.  A failed call does not fail the others, its
+    error is returned instead, and calls whose session expired are repeated
+    once after logging in again.  With a cache, only the calls it can not
+    answer are sent, as for request().
+
+      >>> import zabbix.tools._fakes
+      >>> frontend = zabbix.tools._fakes.FakeFrontend(objects={'host': [{'hostid': '10084'}]})
+      >>> api = ZabbixAPI(zabbix_url=frontend.start(), zabbix_user='Admin', batch_size=2)
+      >>> for call in api.batch([
+      ...     ('host.get', {}),
+      ...     ('nothing.get', {}),
+      ...     ('apiinfo.version', []),
+      ...     ]):
+      ...   print(call.method, call.result, call.error)
+      host.get [{'hostid': '10084'}] None
+      nothing.get None Method not found. (-32601): Incorrect API "nothing".
+      apiinfo.version 6.0.0 None
+      >>> frontend.batches
+      2
+      >>> frontend.stop()
+    """
+    chunk_size = int(kwargs.get('chunk_size', self.batch_size))
+    calls = [(method, {} if params is None else params) for (method, params) in calls]
+
+    outcomes = [None] * len(calls)
+    if self.cache is not None:
+      generations = [self.cache.generation(method) for (method, _) in calls]
+      for (index, (method, params)) in enumerate(calls):
+        if self.cache.cacheable(method):
+          outcomes[index] = self.cache.get(method, params)
+    pending = [x for (x, outcome) in enumerate(outcomes) if outcome is None]
+    if pending:
+      self.__check_version()
+    if self.auth is None and pending:
+      self.login()
+
+    for start in range(0, len(pending), chunk_size):
+      indexes = pending[start:start + chunk_size]
+      chunk = [calls[x] for x in indexes]
+      session = self.auth
+      chunk_outcomes = self.__call_batch(chunk)
+
+      expired = [x for (x, outcome) in enumerate(chunk_outcomes) if isinstance(outcome, NotAuthorized)]
+      if expired and self.zabbix['token'] is None:
+        self.debug(logging.INFO, 'Session expired, logging in again')
+        self.login(expired=session)
+        for (index, outcome) in zip(expired, self.__call_batch([chunk[x] for x in expired])):
+          chunk_outcomes[index] = outcome
+
+      for (index, outcome) in zip(indexes, chunk_outcomes):
+        outcomes[index] = outcome
+
+    if self.cache is not None:
+      for index in pending:
+        if self.cache.mutates(calls[index][0]):
+          self.cache.invalidate(calls[index][0])
+      for index in pending:
+        if not isinstance(outcomes[index], ZabbixAPIException):
+          self.cache.put(calls[index][0], calls[index][1], outcomes[index], generations[index])
+
+    retval = []
+    for ((method, params), outcome) in zip(calls, outcomes):
+      if isinstance(outcome, ZabbixAPIException):
+        retval.append(BatchResult(method, params, None, outcome))
+      else:
+        retval.append(BatchResult(method, params, outcome, None))
+    return retval
+
+  def pages(self, method, params=None, **kwargs):
+    """
+    Make a <object>.get call that may match millions of rows in requests of
+    at most page_size rows, and yield the result a page (a list of rows) at
+    a time;  every page is a JSON document of its own, decoded as it
+    arrives.  A limit in params caps the total number of rows.  Pages are
+    never cached.
+
+      - history.get is sorted by clock, and every request continues from
+        the clock of the last row received;  memory use depends on the page
+        size only.
+      - trend.get can not be sorted, so the time range is walked in windows
+        expected to hold about half a page;  memory use depends on the page
+        size only.
+      - Other objects are listed by id first, then fetched page_size ids at
+        a time.  The API can not filter on ids greater than a cursor, so the
+        listing is a single request for every matching id:  it is not
+        bounded by the page size, but holds one id per row rather than the
+        objects themselves.
+
+    The method supports the following keyword arguments;
+      page_size     -- (Integer) Rows asked for per request.  Defaults to
+                       10000.
+
+      prefetch      -- (Boolean) Request the next page on a background
+                       thread while the current one is processed.  Defaults
+                       to False.
+    """
+    (object_type, _, action) = method.partition('.')
+    if action != 'get':
+      raise ValueError('Only <object>.get calls can be paged, not {0}'.format(method))
+    params = dict(params or {})
+    page_size = int(kwargs.get('page_size', PAGE_SIZE))
+    total = params.pop('limit', None)
+
+    if object_type == 'history':
+      pages = self.__clock_pages(method, params, page_size)
+    elif object_type == 'trend':
+      pages = self.__window_pages(method, params, page_size)
+    else:
+      pages = self.__id_pages(method, params, page_size, total)
+    if total is not None:
+      pages = self.__truncated(pages, int(total))
+    if kwargs.get('prefetch', False):
+      pages = self.__prefetched(pages)
+    return pages
+
+  def iterate(self, method, params=None, **kwargs):
+    """
+    Yield the rows of a large <object>.get call one by one, see pages() for
+    the keyword arguments.
+
+      >>> import zabbix.tools._fakes
+      >>> history = [
+      ...   {'itemid': str(23296 + x % 2), 'clock': str(1700000000 + x // 4), 'ns': str(x), 'value': str(x)}
+      ...   for x in range(25)
+      ...   ]
+      >>> trends = [
+      ...   {'itemid': '23296', 'clock': str(1700000000 + x * 3600), 'num': '60', 'value_avg': str(x)}
+      ...   for x in range(10)
+      ...   ]
+      >>> items = [{'itemid': str(x), 'name': 'item {0}'.format(x)} for x in range(1, 8)]
+      >>> frontend = zabbix.tools._fakes.FakeFrontend(
+      ...   objects={'history': history, 'trend': trends, 'item': items})
+      >>> api = ZabbixAPI(zabbix_url=frontend.start(), zabbix_user='Admin')
+      >>> rows = api.iterate('history.get', {'itemids': ['23296', '23297']}, page_size=3)
+      >>> [x['value'] for x in rows] == [x['value'] for x in history]
+      True
+      >>> rows = api.iterate('history.get', {'time_from': 1700000005, 'limit': 4}, prefetch=True)
+      >>> [x['value'] for x in rows]
+      ['20', '21', '22', '23']
+      >>> [len(x) for x in api.pages('item.get', {'output': ['name']}, page_size=3)]
+      [3, 3, 1]
+      >>> [len(x) for x in api.pages('trend.get', {'itemids': ['23296'], 'time_from': 1700000000, 'time_till': 1700036000}, page_size=4)]
+      [2, 2, 2, 2, 2]
+      >>> frontend.stop()
+    """
+    pages = self.pages(method, params, **kwargs)
+    try:
+      for page in pages:
+        for row in page:
+          yield row
+    finally:
+      pages.close()
+
+  def __clock_pages(self, method, params, page_size):
+    """
+    history.get pages.  Every request starts at the clock of the last row
+    received, so the rows of that second already returned are skipped;  when
+    one second holds more rows than a page, the page grows until it gets
+    past that second.
+    """
+    output = params.get('output', 'extend')
+    if isinstance(output, list):
+      params['output'] = output + [x for x in ('itemid', 'clock', 'ns') if x not in output]
+    time_from = params.get('time_from', None)
+    limit = page_size
+    seen = set()
+
+    while True:
+      query = dict(params, sortfield='clock', sortorder='ASC', limit=limit)
+      if time_from is not None:
+        query['time_from'] = time_from
+      rows = self.__request(method, query)
+      page = [x for x in rows if (x['itemid'], x['clock'], x.get('ns', None)) not in seen]
+      if page:
+        yield page
+      if len(rows) < limit:
+        return
+
+      last = int(rows[-1]['clock'])
+      if time_from is not None and last == int(time_from):
+        limit *= 2
+      else:
+        limit = page_size
+      seen = set((x['itemid'], x['clock'], x.get('ns', None)) for x in rows if int(x['clock']) == last)
+      time_from = last
+
+  def __window_pages(self, method, params, page_size):
+    """
+    trend.get pages.  The time range is walked in windows expected to hold
+    half a page of hourly rows;  a window that fills a page is halved and
+    asked again.
+    """
+    itemids = params.get('itemids', None)
+    items = len(itemids) if isinstance(itemids, list) else 1
+    start = int(params.get('time_from', 0))
+    time_till = int(params.get('time_till', None) or time.time())
+    window = TREND_PERIOD * max(1, page_size // (2 * max(items, 1)))
+    limit = page_size
+
+    while start <= time_till:
+      end = min(start + window - 1, time_till)
+      rows = self.__request(method, dict(params, time_from=start, time_till=end, limit=limit))
+      if len(rows) >= limit:
+        if end > start:
+          window = max(1, (end - start + 1) // 2)
+        else:
+          limit *= 2
+        continue
+
+      if rows:
+        rows.sort(key=lambda x: int(x['clock']))
+        yield rows
+      start = end + 1
+      limit = page_size
+
+  def __id_pages(self, method, params, page_size, total):
+    """
+    Pages of any other <object>.get call.  The ids of the matching objects
+    are listed first, without their details, then the objects are asked for
+    page_size ids at a time, in id order.
+
+    The listing is one unpaged request:  <object>.get has neither an offset
+    nor a greater-than filter on ids, so there is no cursor to continue
+    from.  Its size grows with the number of matching objects, at one id
+    each.
+    """
+    field = id_field(method.partition('.')[0])
+    ids = params.get(field + 's', None)
+    if not isinstance(ids, list):
+      query = dict((k, v) for (k, v) in params.items() if not k.startswith('select'))
+      query.update(output=[field], preservekeys=False)
+      if total is not None:
+        query.update(limit=total, sortfield=field)
+      ids = sorted((x[field] for x in self.__request(method, query)), key=int)
+
+    for start in range(0, len(ids), page_size):
+      rows = self.__request(method, dict(params, **{field + 's': ids[start:start + page_size]}))
+      if isinstance(rows, dict):
+        rows = list(rows.values())
+      if rows:
+        yield rows
+
+  @staticmethod
+  def __truncated(pages, total):
+    """
+    Stop a page generator after total rows.
+    """
+    try:
+      for page in pages:
+        if total <= 0:
+          return
+        if len(page) > total:
+          page = page[:total]
+        total -= len(page)
+        yield page
+    finally:
+      pages.close()
+
+  @staticmethod
+  def __prefetched(pages):
+    """
+    Run a page generator on a background thread, one page ahead of the
+    consumer.  The thread stops once the consumer does.
+    """
+    ready = queue.Queue(maxsize=1)
+    done = threading.Event()
+
+    def offer(item):
+      while not done.is_set():
+        try:
+          ready.put(item, timeout=0.1)
+          return True
+        except queue.Full:
+          continue
+      return False
+
+    def produce():
+      try:
+        for page in pages:
+          if not offer(page):
+            pages.close()
+            return
+        offer(None)
+      except Exception as err:
+        offer(err)
+
+    thread = threading.Thread(target=produce, name='ZabbixAPI-prefetch')
+    thread.daemon = True
+    thread.start()
+    try:
+      while True:
+        item = ready.get()
+        if item is None:
+          return
+        if isinstance(item, Exception):
+          raise item
+        yield item
+    finally:
+      done.set()
+
+  def api_version(self):
+    """
+    The version of the API, e.g. '6.0.21'.  Asked once, then remembered.
+    """
+    if self.__version is None:
+      version = self.__call('apiinfo.version', [], False)
+      self.__version = tuple(int(x) for x in version.split('.')[:2] if x.isdigit())
+      self.__version_text = version
+    return self.__version_text
 
   def login(self, **kwargs):
     """
+    Log in and return the session token.  Threads that find their session
+    expired at the same time log in only once; expired is the session the
+    caller saw fail.
+    """
+    with self.__login_lock:
+      if self.auth is not None and self.auth != kwargs.get('expired', None):
+        return self.auth
+
+      if self.__version is None:
+        self.api_version()
+      user_field = 'username' if self.__version >= (5, 4) else 'user'
+      self.auth = None
+      self.auth = self.__call(
+          'user.login',
+          {user_field: self.zabbix['user'], 'password': self.zabbix['pass']},
+          False
+          )
+      self.__count('logins')
+      self.debug(logging.DEBUG, 'logged in as', self.zabbix['user'])
+      return self.auth
+
+  def logout(self):
+    """
+    End the session, unless an API token is used.
+    """
+    if self.auth is None or self.zabbix['token'] is not None:
+      return False
+    try:
+      return self.__call('user.logout', [], True)
+    finally:
+      self.auth = None
+
+  def close(self):
+    """
+    Close the idle connections.  The client remains usable.
+    """
+    self.pool.close()
+
+  def stats(self):
+    """
+    Return the request, error and login counters, the time spent waiting
+    for the frontend, and the connection pool and cache counters as a
+    dict.
+    """
+    with self.__lock:
+      retval = dict(self.__stats)
+    retval['pool'] = self.pool.stats()
+    if self.cache is not None:
+      retval['cache'] = self.cache.stats()
+    return retval
+
+
+class ProvisionPlan(object):
+  """
+  The changes Provisioner.apply() makes:  the hosts and items to create,
+  the fields to update on existing ones, and how many need no change.
+  Items to create are (host name, item) tuples, as their host may not
+  exist yet.
+  """
+
+  def __init__(self):
+    self.hostids = {}
+    self.create_hosts = []
+    self.update_hosts = []
+    self.create_items = []
+    self.update_items = []
+    self.unchanged = {'host': 0, 'item': 0}
+
+  def counts(self):
     """
-    auth_obj = self.json_obj(
-        'usr.login',
-        { 'user': self.zabbix['user'], 'password': self.zabbix['pass'] },
-        auth=False
+    Return the number of objects per action as a dict.
+    """
+    return {
+      'host.create': len(self.create_hosts),
+      'host.update': len(self.update_hosts),
+      'host.unchanged': self.unchanged['host'],
+      'item.create': len(self.create_items),
+      'item.update': len(self.update_items),
+      'item.unchanged': self.unchanged['item'],
+      }
+
+  def __str__(self):
+    return ', '.join('{0} {1}'.format(x, y) for (x, y) in sorted(self.counts().items()))
+
+
+class Provisioner(object):
+  """
+  Bring hosts and their items to a declared state with as few API calls as
+  possible.  The declaration is a list of host.create objects, each with
+  an additional 'items' list of item.create objects (without hostid);
+  hosts are matched by their 'host' name and items by their 'key_'.
+
+  plan() reads the existing hosts and items with a few bulk get calls and
+  works out what differs;  apply() then creates what is missing and
+  updates the fields that differ, in JSON-RPC batches of chunk_size calls
+  with up to workers batches in flight.  Only plain fields are compared;
+  lists and objects such as groups or interfaces are only used on
+  creation.
+
+  The class object supports the following keyword arguments at instantiation;
+    chunk_size    -- (Integer) Calls per batch.  Defaults to the batch_size
+                     of the client.
+
+    workers       -- (Integer) Batches sent at once.  Defaults to 4.
+
+    >>> import zabbix.tools._fakes
+    >>> frontend = zabbix.tools._fakes.FakeFrontend(objects={
+    ...   'host': [{'hostid': '10084', 'host': 'web01', 'status': '0'}],
+    ...   'item': [{'itemid': '23296', 'hostid': '10084', 'key_': 'agent.ping', 'delay': '1m'}],
+    ...   })
+    >>> api = ZabbixAPI(zabbix_url=frontend.start(), zabbix_user='Admin')
+    >>> hosts = [
+    ...   {'host': 'web01', 'status': 1, 'items': [
+    ...     {'key_': 'agent.ping', 'delay': '30s'},
+    ...     {'key_': 'system.uptime', 'delay': '1m'},
+    ...     ]},
+    ...   {'host': 'web02', 'groups': [{'groupid': '2'}], 'items': [
+    ...     {'key_': 'agent.ping', 'delay': '30s'},
+    ...     ]},
+    ...   ]
+    >>> provisioner = Provisioner(api)
+    >>> plan = provisioner.plan(hosts)
+    >>> print(plan)
+    host.create 1, host.unchanged 0, host.update 1, item.create 2, item.unchanged 0, item.update 1
+    >>> report = provisioner.apply(plan)
+    >>> report['host'], report['item'], report['errors']
+    ({'created': 1, 'updated': 1, 'unchanged': 0, 'failed': 0}, {'created': 2, 'updated': 1, 'unchanged': 0, 'failed': 0}, [])
+    >>> print(provisioner.plan(hosts))
+    host.create 0, host.unchanged 2, host.update 0, item.create 0, item.unchanged 3, item.update 0
+    >>> frontend.stop()
+  """
+
+  def __init__(self, api, **kwargs):
+    self.api = api
+    self.chunk_size = int(kwargs.get('chunk_size', api.batch_size))
+    self.workers = int(kwargs.get('workers', 4))
+
+  @staticmethod
+  def __fields(objects, *required):
+    """
+    The plain (not list or object) fields declared on any of objects.
+    """
+    fields = set(required)
+    for obj in objects:
+      fields.update(x for (x, y) in obj.items() if not isinstance(y, (list, dict)))
+    return sorted(fields)
+
+  @staticmethod
+  def __changes(wanted, current, fields):
+    """
+    The declared plain fields whose value differs from the current one;  the
+    API returns every value as a string.
+    """
+    return dict(
+      (x, wanted[x]) for x in fields
+      if x in wanted and u'{0}'.format(wanted[x]) != u'{0}'.format(current.get(x, None))
+      )
+
+  def plan(self, hosts):
+    """
+    Compare the declared hosts and items with the existing ones and return
+    a ProvisionPlan.
+    """
+    hosts = list(hosts)
+    host_fields = self.__fields(
+        [dict((x, y) for (x, y) in host.items() if x != 'items') for host in hosts],
+        'hostid', 'host')
+    names = [x['host'] for x in hosts]
+    existing = {}
+    for result in self.api.batch([
+        ('host.get', {'filter': {'host': names[x:x + self.chunk_size]}, 'output': host_fields})
+        for x in range(0, len(names), self.chunk_size)
+        ]):
+      if result.error is not None:
+        raise result.error
+      existing.update((x['host'], x) for x in result.result)
+
+    plan = ProvisionPlan()
+    for host in hosts:
+      current = existing.get(host['host'], None)
+      wanted = dict((x, y) for (x, y) in host.items() if x != 'items')
+      if current is None:
+        plan.create_hosts.append(wanted)
+        continue
+      plan.hostids[host['host']] = current['hostid']
+      changes = self.__changes(wanted, current, host_fields)
+      if changes:
+        changes['hostid'] = current['hostid']
+        plan.update_hosts.append(changes)
+      else:
+        plan.unchanged['host'] += 1
+
+    item_fields = self.__fields(
+        [item for host in hosts for item in host.get('items', [])],
+        'itemid', 'hostid', 'key_')
+    items = {}
+    if plan.hostids:
+      items = dict(
+        ((x['hostid'], x['key_']), x)
+        for x in self.api.iterate('item.get', {'hostids': list(plan.hostids.values()), 'output': item_fields})
         )
 
-    self.debug(logging.DEBUG,auth_obj)
+    for host in hosts:
+      hostid = plan.hostids.get(host['host'], None)
+      for item in host.get('items', []):
+        current = items.get((hostid, item['key_']), None)
+        if current is None:
+          plan.create_items.append((host['host'], item))
+          continue
+        changes = self.__changes(item, current, item_fields)
+        if changes:
+          changes['itemid'] = current['itemid']
+          plan.update_items.append(changes)
+        else:
+          plan.unchanged['item'] += 1
+    return plan
+
+  def __run(self, method, objects):
+    """
+    Call method once per object, chunk_size calls per batch and up to
+    workers batches at once, and return the BatchResults in order.
+    """
+    chunks = [objects[x:x + self.chunk_size] for x in range(0, len(objects), self.chunk_size)]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+      outcomes = executor.map(
+          lambda chunk: self.api.batch([(method, x) for x in chunk], chunk_size=len(chunk)),
+          chunks
+          )
+      return [x for chunk in outcomes for x in chunk]
+
+  def apply(self, plan):
+    """
+    Make the changes of a plan, and return a report dict:  the hosts and
+    items created, updated, left unchanged and failed, the failed calls as
+    BatchResults in 'errors', the seconds taken and the objects created or
+    updated per second.  Items of hosts that could not be created count as
+    failed.
+    """
+    started = time.time()
+    report = {
+      'host': {'created': 0, 'updated': 0, 'unchanged': plan.unchanged['host'], 'failed': 0},
+      'item': {'created': 0, 'updated': 0, 'unchanged': plan.unchanged['item'], 'failed': 0},
+      'errors': [],
+      }
+
+    def tally(object_type, action, results):
+      for result in results:
+        if result.error is None:
+          report[object_type][action] += 1
+        else:
+          report[object_type]['failed'] += 1
+          report['errors'].append(result)
+
+    hostids = dict(plan.hostids)
+    created = self.__run('host.create', plan.create_hosts)
+    tally('host', 'created', created)
+    for (host, result) in zip(plan.create_hosts, created):
+      if result.error is None:
+        hostids[host['host']] = result.result['hostids'][0]
+    tally('host', 'updated', self.__run('host.update', plan.update_hosts))
+
+    items = [dict(item, hostid=hostids[name]) for (name, item) in plan.create_items if name in hostids]
+    report['item']['failed'] += len(plan.create_items) - len(items)
+    tally('item', 'created', self.__run('item.create', items))
+    tally('item', 'updated', self.__run('item.update', plan.update_items))
+
+    report['seconds'] = time.time() - started
+    applied = sum(report[x]['created'] + report[x]['updated'] for x in ('host', 'item'))
+    report['objects_per_second'] = applied / max(report['seconds'], 1e-6)
+    self.api.debug(logging.INFO, 'provisioned:', '{0} objects in {1:.3f}s ({2:.0f}/s), {3} failed'.format(
+        applied, report['seconds'], report['objects_per_second'], len(report['errors'])))
+    return report
+
+  def provision(self, hosts):
+    """
+    plan() and apply() in one go;  returns the plan and the report.
+    """
+    plan = self.plan(hosts)
+    self.api.debug(logging.INFO, 'plan:', plan)
+    return plan, self.apply(plan)
 
 
 if __name__ == '__main__':
-  foo = ZabbixAPI()
-  foo.login()
+  import doctest
+  doctest.testmod()
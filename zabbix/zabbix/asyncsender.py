@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+An asyncio flavour of the Zabbix sender, able to feed several servers or
+proxies at once from a single event loop.
+"""
+import asyncio
+import logging
+import socket
+import sys
+
+from zabbix import protocol
+from zabbix.sender import Sender, SendSummary
+
+
+class AsyncSender(Sender):
+  """
+  AsyncSender buffers items exactly like Sender does (add_item / add_lld),
+  but send() and send_lld() are coroutines built on asyncio streams.  Every
+  chunk is sent to every target concurrently, so one slow proxy no longer
+  holds up the others.
+
+  On top of the Sender keyword arguments, the class object supports the
+  following keyword arguments at instantiation;
+    zabbix_targets -- (List) As for Sender, but every chunk goes to every
+                     target instead of failing over between them.
+
+    max_in_flight -- (Integer) Maximum number of requests outstanding to a
+                     single target at any time.  Defaults to 4.
+
+    deadline      -- (Number) Seconds a single request, connecting included,
+                     may take before it is abandoned.  Its connection is closed
+                     rather than reused.  Defaults to 10.
+
+  The Sender spool_dir argument is not supported, and raises ValueError.
+
+  Usage example;
+      >>> import asyncio
+      >>> import zabbix.asyncsender
+      >>> monitor = zabbix.asyncsender.AsyncSender(
+      ...   read_config=False,
+      ...   zabbix_host='client1.example.org',
+      ...   zabbix_targets=['proxy1.example.org:10051', 'proxy2.example.org']
+      ...   )
+      >>> monitor.zabbix_targets
+      [('proxy1.example.org', 10051), ('proxy2.example.org', 10051)]
+      >>> monitor.add_item(key='myKey1', value='16535')
+      True
+      >>> asyncio.run(monitor.send()) #doctest: +SKIP
+      [(0, {..., 'target': ('proxy1.example.org', 10051)}), (0, {..., 'target': ('proxy2.example.org', 10051)})]
+
+  Chunks sent to the same target may be processed out of order when
+  max_in_flight is larger than one; every item carries its own clock.
+      >>> zabbix.asyncsender.AsyncSender(read_config=False, spool_dir='/tmp/spool')
+      Traceback (most recent call last):
+      ...
+      ValueError: AsyncSender does not support spool_dir
+  """
+
+  def __init__(self, **kwargs):
+    if kwargs.get('spool_dir', None):
+      raise ValueError('AsyncSender does not support spool_dir')
+    Sender.__init__(self, **kwargs)
+
+    self.max_in_flight = int(kwargs.get('max_in_flight', 4))
+    self.deadline = float(kwargs.get('deadline', 10))
+
+    self.__loop = None
+    self.__idle = {}
+    self.__limits = {}
+
+  def __bind_loop(self):
+    """
+    Streams and semaphores belong to an event loop.  When send() is called
+    from a new loop, whatever was kept for the previous one is dropped.
+    """
+    loop = asyncio.get_running_loop()
+    if loop is not self.__loop:
+      self.__loop = loop
+      self.__idle = {}
+      self.__limits = {}
+    return loop
+
+  def __limit(self, target):
+    if target not in self.__limits:
+      self.__limits[target] = asyncio.Semaphore(self.max_in_flight)
+    return self.__limits[target]
+
+  async def __request(self, target, packet):
+    """
+    Send one packet over an idle or new connection to target and return the
+    raw response.  A reused connection that went away is retried once.
+    """
+    idle = self.__idle.setdefault(target, [])
+    while True:
+      reused = False
+      while idle:
+        (reader, writer) = idle.pop()
+        if reader.at_eof() or writer.is_closing():
+          writer.close()
+          continue
+        reused = True
+        break
+
+      if not reused:
+        (reader, writer) = await asyncio.open_connection(*target)
+
+      try:
+        writer.write(packet)
+        await writer.drain()
+        response = await protocol.read_packet_async(reader)
+      except (socket.error, protocol.ProtocolError):
+        writer.close()
+        if not reused:
+          raise
+        logging.debug('Connection to %s:%s went away, reconnecting', *target)
+        continue
+      except asyncio.CancelledError:
+        # Abandoned half way (deadline), the stream can not be trusted to
+        # be at a packet boundary any more.
+        writer.close()
+        raise
+
+      idle.append((reader, writer))
+      return response
+
+  async def __send_one(self, target, packet):
+    """
+    The asyncio equivalent of Sender.__send(), bounded by max_in_flight and
+    the per request deadline.
+    """
+    async with self.__limit(target):
+      try:
+        response_raw = await asyncio.wait_for(
+            self.__request(target, packet),
+            self.deadline
+            )
+      except asyncio.TimeoutError:
+        err_message = u'Deadline of {0}s exceeded talking to {1}:{2}\n'.format(
+            self.deadline,
+            *target
+            )
+        sys.stderr.write(err_message)
+        return 254, err_message
+      except protocol.ProtocolError:
+        err_message = u'Invalid response from server. Malformed data?\n---\n{0}\n---\n'.format(
+            self._printable(packet)
+            )
+        return 253, err_message
+      except socket.error as err:
+        err_message = u'Error talking to server {0}:{1}: {2}\n'.format(
+            target[0],
+            target[1],
+            err
+            )
+        sys.stderr.write(err_message)
+        return 255, err_message
+
+    return self._parse_response(packet, response_raw)
+
+  async def __send_target(self, target, chunks, item_count):
+    summary = SendSummary(item_count)
+    results = await asyncio.gather(
+        *[self.__send_one(target, packet) for (packet, _) in chunks]
+        )
+    for (result, (_, chunk_size)) in zip(results, chunks):
+      summary.add(result, chunk_size)
+
+    (retcode, response) = summary.result()
+    response['target'] = target
+    return retcode, response
+
+  async def __fan_out(self, items, **kwargs):
+    """
+    Chunk the items once, then send every chunk to every target at once.
+    Returns one combined (retcode, response) tuple per target.  The packets
+    are in flight concurrently, so each one is copied out of the encoder.
+    """
+    self.__bind_loop()
+    chunks = [
+      (bytes(packet), count)
+      for (count, packet, _) in self._iter_packets(items, **kwargs)
+      ]
+    return list(await asyncio.gather(
+        *[self.__send_target(x, chunks, len(items)) for x in self.zabbix_targets]
+        ))
+
+  async def send(self, **kwargs):
+    """
+    Send the buffered items to every target.  Accepts the same chunking
+    arguments as Sender.send(); 'print_values' prints instead of sending.
+    """
+    if kwargs.get('print_values', False):
+      return Sender.send(self, print_values=True)
+
+    return await self.__fan_out(self.__list_item__, **kwargs)
+
+  async def send_lld(self, **kwargs):
+    """
+    Send the LLD data to every target, see Sender.send_lld().
+    """
+    if kwargs.get('print_values', False):
+      return Sender.send_lld(self, print_values=True)
+
+    return await self.__fan_out(list(self._lld_items()), **kwargs)
+
+  async def close(self):
+    """
+    Close every idle connection.
+    """
+    idle = self.__idle
+    self.__idle = {}
+    for connections in idle.values():
+      for (reader, writer) in connections:
+        writer.close()
+        try:
+          await writer.wait_closed()
+        except socket.error:
+          pass
+
+
+if __name__ == '__main__':
+  import doctest
+  doctest.testmod()
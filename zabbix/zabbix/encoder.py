@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Incremental encoder for 'sender data' packets.
+
+Building a dict around every item, json.dumps()'ing it and then gluing the
+protocol header in front of the result keeps several copies of a batch in
+memory at once.  PacketEncoder instead writes every item straight into one
+reusable bytearray, right behind room reserved for the protocol header, and
+fills the header in place once the packet is complete.  The finished packet
+is handed out as a memoryview, so it can go to socket.sendall() without
+being copied again.
+
+    >>> import zabbix.encoder
+    >>> encoder = zabbix.encoder.PacketEncoder()
+    >>> encoder.add({'host': 'client1.example.org', 'key': 'myKey1', 'value': '16535'})
+    >>> encoder.count
+    1
+    >>> packet = encoder.finish(clock=499162920)
+    >>> bytes(packet[:5])
+    b'ZBXD\\x01'
+    >>> bytes(encoder.payload())
+    b'{"request": "sender data", "data": [{"host": "client1.example.org", "key": "myKey1", "value": "16535"}], "clock": 499162920}'
+    >>> encoder.reset()
+    >>> encoder.count
+    0
+"""
+import json
+import zlib
+
+from zabbix import protocol
+
+
+class PacketEncoder(object):
+  """
+  The class object supports the following keyword arguments at instantiation;
+    request       -- (String) The request type written in the packet.
+                     Defaults to 'sender data'.
+
+    initial_size  -- (Integer) Initial size of the buffer, it grows as needed
+                     and is kept at its largest size for the next packet.
+                     Defaults to 65536.
+
+  A packet is built with reset(), any number of add() / add_encoded() calls
+  and finish().  The views returned by finish() and payload() are only valid
+  until the next reset().
+  """
+
+  def __init__(self, **kwargs):
+    self.__prefix = u'{{"request": {0}, "data": ['.format(
+        json.dumps(kwargs.get('request', 'sender data'))
+        ).encode('utf-8')
+    self.__buffer = bytearray(int(kwargs.get('initial_size', 65536)))
+    self.__views = []
+    self.__length = 0
+    self.__payload_end = 0
+    self.count = 0
+    self.reset()
+
+  def __write(self, data):
+    end = self.__length + len(data)
+    if end > len(self.__buffer):
+      # Grow by an eighth, like list does, so a large packet does not end up
+      # in a buffer twice its size.
+      self.__buffer.extend(bytes(max(end - len(self.__buffer), len(self.__buffer) >> 3)))
+    self.__buffer[self.__length:end] = data
+    self.__length = end
+
+  def __view(self, start, end):
+    with memoryview(self.__buffer) as view:
+      retval = view[start:end]
+    self.__views.append(retval)
+    return retval
+
+  def reset(self):
+    """
+    Start a new packet, reusing the buffer.  Every view handed out for the
+    previous packet is released.
+    """
+    for view in self.__views:
+      view.release()
+    self.__views = []
+    self.__length = protocol.ZBX_HEADER_LEN
+    self.__payload_end = 0
+    self.count = 0
+    self.__write(self.__prefix)
+
+  @property
+  def size(self):
+    """
+    Size, in bytes, of the packet if it was finished now.
+    """
+    return self.__length + 32
+
+  def add_encoded(self, encoded):
+    """
+    Append one item that is already JSON encoded (bytes).
+    """
+    self.__write(b', ' + encoded if self.count else encoded)
+    self.count += 1
+
+  def add(self, item):
+    """
+    JSON encode one item (dict) and append it.
+    """
+    self.add_encoded(json.dumps(item).encode('utf-8'))
+
+  def finish(self, **kwargs):
+    """
+    Close the packet and return it, header included, as a memoryview.  When
+    compress_threshold is given and the payload is at least that large, a
+    compressed packet (bytes) is returned instead.  'clock' and 'ns' are
+    written as the request clock when given.
+    """
+    clock = kwargs.get('clock', None)
+    ns = kwargs.get('ns', None)
+    if clock is None:
+      self.__write(b']}')
+    elif ns is None:
+      self.__write(u'], "clock": {0}}}'.format(json.dumps(clock)).encode('utf-8'))
+    else:
+      self.__write(u'], "clock": {0}, "ns": {1}}}'.format(
+          json.dumps(clock),
+          json.dumps(ns)
+          ).encode('utf-8'))
+    self.__payload_end = self.__length
+
+    payload_length = self.__length - protocol.ZBX_HEADER_LEN
+    compress_threshold = kwargs.get('compress_threshold', None)
+    if compress_threshold is not None and payload_length >= compress_threshold:
+      compressed = zlib.compress(self.payload(), protocol.ZBX_COMPRESS_LEVEL)
+      return protocol.ZBX_HEADER.pack(
+          protocol.ZBX_SIGNATURE,
+          protocol.ZBX_FLAG_STANDARD | protocol.ZBX_FLAG_COMPRESS,
+          len(compressed),
+          payload_length
+          ) + compressed
+
+    protocol.ZBX_HEADER.pack_into(
+        self.__buffer,
+        0,
+        protocol.ZBX_SIGNATURE,
+        protocol.ZBX_FLAG_STANDARD,
+        payload_length,
+        0
+        )
+    return self.__view(0, self.__length)
+
+  def payload(self):
+    """
+    The JSON payload of the finished packet, without the header.
+    """
+    return self.__view(protocol.ZBX_HEADER_LEN, self.__payload_end)
+
+
+if __name__ == '__main__':
+  import doctest
+  doctest.testmod()
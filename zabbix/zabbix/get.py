@@ -2,37 +2,230 @@
 # -*- coding: utf-8 -*-
 """
 Simple lib to connect to a Zabbix agent and request the value of an item.
+
+query_agent() asks a single agent for a single item.  poll_agents() asks
+many agents for many items at once, and streams the results back as they
+come in;
+    >>> import zabbix.get
+    >>> for result in zabbix.get.poll_agents(
+    ...     ['agent1.example.org', '[2001:db8::1]:10050'],
+    ...     keys=['agent.ping', 'system.uptime'],
+    ...     timeout=3
+    ...     ): #doctest: +SKIP
+    ...   print(result.host, result.key, result.value, result.error)
+    agent1.example.org agent.ping 1 None
+    2001:db8::1 agent.ping None Timeout after 3s
+    ...
 """
+import asyncio
+import collections
+import queue
+import re
 import socket
+import threading
+import time
+
+from zabbix import protocol
+from zabbix.getagentconfig import parse_targets
+
+ZBX_NOTSUPPORTED = b'ZBX_NOTSUPPORTED'
+ZBX_ERROR = b'ZBX_ERROR'
+
+# The only replies typed_value() turns into numbers;  int() and float()
+# alone also take '1_000', ' 12 ', 'nan' or 'Infinity'.
+INTEGER = re.compile(r'[+-]?[0-9]+')
+FLOAT = re.compile(r'[+-]?(?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:[eE][+-]?[0-9]+)?')
+
+AgentResult = collections.namedtuple(
+    'AgentResult',
+    ('host', 'port', 'key', 'value', 'error', 'elapsed')
+    )
+AgentResult.__doc__ = """
+The outcome of one item request;  value is None when the request failed, and
+error then says why.  elapsed is the time the request took, in seconds.
+"""
+
+
+def typed_value(value):
+  """
+  Convert the text an agent answered with to an int or a float when it is a
+  plain decimal number, and leave it as a str otherwise.  Integers are kept
+  as int, as unsigned 64 bit counters do not fit a float.
+
+    >>> typed_value('1'), typed_value('-0.25'), typed_value('1e3'), typed_value('Linux 6.1')
+    (1, -0.25, 1000.0, 'Linux 6.1')
+    >>> typed_value('1_000'), typed_value(' 12 '), typed_value('nan'), typed_value('inf'), typed_value('Infinity')
+    ('1_000', ' 12 ', 'nan', 'inf', 'Infinity')
+  """
+  if INTEGER.fullmatch(value):
+    return int(value)
+  if FLOAT.fullmatch(value):
+    return float(value)
+  return value
+
+
+def parse_response(payload):
+  """
+  Split the payload of an agent response into a (value, error) tuple.
+
+    >>> parse_response(b'16535')
+    (16535, None)
+    >>> parse_response(b'ZBX_NOTSUPPORTED\\x00Unsupported item key.')
+    (None, 'ZBX_NOTSUPPORTED: Unsupported item key.')
+  """
+  (value, _, reason) = payload.partition(b'\x00')
+  if value in (ZBX_NOTSUPPORTED, ZBX_ERROR):
+    error = value.decode('ascii')
+    if reason:
+      error = u'{0}: {1}'.format(error, reason.rstrip(b'\x00').decode('utf-8', 'replace'))
+    return None, error
+  return typed_value(payload.decode('utf-8', 'replace').rstrip('\n')), None
 
 
 def query_agent(**kwargs):
   """
-  Open a socket to port 10050 on the remote server and query for the number of
-  processes running via proc.num[<FOO>], where FOO is either zabbix_server or
-  zabbix_proxy.
+  Open a socket to the Zabbix agent (port 10050 by default) and ask for the
+  value of a single item, agent.ping unless told otherwise.  Requests and
+  responses are framed with the Zabbix protocol header.
+
+  Returns a (retcode, value) tuple;
+      0     -- value holds the item value, see typed_value.
+      1     -- The agent does not support the item; value is the reason.
+      99999 -- The agent could not be reached; value is the error.
   """
   query_string = kwargs.get('query_string', 'agent.ping')
 
   query_host = kwargs.get('query_host', '127.0.0.1')
-  query_port = kwargs.get('query_port', '10050')
+  query_port = int(kwargs.get('query_port', '10050'))
+  timeout = kwargs.get('timeout', 3)
+
+  try:
+    connection = socket.create_connection((query_host, query_port), timeout=timeout)
+  except socket.error as e:
+    return (99999, 'ERROR: {} :: {}:{}'.format(e, query_host, query_port))
 
   try:
-    connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    connection.connect((query_host, query_port))
-  except:
+    connection.sendall(protocol.pack(query_string))
+    payload = protocol.read_packet(connection)
+  except (socket.error, protocol.ProtocolError) as e:
     return (99999, 'ERROR: {} :: {}:{}'.format(e, query_host, query_port))
-  else:
-    connection.send(query_string)
-    result = connection.recv(8192)
+  finally:
     connection.close()
 
-    retval = ''.join(x for x in result if x.isdigit())
-    return (0, retval)
-  return (0 ,'')
+  (value, error) = parse_response(payload)
+  if error is not None:
+    return (1, error)
+  return (0, value)
+
+
+async def query_agent_async(host, port, key, timeout=3):
+  """
+  The asyncio flavour of query_agent(), returning an AgentResult.  timeout
+  bounds the whole request, connecting included.
+  """
+  started = time.time()
+
+  async def request():
+    (reader, writer) = await asyncio.open_connection(host, port)
+    try:
+      writer.write(protocol.pack(key))
+      await writer.drain()
+      return await protocol.read_packet_async(reader)
+    finally:
+      writer.close()
+
+  try:
+    payload = await asyncio.wait_for(request(), timeout)
+  except asyncio.TimeoutError:
+    return AgentResult(host, port, key, None, u'Timeout after {0}s'.format(timeout), time.time() - started)
+  except (socket.error, protocol.ProtocolError) as err:
+    return AgentResult(host, port, key, None, u'{0}'.format(err), time.time() - started)
+
+  (value, error) = parse_response(payload)
+  return AgentResult(host, port, key, value, error, time.time() - started)
+
+
+async def poll_agents_async(hosts, keys=('agent.ping',), **kwargs):
+  """
+  Asynchronous generator yielding an AgentResult for every key of every
+  host, in the order they complete.  See poll_agents for the arguments.
+  """
+  max_in_flight = int(kwargs.get('max_in_flight', 1000))
+  timeout = kwargs.get('timeout', 3)
+  limit = asyncio.Semaphore(max_in_flight)
+
+  async def bounded(host, port, key):
+    async with limit:
+      return await query_agent_async(host, port, key, timeout)
+
+  requests = [
+    asyncio.ensure_future(bounded(host, port, key))
+    for (host, port) in parse_targets(list(hosts), kwargs.get('port', 10050))
+    for key in keys
+    ]
+  try:
+    for request in asyncio.as_completed(requests):
+      yield await request
+  finally:
+    for request in requests:
+      request.cancel()
+
+
+def poll_agents(hosts, keys=('agent.ping',), **kwargs):
+  """
+  Ask every host for every key, with up to max_in_flight requests running at
+  once, and yield an AgentResult for each as soon as it is known.  The
+  requests run on an event loop in a thread of their own, so a slow consumer
+  does not hold them up.
+
+  The function supports the following keyword arguments;
+    hosts         -- (List) Agents, as (host, port) tuples or 'host[:port]'
+                     strings (IPv6 addresses in square brackets).
+                     ** REQUIRED **
+
+    keys          -- (List) Item keys to ask every agent for.  Defaults to
+                     agent.ping only.
+
+    port          -- (Integer) Port of the agents that were given without
+                     one.  Defaults to 10050.
+
+    timeout       -- (Number) Seconds a single request, connecting included,
+                     may take.  Defaults to 3.
+
+    max_in_flight -- (Integer) Maximum number of requests running at once.
+                     Mind the open files limit.  Defaults to 1000.
+  """
+  results = queue.Queue()
+  stop = threading.Event()
+
+  def run():
+    async def collect():
+      async for result in poll_agents_async(hosts, keys, **kwargs):
+        results.put(result)
+        if stop.is_set():
+          break
+
+    try:
+      asyncio.run(collect())
+    except Exception as err:
+      results.put(err)
+    results.put(None)
+
+  thread = threading.Thread(target=run)
+  thread.daemon = True
+  thread.start()
+  try:
+    while True:
+      result = results.get()
+      if result is None:
+        break
+      if isinstance(result, Exception):
+        raise result
+      yield result
+  finally:
+    stop.set()
 
 
 if __name__ == '__main__':
   import doctest
   doctest.testmod()
-
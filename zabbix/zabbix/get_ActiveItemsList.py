@@ -3,11 +3,54 @@
 """
 This is a tool created to help troubleshoot some LLD issues with the MySQL
 version of the Zabbix proxy.
+
+ActiveChecks asks the server for the active checks of a host, the same way a
+Zabbix agent (active) does, and caches the answer per host.  A cached answer
+is reused until the refresh interval has passed, and is then revalidated with
+its config_revision, so an unchanged list of checks is not sent again;
+    >>> import tempfile
+    >>> import zabbix.get_ActiveItemsList
+    >>> import zabbix.tools._fakes
+    >>> server = zabbix.tools._fakes.FakeTrapper(active_checks={
+    ...   'client1.example.org': [{'key': 'agent.ping', 'delay': '1m', 'lastlogsize': 0, 'mtime': 0}],
+    ...   'client2.example.org': [],
+    ...   })
+    >>> (host, port) = server.start()
+    >>> checks = zabbix.get_ActiveItemsList.ActiveChecks(
+    ...   read_config=False,
+    ...   zabbix_serv=host,
+    ...   zabbix_port=port,
+    ...   cache_dir=tempfile.mkdtemp()
+    ...   )
+    >>> checks.get('client1.example.org')['data']
+    [{'key': 'agent.ping', 'delay': '1m', 'lastlogsize': 0, 'mtime': 0}]
+    >>> checks.get('client1.example.org')['config_revision']
+    1
+    >>> result = checks.get_many(['client1.example.org', 'client2.example.org', 'client3.example.org'])
+    >>> [len(result[x]['data']) for x in ('client1.example.org', 'client2.example.org')]
+    [1, 0]
+    >>> result['client3.example.org']
+    ActiveChecksError('host [client3.example.org] not found')
+    >>> checks.stats() == {'hits': 2, 'misses': 3, 'requests': 3, 'not_modified': 0, 'errors': 1}
+    True
+    >>> checks.get('client1.example.org', force=True)['data'][0]['key']
+    'agent.ping'
+    >>> checks.stats()['not_modified']
+    1
+    >>> server.stop()
 """
+import concurrent.futures
+import json
+import os
 import socket
 import sys
+import threading
 import time
-import zabbix
+import urllib.parse
+
+from zabbix import protocol
+from zabbix import transport
+from zabbix.getagentconfig import GetAgentConfig, parse_targets
 
 ZBX_HOST_NOTFOUND = 'Host does not exist in Zabbix.'
 ZBX_HOST_NOACTIVE = 'Host does not have any Zabbix agent (active) checks.'
@@ -15,53 +58,293 @@ ZBX_HOST_REGISTER = 'Host has been registered.'
 ZBX_HOST_DIDEXIST = 'Host already exists.'
 ZBX_HOST_UNKNOWN  = 'Unable to determine if the host is registerd or not.'
 
+ZBX_REFRESH_ACTIVE = 120
+
+CACHE_SUFFIX = '.json'
+
+
+class ActiveChecksError(Exception):
+  """
+  The server did not return the active checks of a host, e.g. because it
+  does not know the host.  The message is the server's 'info'.
+  """
+  pass
+
+
 def main():
-  print get_ActiveItemList()
+  print(get_ActiveItemList())
   return 0
 
 
+class ActiveChecks(object):
+  """
+  A caching client for the 'active checks' request of the Zabbix server /
+  proxy.  Entries are dicts holding the host, the 'data' list of checks
+  (key, delay, lastlogsize, mtime), 'regexp', 'config_revision', the time
+  they were 'fetched' and the 'refresh' interval they are valid for.
+
+  The servers to ask are read from the Zabbix agent configuration, or from
+  the zabbix_serv / zabbix_port / zabbix_targets keyword arguments as for
+  Sender; the others are only tried when the first can not be reached.  The
+  class object supports the following additional keyword arguments at
+  instantiation;
+    cache_dir     -- (String) Directory to keep a JSON file per host in, so
+                     the cache outlives the process.  Defaults to None
+                     (memory only).
+
+    refresh_active -- (Number) Seconds a cached answer is used before it is
+                     revalidated, unless the server announces its own
+                     refresh_active.  Defaults to RefreshActiveChecks from
+                     the agent configuration, or 120.
+
+    host_metadata -- (String) Sent along with every request, for the server
+                     to match auto-registration actions on.  Defaults to
+                     HostMetadata from the agent configuration.
+
+    max_workers   -- (Integer) Number of parallel connections get_many()
+                     uses.  Defaults to 16.
+
+    timeout       -- (Number) Socket timeout in seconds.  Defaults to 5.
+
+  A host the server does not know is never cached, as it may be
+  registered any moment.
+  """
+
+  def __init__(self, **kwargs):
+    config = GetAgentConfig(**kwargs)
+    agent_conf = config['zabbix_conf'] or {}
+
+    self.zabbix_serv = kwargs.get('zabbix_serv', config['zabbix_serv'])
+    self.zabbix_port = int(kwargs.get('zabbix_port', config['zabbix_port']))
+    self.zabbix_targets = [(self.zabbix_serv, self.zabbix_port)] + [
+      x for x in parse_targets(
+          kwargs.get('zabbix_targets', config['zabbix_targets']),
+          self.zabbix_port
+          )[1:]
+      if x != (self.zabbix_serv, self.zabbix_port)
+      ]
+    self.cache_dir = kwargs.get('cache_dir', None)
+    self.refresh_active = float(kwargs.get(
+        'refresh_active',
+        agent_conf.get('RefreshActiveChecks', ZBX_REFRESH_ACTIVE)
+        ))
+    self.host_metadata = kwargs.get('host_metadata', agent_conf.get('HostMetadata', None))
+    self.max_workers = int(kwargs.get('max_workers', 16))
+    self.targets = transport.TargetSet(
+        self.zabbix_targets,
+        timeout=kwargs.get('timeout', 5)
+        )
+
+    if self.cache_dir is not None and not os.path.isdir(self.cache_dir):
+      os.makedirs(self.cache_dir)
+
+    self.__lock = threading.Lock()
+    self.__cache = {}
+    self.__stats = {
+      'hits': 0,
+      'misses': 0,
+      'requests': 0,
+      'not_modified': 0,
+      'errors': 0,
+      }
+
+  def __count(self, counter):
+    with self.__lock:
+      self.__stats[counter] += 1
+
+  def __path(self, host):
+    return os.path.join(
+        self.cache_dir,
+        urllib.parse.quote(host, safe='') + CACHE_SUFFIX
+        )
+
+  def __load(self, host):
+    """
+    The cached entry of a host, from memory or else from cache_dir.
+    """
+    with self.__lock:
+      entry = self.__cache.get(host, None)
+    if entry is not None or self.cache_dir is None:
+      return entry
+
+    try:
+      with open(self.__path(host), 'r') as f:
+        entry = json.load(f)
+    except (IOError, OSError, ValueError):
+      return None
+    with self.__lock:
+      self.__cache.setdefault(host, entry)
+    return entry
+
+  def __store(self, host, entry):
+    with self.__lock:
+      self.__cache[host] = entry
+    if self.cache_dir is None:
+      return
+
+    path = self.__path(host)
+    temp_path = '{0}.{1}.tmp'.format(path, threading.get_ident())
+    with open(temp_path, 'w') as f:
+      json.dump(entry, f)
+    os.rename(temp_path, path)
+
+  def __request(self, host, revision=None):
+    """
+    Ask the server for the active checks of host, and return the decoded
+    response.
+    """
+    request = {'request': 'active checks', 'host': host}
+    if self.host_metadata:
+      request['host_metadata'] = self.host_metadata
+    if revision is not None:
+      request['config_revision'] = revision
+
+    self.__count('requests')
+    (target, response) = self.targets.request(protocol.pack(json.dumps(request)))
+    return json.loads(response.decode('utf-8'))
+
+  def get(self, host, force=False):
+    """
+    Return the cache entry of host, asking the server when there is none or
+    it is due for a refresh (or force is set).  Raises ActiveChecksError
+    when the server refuses, and socket.error / ProtocolError when it can
+    not be reached.
+    """
+    now = time.time()
+    entry = self.__load(host)
+    if entry is not None and not force and now < entry['fetched'] + entry['refresh']:
+      self.__count('hits')
+      return entry
+
+    self.__count('misses')
+    revision = entry['config_revision'] if entry is not None else None
+    try:
+      response = self.__request(host, revision)
+    except (socket.error, protocol.ProtocolError):
+      self.__count('errors')
+      raise
+
+    if response.get('response') != 'success':
+      self.__count('errors')
+      raise ActiveChecksError(response.get('info', 'No active checks for host [{0}]'.format(host)))
+
+    if 'data' not in response and entry is not None:
+      self.__count('not_modified')
+      (data, regexp) = (entry['data'], entry['regexp'])
+    else:
+      (data, regexp) = (response.get('data', []), response.get('regexp', []))
+
+    entry = {
+      'host': host,
+      'data': data,
+      'regexp': regexp,
+      'config_revision': response.get('config_revision', None),
+      'fetched': now,
+      'refresh': float(response.get('refresh_active', self.refresh_active)),
+      }
+    self.__store(host, entry)
+    return entry
+
+  def get_many(self, hosts, force=False):
+    """
+    get() the entries of many hosts, over up to max_workers connections at
+    once.  Returns a dict mapping every host to its entry, or to the
+    exception raised for it.
+    """
+    def get_one(host):
+      try:
+        return self.get(host, force)
+      except (ActiveChecksError, socket.error, protocol.ProtocolError) as err:
+        return err
+
+    hosts = list(hosts)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+      return dict(zip(hosts, executor.map(get_one, hosts)))
+
+  def invalidate(self, host=None):
+    """
+    Forget the cached entry of host, or of every host.
+    """
+    with self.__lock:
+      if host is None:
+        hosts = list(self.__cache)
+        self.__cache.clear()
+      else:
+        hosts = [host]
+        self.__cache.pop(host, None)
+    if self.cache_dir is None:
+      return
+    if host is None:
+      hosts = [
+        urllib.parse.unquote(x[:-len(CACHE_SUFFIX)])
+        for x in os.listdir(self.cache_dir) if x.endswith(CACHE_SUFFIX)
+        ]
+    for name in hosts:
+      try:
+        os.unlink(self.__path(name))
+      except OSError:
+        pass
+
+  def stats(self):
+    """
+    Return the cache counters as a dict.
+    """
+    with self.__lock:
+      return dict(self.__stats)
+
+
 def get_ActiveItemList(**kwargs):
-  def zbx_ask_question(connection, question):
-    connection.send(zbxQuestion)
-    retval = connection.recv(8192)
-    return (len(retval), retval)
+  """
+  Return the active checks of the agent's host as [key, delay, lastlogsize]
+  lists, or one of the ZBX_HOST_* messages.  With auto_register set, the
+  request is repeated up to run_count times, run_delay seconds apart, until
+  the server knows the host, and the outcome of the registration is
+  returned instead.
+
+  Additionally to the ActiveChecks keyword arguments, the function supports
+  the following keyword arguments;
+    checks        -- (ActiveChecks) The client to use, so its cache is shared
+                     between calls.  Defaults to a new one.
 
-  zbxConfig = zabbix.get_AgentConfig(**kwargs)
+    force         -- (Boolean) Ask the server even when the cached answer is
+                     still valid.  Defaults to False.
+  """
+  checks = kwargs.get('checks', None) or ActiveChecks(**kwargs)
+  host = kwargs.get('zabbix_host', GetAgentConfig(**kwargs)['zabbix_host'])
   if kwargs.get('auto_register', False):
     run_count = int(kwargs.get('run_count', 0))
-    run_delay = int(kwargs.get('run_delay', 1))
+    run_delay = float(kwargs.get('run_delay', 1))
   else:
     run_count = 0
     run_delay = 1
 
-  count = 0
-  size = 0
-  zbxQuestion = 'ZBX_GET_ACTIVE_CHECKS\n{0}\n'.format(zbxConfig.zabbix_host)
-  zbxClient = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-  while size == 0:
-    count += 1
-    zbxClient.connect((zbxConfig.zabbix_serv, int(zbxConfig.zabbix_port)))
-    (size, content) = zbx_ask_question(zbxClient,zbxQuestion)
-    zbxClient.close()
-    if count > run_count:
-        break
-    time.sleep(1)
-
-  if size == 0:
+  entry = None
+  for count in range(run_count + 1):
+    if count:
+      time.sleep(run_delay)
+    try:
+      entry = checks.get(host, kwargs.get('force', False))
+      break
+    except ActiveChecksError:
+      continue
+    except (socket.error, protocol.ProtocolError):
+      if kwargs.get('auto_register', False):
+        return ZBX_HOST_UNKNOWN
+      raise
+
+  if entry is None:
     return ZBX_HOST_NOTFOUND
 
   if kwargs.get('auto_register', False):
-    if size > 8:
-      return ZBX_HOST_DIDEXIST
-    elif size == 8:
-      return ZBX_HOST_REGISTER
-    else:
-      return ZBX_HOST_UNKNOWN
+    return ZBX_HOST_DIDEXIST if entry['data'] else ZBX_HOST_REGISTER
 
-  if size == 8:
+  if not entry['data']:
     return ZBX_HOST_NOACTIVE
 
-  return [x.rsplit(':',2) for x in content.split('\n') if x != 'ZBX_EOF' and len(x) > 1]
+  return [
+    [x['key'], u'{0}'.format(x.get('delay', '')), u'{0}'.format(x.get('lastlogsize', 0))]
+    for x in entry['data']
+    ]
 
 
 if __name__ == '__main__':
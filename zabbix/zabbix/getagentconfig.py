@@ -1,10 +1,220 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+"""
+Read the Zabbix agent configuration.
+
+Configuration files are parsed once per process and cached.  Every later
+read only stat()s the files involved, and parses them again when the inode,
+mtime or size of any of them (or of a directory an Include scans) changed;
+    >>> import os
+    >>> import tempfile
+    >>> import zabbix.getagentconfig
+    >>> conf_dir = tempfile.mkdtemp()
+    >>> os.mkdir(os.path.join(conf_dir, 'zabbix_agentd.d'))
+    >>> with open(os.path.join(conf_dir, 'zabbix_agentd.conf'), 'w') as f:
+    ...   _ = f.write('Hostname=client1.example.org\\nInclude=zabbix_agentd.d/*.conf\\n')
+    >>> with open(os.path.join(conf_dir, 'zabbix_agentd.d', 'ping.conf'), 'w') as f:
+    ...   _ = f.write('# Ping\\nUserParameter=ping,echo 1\\n')
+    >>> conf = zabbix.getagentconfig.read_agent_config(os.path.join(conf_dir, 'zabbix_agentd.conf'))
+    >>> conf['Hostname'], conf['UserParameter']
+    ('client1.example.org', ['ping,echo 1'])
+    >>> with open(os.path.join(conf_dir, 'zabbix_agentd.d', 'pong.conf'), 'w') as f:
+    ...   _ = f.write('UserParameter=pong,echo 0 # not a comment\\n')
+    >>> zabbix.getagentconfig.read_agent_config(os.path.join(conf_dir, 'zabbix_agentd.conf'))['UserParameter']
+    ['ping,echo 1', 'pong,echo 0 # not a comment']
+
+Long running daemons that would rather not stat() the files on every read
+can pass validate=False, and call reload() (also available as
+GetAgentConfig.reload) when they are told to, e.g. on SIGHUP.
+"""
+import glob
+import logging
+import os
+import threading
 
 import zabbix
-import zabbix.tools
 from zabbix.tools import parse_file
 
+# Keys the agent accepts more than once.  Their values are kept as lists, in
+# the order they were read;  for every other key, the last value wins.
+MULTI_VALUED_KEYS = frozenset((
+  'Alias',
+  'AllowKey',
+  'DenyKey',
+  'Include',
+  'LoadModule',
+  'PerfCounter',
+  'PerfCounterEn',
+  'UserParameter',
+  ))
+
+# Include directives nested deeper than this are ignored, as the agent does.
+MAX_INCLUDE_DEPTH = 10
+
+# The agent only knows whole line '#' comments;  a '#' further on in a line,
+# as in many UserParameter commands, is part of the value.
+COMMENT_CHARS = b'#'
+
+__config_cache = {}
+__config_lock = threading.Lock()
+
+
+def parse_targets(entries, default_port=None):
+  """
+  Turn the value of a Server / ServerActive entry into a list of (host,
+  port) tuples.  Entries are separated by commas, and the nodes of a Zabbix
+  HA cluster within an entry by semicolons.  IPv6 addresses with a port
+  must be enclosed in square brackets, as Zabbix requires.  Lists of such
+  strings, or of (host, port) tuples, are accepted as well.
+
+    >>> parse_targets('zabbix1.example.org,zabbix2.example.org:10052')
+    [('zabbix1.example.org', 10051), ('zabbix2.example.org', 10052)]
+    >>> parse_targets('[2001:db8::1]:10053;[2001:db8::2],::1')
+    [('2001:db8::1', 10053), ('2001:db8::2', 10051), ('::1', 10051)]
+    >>> parse_targets([('127.0.0.1', '10055'), 'localhost'], 10050)
+    [('127.0.0.1', 10055), ('localhost', 10050)]
+  """
+  if default_port is None:
+    default_port = zabbix.__zabbix_serv_port__
+
+  if isinstance(entries, (tuple, list)):
+    retval = []
+    for entry in entries:
+      if isinstance(entry, (tuple, list)):
+        retval.append((entry[0], int(entry[1])))
+      else:
+        retval.extend(parse_targets(entry, default_port))
+    return retval
+
+  retval = []
+  for entry in entries.replace(';', ',').split(','):
+    entry = entry.strip()
+    if not entry:
+      continue
+
+    if entry.startswith('['):
+      (host, _, port) = entry[1:].partition(']')
+      port = port.lstrip(':')
+    elif entry.count(':') == 1:
+      (host, port) = entry.split(':')
+    else:
+      (host, port) = (entry, '')
+
+    retval.append((host, int(port) if port else int(default_port)))
+  return retval
+
+
+def __stat_key(path):
+  """
+  What a file or directory is compared on to tell whether it changed.
+  """
+  try:
+    stat = os.stat(path)
+  except OSError:
+    return None
+  return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+def __include_paths(pattern, base_dir):
+  """
+  The files an Include value stands for, and the directory that was scanned
+  for them.  Relative paths are taken relative to the including file.
+  """
+  pattern = os.path.join(base_dir, pattern)
+  if os.path.isdir(pattern):
+    return (
+        sorted(
+          os.path.join(pattern, x) for x in os.listdir(pattern)
+          if os.path.isfile(os.path.join(pattern, x))
+          ),
+        pattern
+        )
+  if glob.has_magic(pattern):
+    return sorted(x for x in glob.glob(pattern) if os.path.isfile(x)), os.path.dirname(pattern)
+  return [pattern], None
+
+
+def __parse_config(filename, conf, watched, depth=0):
+  """
+  Parse one configuration file into conf, following its Include directives,
+  and record every file and directory read in watched.  Lines are matched
+  by zabbix.tools.parse_file.iter_kvp, with COMMENT_CHARS and no inline
+  comments.
+  """
+  watched[filename] = __stat_key(filename)
+  try:
+    with open(filename, 'rb') as f:
+      settings = list(parse_file.iter_kvp(
+          f,
+          comment_chars=COMMENT_CHARS,
+          inline_comments=False
+          ))
+  except (IOError, OSError):
+    return conf
+
+  for (option, value) in settings:
+    (option, value) = (option.decode('utf-8', 'replace'), value.decode('utf-8', 'replace'))
+
+    if option not in MULTI_VALUED_KEYS:
+      conf[option] = value
+      continue
+    conf.setdefault(option, []).append(value)
+
+    if option == 'Include':
+      if depth >= MAX_INCLUDE_DEPTH:
+        logging.warning('Include nested too deep, ignoring %s in %s', value, filename)
+        continue
+      (paths, scanned) = __include_paths(value, os.path.dirname(filename))
+      if scanned is not None:
+        watched[scanned] = __stat_key(scanned)
+      for path in paths:
+        path = os.path.normpath(path)
+        if path in watched:
+          logging.warning('Ignoring repeated Include of %s in %s', path, filename)
+          continue
+        __parse_config(path, conf, watched, depth + 1)
+  return conf
+
+
+def read_agent_config(filename, validate=True):
+  """
+  Return the agent configuration file as a dict, Include directives
+  resolved and MULTI_VALUED_KEYS as lists.  A missing or unreadable file
+  reads as empty.  The result comes from the process wide cache when none of
+  the files it was read from changed since, or when validate is False.
+  """
+  filename = os.path.normpath(os.path.abspath(filename))
+  with __config_lock:
+    cached = __config_cache.get(filename, None)
+
+  if cached is not None and validate:
+    if any(__stat_key(x) != key for (x, key) in cached[1].items()):
+      cached = None
+
+  if cached is None:
+    watched = {}
+    cached = (__parse_config(filename, {}, watched), watched)
+    with __config_lock:
+      __config_cache[filename] = cached
+
+  return dict(
+    (key, list(value) if isinstance(value, list) else value)
+    for (key, value) in cached[0].items()
+    )
+
+
+def reload(filename=None):
+  """
+  Drop the cached configuration of filename, or of every file, so the next
+  read parses it again.
+  """
+  with __config_lock:
+    if filename is None:
+      __config_cache.clear()
+    else:
+      __config_cache.pop(os.path.normpath(os.path.abspath(filename)), None)
+
+
 def GetAgentConfig(**kwargs):
   """
   This simple module will consume the Zabbix agent configuration file and
@@ -33,20 +243,24 @@ def GetAgentConfig(**kwargs):
   those check values to the server that provided the list at the interval
   specified.
 
-  This module is not that smart.  Instead it only cares about the first one
+  The zabbix_serv and zabbix_port attributes only describe the first one
   listed in either ServerActive (preferred) or Server (if ServerActive not
-  defined).  Additionally, at this time, it does not support parsing of IPv6
-  so if you are using the IPv6 address shorthand, this module will likely
-  return invalid values for zabbix_port.
+  defined).  Every entry, IPv6 addresses in square brackets included, is
+  available as a list of (host, port) tuples in the zabbix_targets
+  attribute, see parse_targets.
 
   Additionally, the entirety of the Zabbix agent configuration file can be
-  accessed as a dict() attribute called zabbix_conf. There is no processing
-  performed on this data.
+  accessed as a dict() attribute called zabbix_conf.  Include directives are
+  resolved and keys the agent accepts more than once are lists, otherwise
+  there is no processing performed on this data (see read_agent_config).
 
   Finally, the class accepts the following keyword arguments, which will
   override the default values;
     zabbix_agent_conf -- This will tell the class where to find the agent
       configuration file.  It defaults to /etc/zabbix/zabbix_agentd.conf
+    validate_config -- Check whether the cached configuration file changed
+      before using it.  Defaults to True; with False, the file is only read
+      again after GetAgentConfig.reload().
     zabbix_host -- This is the hostname that the Zabbix server will use for
       storing / processing the data that is sent. If defined, it will
       override the Hostname and HostnameItem values.
@@ -67,20 +281,20 @@ def GetAgentConfig(**kwargs):
   retval = dict()
 
   retval['zabbix_time'] = int(zabbix.__zabbix_time_curr__)
-  retval['zabbix_conf'] = parse_file.parse_file_kvp(
-    filename = kwargs.get(
-      'zabbix_agent_conf',
-      zabbix.__zabbix_agnt_conf__
-    )
-  )
 
   if not kwargs.get('read_config', True):
     retval['zabbix_host'] = zabbix.__zabbix_agnt_addr__
     retval['zabbix_serv'] = zabbix.__zabbix_serv_addr__
     retval['zabbix_port'] = int(zabbix.__zabbix_serv_port__)
+    retval['zabbix_targets'] = [(retval['zabbix_serv'], retval['zabbix_port'])]
     retval['zabbix_conf'] = ''
     return retval
 
+  retval['zabbix_conf'] = read_agent_config(
+      kwargs.get('zabbix_agent_conf', zabbix.__zabbix_agnt_conf__),
+      kwargs.get('validate_config', True)
+      )
+
   retval['zabbix_host'] = _parse_host_entry(
       kwargs.get(
           'zabbix_host',
@@ -91,7 +305,7 @@ def GetAgentConfig(**kwargs):
           )
       )[0]
 
-  zabbix_serv = _parse_host_entry(
+  zabbix_targets = parse_targets(
       kwargs.get(
           'zabbix_serv',
           retval['zabbix_conf'].get(
@@ -101,21 +315,21 @@ def GetAgentConfig(**kwargs):
                    zabbix.__zabbix_serv_addr__
                    )
               )
-          ),
-      )
-  retval['zabbix_serv'] = zabbix_serv[0]
-  if 'zabbix_port' not in kwargs:
-    if len(zabbix_serv) == 1:
-      retval['zabbix_port'] = int(zabbix.__zabbix_serv_port__)
-    else:
-      retval['zabbix_port'] = int(zabbix_serv[1])
-  else:
-    retval['zabbix_port'] = int(kwargs.get('zabbix_port', zabbix.__zabbix_serv_port__))
+          )
+      ) or [(zabbix.__zabbix_serv_addr__, int(zabbix.__zabbix_serv_port__))]
+  if 'zabbix_port' in kwargs:
+    zabbix_targets[0] = (zabbix_targets[0][0], int(kwargs['zabbix_port']))
+
+  retval['zabbix_serv'] = zabbix_targets[0][0]
+  retval['zabbix_port'] = zabbix_targets[0][1]
+  retval['zabbix_targets'] = zabbix_targets
 
   retval['zabbix_time'] = int(kwargs.get('zabbix_time', zabbix.__zabbix_time_curr__))
 
   return retval
 
+GetAgentConfig.reload = reload
+
 if __name__ == '__main__':
   import doctest
   doctest.testmod()
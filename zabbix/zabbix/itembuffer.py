@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Compact, column oriented storage for the items buffered by the sender.
+
+A list holding one four key dict per value costs several hundred bytes per
+value.  ItemBuffer stores the same data as columns instead;
+    hosts / keys  -- Dictionary encoded: every distinct host name and item key
+                     is stored once, and each item only keeps its index, in an
+                     array of unsigned integers.
+    clocks / ns   -- Arrays of 64 bit integers.
+    values        -- A plain list, values are whatever the caller handed in.
+
+Items still read back as the familiar dicts;
+    >>> import zabbix.itembuffer
+    >>> buffer = zabbix.itembuffer.ItemBuffer()
+    >>> buffer.append('client1.example.org', 'myKey1', '16535', 499162920)
+    >>> buffer.add_items([
+    ...   ('client1.example.org', 'myKey2', '16534', 499162920),
+    ...   {'host': 'client2.example.org', 'key': 'myKey1', 'value': '16533', 'clock': 499162920},
+    ...   ])
+    2
+    >>> len(buffer)
+    3
+    >>> buffer[2] == {'host': 'client2.example.org', 'key': 'myKey1', 'value': '16533', 'clock': 499162920}
+    True
+    >>> next(buffer.iter_encoded())
+    b'{"host": "client1.example.org", "key": "myKey1", "value": "16535", "clock": 499162920}'
+
+Gauges sampled faster than they are flushed can be coalesced on (host, key),
+keeping only the latest value;
+    >>> buffer = zabbix.itembuffer.ItemBuffer(coalesce='last')
+    >>> buffer.append('client1.example.org', 'myKey1', '1', 499162920)
+    >>> buffer.append('client1.example.org', 'myKey1', '2', 499162921)
+    >>> buffer.append('client1.example.org', 'myKey1', '0', 499162900)
+    >>> [x['value'] for x in buffer], buffer.dropped
+    (['2'], 2)
+
+or every value with a distinct clock;
+    >>> buffer = zabbix.itembuffer.ItemBuffer(coalesce='distinct')
+    >>> buffer.append('client1.example.org', 'myKey1', '1', 499162920)
+    >>> buffer.append('client1.example.org', 'myKey1', '2', 499162920)
+    >>> buffer.append('client1.example.org', 'myKey1', '3', 499162921)
+    >>> [x['value'] for x in buffer], buffer.dropped
+    (['2', '3'], 1)
+"""
+import array
+import json
+
+NO_NS = -1
+
+COALESCE_POLICIES = (None, 'last', 'distinct')
+
+
+class ItemBuffer(object):
+  """
+  The buffer behaves like the list of item dicts it replaces as far as
+  len(), iteration, indexing, comparison and printing go, and adds the
+  append() / add_items() mutators and the iter_encoded() fast path used to
+  build sender packets.
+
+  The class object supports the following keyword argument at instantiation;
+    coalesce      -- (String) How repeated (host, key) pairs are handled;
+                     None       -- Keep every item.  This is the default.
+                     'last'     -- Keep a single item per (host, key), the one
+                                   with the latest clock / ns.  On equal
+                                   clocks the item added last wins.
+                     'distinct' -- Keep one item per (host, key, clock, ns),
+                                   the one added last.
+
+  Coalescing is backed by a hash index on the dictionary encoded (host, key)
+  pair, and the number of items it threw away is kept in 'dropped'.
+  """
+
+  def __init__(self, **kwargs):
+    self.coalesce = kwargs.get('coalesce', None)
+    if self.coalesce not in COALESCE_POLICIES:
+      raise ValueError('Unknown coalesce policy: {0!r}'.format(self.coalesce))
+    self.dropped = 0
+    self.__index = {}
+
+    self.__host_names = []
+    self.__host_index = {}
+    self.__key_names = []
+    self.__key_index = {}
+    self.__host_json = []
+    self.__key_json = []
+
+    self.__hosts = array.array('I')
+    self.__keys = array.array('I')
+    self.__clocks = array.array('q')
+    self.__ns = array.array('q')
+    self.__values = []
+
+  def __intern(self, name, names, index, encoded):
+    """
+    Dictionary encode one host name / item key.
+    """
+    try:
+      return index[name]
+    except KeyError:
+      index[name] = len(names)
+      names.append(name)
+      encoded.append(json.dumps(name).encode('utf-8'))
+      return index[name]
+
+  def append(self, host, key, value, clock, ns=None):
+    """
+    Add one item to the buffer, honouring the coalesce policy.
+    """
+    host_id = self.__intern(host, self.__host_names, self.__host_index, self.__host_json)
+    key_id = self.__intern(key, self.__key_names, self.__key_index, self.__key_json)
+    clock = int(clock)
+    ns = NO_NS if ns is None else int(ns)
+
+    if self.coalesce is not None:
+      if self.coalesce == 'last':
+        index_key = (host_id, key_id)
+      else:
+        index_key = (host_id, key_id, clock, ns)
+
+      row = self.__index.get(index_key, None)
+      if row is not None:
+        self.dropped += 1
+        if (clock, ns) < (self.__clocks[row], self.__ns[row]):
+          return
+        self.__values[row] = value
+        self.__clocks[row] = clock
+        self.__ns[row] = ns
+        return
+      self.__index[index_key] = len(self.__values)
+
+    self.__hosts.append(host_id)
+    self.__keys.append(key_id)
+    self.__values.append(value)
+    self.__clocks.append(clock)
+    self.__ns.append(ns)
+
+  def add_items(self, items, **kwargs):
+    """
+    Bulk add items, either dicts with host / key / value / clock (and
+    optionally ns) entries, or (host, key, value, clock[, ns]) tuples.  A
+    missing host or clock is taken from the 'host' / 'clock' keyword
+    arguments, and the ns of an item without a clock from 'ns'.  Returns the
+    number of items added.
+    """
+    default_host = kwargs.get('host', None)
+    default_clock = kwargs.get('clock', None)
+    default_ns = kwargs.get('ns', None)
+    append = self.append
+
+    count = 0
+    for item in items:
+      if isinstance(item, dict):
+        (host, key, value) = (item.get('host', None), item['key'], item['value'])
+        (clock, ns) = (item.get('clock', None), item.get('ns', None))
+      else:
+        (host, key, value, clock) = item[:4]
+        ns = item[4] if len(item) > 4 else None
+
+      if clock is None:
+        (clock, ns) = (default_clock, default_ns if ns is None else ns)
+      append(default_host if host is None else host, key, value, clock, ns)
+      count += 1
+    return count
+
+  def clear(self):
+    """
+    Empty the buffer, keeping the coalesce policy.  The dropped counter is
+    reset as well.
+    """
+    self.__init__(coalesce=self.coalesce)
+
+  def __len__(self):
+    return len(self.__values)
+
+  def __getitem__(self, index):
+    if isinstance(index, slice):
+      return [self[x] for x in range(*index.indices(len(self)))]
+
+    retval = {
+      'host': self.__host_names[self.__hosts[index]],
+      'key': self.__key_names[self.__keys[index]],
+      'value': self.__values[index],
+      'clock': self.__clocks[index],
+      }
+    if self.__ns[index] != NO_NS:
+      retval['ns'] = self.__ns[index]
+    return retval
+
+  def __iter__(self):
+    for index in range(len(self)):
+      yield self[index]
+
+  def __eq__(self, other):
+    if isinstance(other, ItemBuffer):
+      other = list(other)
+    return list(self) == other
+
+  def __ne__(self, other):
+    return not self == other
+
+  def __repr__(self):
+    return repr(list(self))
+
+  def iter_encoded(self):
+    """
+    Yield every item JSON encoded (bytes), in the same layout json.dumps()
+    gives the item dict.  Host names and keys are only encoded once.
+    """
+    host_json = self.__host_json
+    key_json = self.__key_json
+    dumps = json.dumps
+    for index in range(len(self)):
+      ns = self.__ns[index]
+      yield b''.join((
+          b'{"host": ', host_json[self.__hosts[index]],
+          b', "key": ', key_json[self.__keys[index]],
+          b', "value": ', dumps(self.__values[index]).encode('utf-8'),
+          b', "clock": ', str(self.__clocks[index]).encode('ascii'),
+          b'}' if ns == NO_NS else u', "ns": {0}}}'.format(ns).encode('ascii'),
+          ))
+
+
+if __name__ == '__main__':
+  import doctest
+  doctest.testmod()
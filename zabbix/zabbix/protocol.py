@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Framing helpers for the Zabbix wire protocol.
+
+Every request and response exchanged with a Zabbix server, proxy or agent is
+wrapped in a small binary header;
+    'ZBXD'   -- (4 bytes) Protocol signature.
+    flags    -- (1 byte) 0x01 for a standard packet, 0x03 when the payload is
+                zlib compressed.
+    datalen  -- (4 bytes) Little-endian length of the payload, as sent.
+    reserved -- (4 bytes) Zero for a standard packet, or the uncompressed
+                length of the payload for a compressed one.
+
+    >>> import zabbix.protocol
+    >>> packet = zabbix.protocol.pack(b'{"request":"sender data"}')
+    >>> packet[:5]
+    b'ZBXD\\x01'
+    >>> len(packet) - zabbix.protocol.ZBX_HEADER_LEN
+    25
+
+Compression is only applied to payloads of at least compress_threshold bytes;
+    >>> packet = zabbix.protocol.pack(b'x' * 4096, compress_threshold=1024)
+    >>> packet[:5]
+    b'ZBXD\\x03'
+    >>> zabbix.protocol.unpack(packet) == b'x' * 4096
+    True
+"""
+import struct
+import zlib
+
+ZBX_SIGNATURE = b'ZBXD'
+ZBX_FLAG_STANDARD = 0x01
+ZBX_FLAG_COMPRESS = 0x02
+ZBX_COMPRESS_LEVEL = 6
+ZBX_HEADER = struct.Struct('<4sBII')
+ZBX_HEADER_LEN = ZBX_HEADER.size
+
+
+class ProtocolError(Exception):
+  """
+  The remote end answered with something that is not a Zabbix packet.
+  """
+  pass
+
+
+class ConnectionClosed(ProtocolError):
+  """
+  The remote end closed the connection before sending a single byte of its
+  response; reset is True when it was torn down by a reset rather than a
+  clean EOF.  Either way, nothing of the answer was read.
+  """
+  def __init__(self, message, reset=False):
+    super(ConnectionClosed, self).__init__(message)
+    self.reset = reset
+
+
+def pack(payload, compress_threshold=None):
+  """
+  Wrap the payload (bytes or str) in a Zabbix protocol header.  When a
+  compress_threshold is given, payloads of at least that many bytes are zlib
+  compressed and sent with the 0x03 flag.
+  """
+  if not isinstance(payload, bytes):
+    payload = payload.encode('utf-8')
+
+  if compress_threshold is not None and len(payload) >= compress_threshold:
+    compressed = zlib.compress(payload, ZBX_COMPRESS_LEVEL)
+    return ZBX_HEADER.pack(
+        ZBX_SIGNATURE,
+        ZBX_FLAG_STANDARD | ZBX_FLAG_COMPRESS,
+        len(compressed),
+        len(payload)
+        ) + compressed
+
+  return ZBX_HEADER.pack(
+      ZBX_SIGNATURE,
+      ZBX_FLAG_STANDARD,
+      len(payload),
+      0
+      ) + payload
+
+
+def __decode(header, data):
+  """
+  Return the payload of a packet, decompressing it when the header says so.
+  """
+  (signature, flags, datalen, reserved) = ZBX_HEADER.unpack(header)
+  if not flags & ZBX_FLAG_COMPRESS:
+    return data
+
+  try:
+    payload = zlib.decompress(data)
+  except zlib.error as err:
+    raise ProtocolError('Unable to decompress response: {0}'.format(err))
+
+  if len(payload) != reserved:
+    raise ProtocolError(
+        'Decompressed {0} bytes, header announced {1}'.format(
+            len(payload),
+            reserved
+            )
+        )
+  return payload
+
+
+def __check_header(header):
+  """
+  Validate a packet header and return the length of the data that follows.
+  """
+  (signature, flags, datalen, reserved) = ZBX_HEADER.unpack(header)
+  if signature != ZBX_SIGNATURE:
+    raise ProtocolError('Invalid response header: {0!r}'.format(header))
+  return datalen
+
+
+def unpack(packet):
+  """
+  Return the payload of a complete packet held in memory.
+  """
+  header = bytes(packet[:ZBX_HEADER_LEN])
+  datalen = __check_header(header)
+  data = bytes(packet[ZBX_HEADER_LEN:ZBX_HEADER_LEN + datalen])
+  if len(data) != datalen:
+    raise ProtocolError('Truncated packet')
+  return __decode(header, data)
+
+
+def recv_exact(sock, size):
+  """
+  Read exactly size bytes from the socket.  A socket that closes before
+  size bytes have arrived raises ProtocolError.
+  """
+  chunks = []
+  remaining = size
+  while remaining > 0:
+    chunk = sock.recv(min(remaining, 65536))
+    if not chunk:
+      raise ProtocolError(
+          'Connection closed after {0} of {1} bytes'.format(
+              size - remaining,
+              size
+              )
+          )
+    chunks.append(chunk)
+    remaining -= len(chunk)
+
+  return b''.join(chunks)
+
+
+def read_packet(sock):
+  """
+  Read one complete Zabbix packet from the socket and return its payload,
+  decompressing it if the sender set the compression flag.  A connection that
+  goes away before the first byte of the response raises ConnectionClosed,
+  one that goes away half way through raises ProtocolError / socket.error.
+    >>> import socket
+    >>> (left, right) = socket.socketpair()
+    >>> right.close()
+    >>> read_packet(left)
+    Traceback (most recent call last):
+    ...
+    zabbix.protocol.ConnectionClosed: Connection closed before any response
+    >>> left.close()
+  """
+  try:
+    first = sock.recv(ZBX_HEADER_LEN)
+  except ConnectionResetError:
+    raise ConnectionClosed('Connection reset before any response', reset=True)
+  if not first:
+    raise ConnectionClosed('Connection closed before any response')
+
+  header = first + recv_exact(sock, ZBX_HEADER_LEN - len(first))
+  datalen = __check_header(header)
+  return __decode(header, recv_exact(sock, datalen))
+
+
+async def read_packet_async(reader):
+  """
+  The asyncio flavour of read_packet(), reading from an asyncio.StreamReader.
+  """
+  import asyncio
+
+  try:
+    header = await reader.readexactly(ZBX_HEADER_LEN)
+    datalen = __check_header(header)
+    data = await reader.readexactly(datalen)
+  except asyncio.IncompleteReadError as err:
+    raise ProtocolError(
+        'Connection closed after {0} of {1} bytes'.format(
+            len(err.partial),
+            err.expected
+            )
+        )
+  return __decode(header, data)
+
+
+if __name__ == '__main__':
+  import doctest
+  doctest.testmod()
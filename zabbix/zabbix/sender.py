@@ -3,14 +3,100 @@
 """
 This is a pure python replacement for the zabbix_sender tool.
 """
+import collections
 import json
 import logging
 import re
 import socket
-import struct
 import sys
+import time
 import zabbix
 
+from zabbix import encoder
+from zabbix import itembuffer
+from zabbix import protocol
+from zabbix import spool
+from zabbix import transport
+from zabbix.getagentconfig import parse_targets
+
+
+def parse_info(response):
+  """
+  Pull the processed / failed / total / seconds spent counters out of the
+  'info' string of a server response.
+
+    >>> parse_info({'info': 'processed: 2; failed: 1; total: 3; seconds spent: 0.000150'})
+    {'processed': 2, 'failed': 1, 'total': 3, 'seconds_spent': 0.00015}
+  """
+  retval = {}
+  info = response.get('info', '') if isinstance(response, dict) else ''
+  for (name, value) in re.findall(r'([a-z ]+?):\s*([\d.]+)', info.lower()):
+    name = name.strip().replace(' ', '_')
+    retval[name] = float(value) if '.' in value else int(value)
+  return retval
+
+
+class SendSummary(object):
+  """
+  Combine the (retcode, response) tuples of several requests into a single
+  (retcode, response) tuple.
+
+  The combined response carries the usual 'response' and 'info' keys, plus
+  the summed counters as 'processed', 'failed', 'total' and 'seconds_spent',
+  the number of 'chunks' sent and the wall clock time 'elapsed'.  When a
+  chunk could not be delivered, 'error' holds its error message and 'unsent'
+  the number of items that were not delivered, of which 'spooled' were kept
+  in the spool for a later replay.  The return code is the worst
+  return code of all the chunks.
+  """
+
+  def __init__(self, item_count):
+    self.item_count = item_count
+    self.started = time.time()
+    self.retcode = 0
+    self.sent = 0
+    self.counters = {
+      'processed': 0,
+      'failed': 0,
+      'total': 0,
+      'seconds_spent': 0.0,
+      'chunks': 0,
+      'spooled': 0,
+      }
+
+  def add(self, result, chunk_size):
+    """
+    Account for the (retcode, response) result of a chunk of chunk_size
+    items.  Returns False when the chunk could not be delivered at all.
+    """
+    (chunk_code, response) = result
+    self.retcode = max(self.retcode, chunk_code)
+    if chunk_code >= 253:
+      self.counters.setdefault('error', response)
+      return False
+
+    self.sent += chunk_size
+    self.counters['chunks'] += 1
+    counters = parse_info(response)
+    for counter in ('processed', 'failed', 'total', 'seconds_spent'):
+      self.counters[counter] += counters.get(counter, 0)
+    return True
+
+  def result(self):
+    retval = dict(self.counters)
+    if 'error' in retval:
+      retval['unsent'] = self.item_count - self.sent
+    retval['seconds_spent'] = round(retval['seconds_spent'], 6)
+    retval['elapsed'] = time.time() - self.started
+    retval['response'] = 'success' if self.retcode == 0 else 'failed'
+    retval['info'] = u'processed: {0}; failed: {1}; total: {2}; seconds spent: {3:.6f}'.format(
+        retval['processed'],
+        retval['failed'],
+        retval['total'],
+        retval['seconds_spent']
+        )
+    return self.retcode, retval
+
 
 class Sender(object):
   """
@@ -55,7 +141,87 @@ class Sender(object):
 
     zabbix_time   -- (Integer) This is the current epoch time when the class
                      object is instantiated.  Each item can have a separate time
-                     when they are added.
+                     when they are added.  When given, it is also the time
+                     every item without a clock of its own is stamped with
+                     (clock_source 'fixed').
+
+    clock_source  -- (String) Where the clock of items added without one
+                     comes from;
+                       'item'  -- The time the item is added, read once per
+                                  add_item() call, and once per add_items()
+                                  call for the whole batch.
+                       'fixed' -- zabbix_time.
+                     Requests always carry the time they were built at,
+                     unless the clock source is 'fixed'.  Defaults to 'fixed'
+                     when zabbix_time is given, 'item' otherwise.
+
+    ns            -- (Boolean) Stamp items, and requests, with nanoseconds as
+                     well (the 'ns' field, Zabbix 2.4 and later), so values
+                     sampled within the same second keep distinct
+                     timestamps.  Defaults to False.
+
+    zabbix_targets -- (List) Every server / proxy that can take the data, as
+                     (server, port) tuples or 'server:port' strings (IPv6
+                     addresses in square brackets).  Defaults to every entry
+                     of ServerActive when the configuration is read, and to
+                     zabbix_serv / zabbix_port otherwise.  zabbix_serv and
+                     zabbix_port always name the first target.
+
+    balance       -- (String) How requests are spread over zabbix_targets;
+                     'failover' sends to the first target that accepts a
+                     connection, 'spread' sends consecutive requests (chunks)
+                     to consecutive targets.  Either way a target that could
+                     not be reached is avoided for a while, backing off
+                     exponentially.  Defaults to 'failover'.
+
+    timeout       -- (Number) Socket timeout, in seconds, used when talking to
+                     the Zabbix server.  Defaults to 5.
+
+    pool_size     -- (Integer) Maximum number of idle connections kept open to
+                     the Zabbix server between sends.  Defaults to 4.
+
+    pool_idle     -- (Number) Seconds an idle connection is kept open before it
+                     is closed instead of being reused.  Defaults to 30.
+
+    chunk_items   -- (Integer) Maximum number of items sent in a single request
+                     to the Zabbix server.  Larger batches are split across
+                     several requests.  Defaults to 250.
+
+    chunk_bytes   -- (Integer) Maximum size, in bytes, of a single request to
+                     the Zabbix server.  Defaults to 1048576 (1 MiB).
+
+    compress      -- (Boolean) Send zlib compressed requests (protocol flag
+                     0x03) to servers / proxies that support them (Zabbix 4.0
+                     and later).  Defaults to False.
+
+    compress_threshold -- (Integer) When compress is enabled, only requests
+                     of at least this many bytes are compressed, as small
+                     ones gain nothing from it.  Defaults to 1024.
+
+    coalesce      -- (String) Drop repeated host / key items before they are
+                     sent;  'last' keeps only the latest value of every host /
+                     key pair, 'distinct' keeps one value per host / key and
+                     clock.  Defaults to None, which sends every item.  The
+                     number of items dropped is available as 'coalesced'.
+
+    spool_dir     -- (String) Directory of a disk backed spool (see
+                     zabbix.spool) that keeps the requests that could not be
+                     delivered because the server was unreachable, and replays
+                     them, oldest first, on the next successful send.  By
+                     default there is no spool, and such data is lost.
+
+    spool_max_bytes -- (Integer) Upper bound for the size of the spool.
+                     Defaults to 268435456 (256 MiB).
+
+    pipeline_window -- (Integer) When items are sent one (or a few) at a
+                     time, see send(iterate_values=True), the number of
+                     requests kept in flight on the connection before
+                     waiting for their responses.  Defaults to 8.
+
+  Connections are pooled process wide, per server / port pair, so the pool
+  options only take effect for the first Sender that talks to a given server.
+  Per target request, error and latency statistics are available from
+  target_stats().
 
 
   Usage examples;
@@ -93,6 +259,8 @@ class Sender(object):
       print_values -- Boolean to display the items (True) or send them (False)
       iterate_values -- Boolean to send items one at a time (True) or send
       them in bulk.  This defaults to False.
+      iterate_items -- When iterating, the number of items per request.  This
+      defaults to 1.
       >>> monitor.send(print_values=True) #doctest: +SKIP
       {'host': 'client1.example.org', 'value': '16535', 'key': 'myKey1', 'clock': 499162920}
       {'host': 'client1.example.org', 'value': '16535', 'key': 'myKey1', 'clock': 499162920}
@@ -104,8 +272,9 @@ class Sender(object):
     """
     Initialize a new instance of the class.  The class initialization will two
     will instantiate two "private" attributes;
-    __list_item__ -- (List) This is the list of item key/value pairs to be sent
-                     to the Zabbix server.
+    __list_item__ -- (ItemBuffer) This is the list of item key/value pairs to
+                     be sent to the Zabbix server.  It is stored column wise
+                     (see zabbix.itembuffer), but reads like a list of dicts.
 
     __dict_lld__  -- (Dict) This is a dictionary of low-level discovery objects
                      to send to the Zabbix server.
@@ -115,11 +284,16 @@ class Sender(object):
     add_item()    -- (Method) This will add an item key/value pair to the
                      __list_item__ list.
 
+    add_items()   -- (Method) This will add many items to the __list_item__
+                     list in one call.
+
     add_lld()     -- (Method) This will add a discovery object to the dictionary
                      of LLD objects (__dict_lld__).
     """
     logging.debug('Instantiating Zabbix sender')
-    self.__list_item__ = []
+    self.__list_item__ = itembuffer.ItemBuffer(
+        coalesce=kwargs.get('coalesce', None)
+        )
     self.__dict_lld__ = {}
 
     logging.debug('Loading Zabbix agent config')
@@ -128,8 +302,39 @@ class Sender(object):
     self.zabbix_serv = kwargs.get('zabbix_serv', zbx_config_object['zabbix_serv'])
     self.zabbix_port = kwargs.get('zabbix_port', zbx_config_object['zabbix_port'])
     self.zabbix_time = kwargs.get('zabbix_time', zbx_config_object['zabbix_time'])
+    self.clock_source = kwargs.get(
+        'clock_source',
+        'fixed' if 'zabbix_time' in kwargs else 'item'
+        )
+    if self.clock_source not in ('item', 'fixed'):
+      raise ValueError('Unknown clock source: {0!r}'.format(self.clock_source))
+    self.ns = kwargs.get('ns', False)
+    self.zabbix_targets = parse_targets(
+        kwargs.get('zabbix_targets', zbx_config_object['zabbix_targets']),
+        self.zabbix_port
+        )
+    if 'zabbix_targets' in kwargs and 'zabbix_serv' not in kwargs:
+      (self.zabbix_serv, self.zabbix_port) = self.zabbix_targets[0]
+    self.balance = kwargs.get('balance', 'failover')
 
     self.verbose = kwargs.get('verbose', False)
+    self.chunk_items = int(kwargs.get('chunk_items', 250))
+    self.chunk_bytes = int(kwargs.get('chunk_bytes', 1048576))
+    self.compress = kwargs.get('compress', False)
+    self.compress_threshold = int(kwargs.get('compress_threshold', 1024))
+    self.spool = None
+    if kwargs.get('spool_dir', None):
+      self.spool = spool.Spool(
+          spool_dir=kwargs['spool_dir'],
+          max_bytes=kwargs.get('spool_max_bytes', 268435456)
+          )
+    self.__pool_options = {
+      'timeout': kwargs.get('timeout', 5),
+      'max_size': kwargs.get('pool_size', 4),
+      'max_idle': kwargs.get('pool_idle', 30),
+      }
+    self.__targets = None
+    self.pipeline_window = int(kwargs.get('pipeline_window', 8))
     logging.debug('Sender instantiated')
 
   def __print_values(self, data_set):
@@ -147,71 +352,239 @@ class Sender(object):
     for elem in dataset:
       print(u'{0}'.format(elem))
 
-  def __build_object(self, **kwargs):
+  def _lld_items(self):
     """
-    This will convert the item object to a Zabbix JSON structure for uploading
-    to the Zabbix server.
+    Convert the LLD dictionary into regular sender items, one per (host, key)
+    pair, whose value is the Zabbix discovery JSON.  The entries of a key are
+    stored as one flat list of (MACRO, value) pairs, so a new discovery row
+    starts every time a MACRO repeats.
     """
-    obj_data = {
-      'request': 'sender data',
-      'data': [],
-      }
+    (clock, ns) = self.now()
+    for ((host, zkey), entries) in self.__dict_lld__.items():
+      rows = []
+      row = {}
+      for (macro, value) in entries:
+        if macro in row:
+          rows.append(row)
+          row = {}
+        row[macro] = value
+      if row:
+        rows.append(row)
+
+      retval = {
+        'host': host,
+        'key': zkey,
+        'value': json.dumps({'data': rows}),
+        'clock': clock
+        }
+      if ns is not None:
+        retval['ns'] = ns
+      yield retval
+
+  def _iter_packets(self, items, **kwargs):
+    """
+    Stream the items through a PacketEncoder (see zabbix.encoder), cutting a
+    new 'sender data' request whenever the current one holds chunk_items
+    items or would grow past chunk_bytes bytes.  An item that is larger than
+    chunk_bytes on its own is sent in a request by itself, and left for the
+    server to judge.
+
+    Yields a (count, packet, payload) tuple per request, where packet is the
+    framed (and possibly compressed) request and payload its JSON.  Both are
+    views on the encoder buffer, valid until the next iteration.  Every
+    request is stamped with the time it is finished, see now().
+    """
+    chunk_items = int(kwargs.get('chunk_items', self.chunk_items))
+    chunk_bytes = int(kwargs.get('chunk_bytes', self.chunk_bytes))
+    compress_threshold = self.compress_threshold if self.compress else None
 
-    buildwhat = kwargs.get('build', 'item')
-    if buildwhat == 'lld':
-      if len(self.__dict_lld__) == 0:
-        obj_data['data'] = {}
-      else:
-        obj_data['clock'] = self.zabbix_time
-        obj_data['data'] = self.__dict_lld__
+    if isinstance(items, itembuffer.ItemBuffer):
+      encoded_items = items.iter_encoded()
     else:
-      if len(self.__list_item__) == 0:
-        obj_data['data'] = {}
-      else:
-        obj_data['clock'] = self.zabbix_time
-        obj_data['data'] = self.__list_item__
+      encoded_items = (json.dumps(x).encode('utf-8') for x in items)
+
+    packet_encoder = encoder.PacketEncoder()
+    for encoded in encoded_items:
+      if packet_encoder.count and (
+          packet_encoder.count >= chunk_items or
+          packet_encoder.size + len(encoded) + 2 > chunk_bytes):
+        (clock, ns) = self.now()
+        packet = packet_encoder.finish(
+            clock=clock,
+            ns=ns,
+            compress_threshold=compress_threshold
+            )
+        yield packet_encoder.count, packet, packet_encoder.payload()
+        packet_encoder.reset()
+      packet_encoder.add_encoded(encoded)
+
+    if packet_encoder.count:
+      (clock, ns) = self.now()
+      packet = packet_encoder.finish(
+          clock=clock,
+          ns=ns,
+          compress_threshold=compress_threshold
+          )
+      yield packet_encoder.count, packet, packet_encoder.payload()
+      packet_encoder.reset()
+
+  def __send_chunked(self, items, **kwargs):
+    """
+    Send the items in as many requests as _iter_packets deems necessary, see
+    send_packets.
+    """
+    return self.send_packets(self._iter_packets(items, **kwargs), len(items))
+
+  def send_packets(self, packets, item_count=0):
+    """
+    Send already encoded requests, (count, packet, payload) tuples such as
+    the ones _iter_packets yields, and combine the responses into a single
+    response (see SendSummary).  payload may be None, it is then recovered
+    from packet when needed.  Sending stops at the first request that could
+    not be delivered at all (return codes 253 - 255).
+
+    With a spool, whatever was spooled earlier is replayed first, and when
+    the server can not be reached the undelivered requests are spooled instead
+    of being dropped.  The replay statistics are returned as 'replayed'.
+    """
+    summary = SendSummary(item_count)
+    packets = iter(packets)
+
+    if self.spool is not None and self.spool.pending():
+      replay = self.spool.replay(lambda payload: self.__send(payload)[0] < 253)
+      summary.counters['replayed'] = replay
+      if not replay['complete']:
+        summary.add((255, u'Spool replay interrupted, spooling new data\n'), 0)
+        self.__spool_packets(packets, summary)
+        return summary.result()
+
+    for (count, packet, payload) in packets:
+      result = self.__send(packet if payload is None else payload, packet=packet)
+      if summary.add(result, count):
+        continue
+      if result[0] == 255 and self.spool is not None:
+        self.__spool_packets([(count, packet, payload)], summary)
+        self.__spool_packets(packets, summary)
+      break
 
-    return json.dumps(obj_data)
+    return summary.result()
 
-  def __send(self, mydata):
+  def __send_pipelined(self, items, **kwargs):
+    """
+    Send the items iterate_items (default 1) at a time, pipelined over one
+    connection (see zabbix.transport.TargetSet.pipeline), and return a
+    (retcode, response, items) tuple per request, where items is the list of
+    items that request carried.  When the connection fails, every request
+    that was not answered gets the error, so the caller knows exactly which
+    items were not delivered.
+    """
+    counts = collections.deque()
+    packets = self._iter_packets(
+        items,
+        chunk_items=kwargs.get('iterate_items', 1),
+        chunk_bytes=kwargs.get('chunk_bytes', self.chunk_bytes)
+        )
+
+    def framed():
+      for (count, packet, _) in packets:
+        counts.append(count)
+        yield packet
+
+    retarray = []
+    offset = 0
+    try:
+      for (_, response_raw) in self.targets.pipeline(
+          framed(),
+          kwargs.get('pipeline_window', self.pipeline_window)):
+        chunk = list(items[offset:offset + counts[0]])
+        offset += counts.popleft()
+        retarray.append(self._parse_response(chunk, response_raw) + (chunk,))
+      return retarray
+    except transport.ConnectError as err:
+      result = (255, u'Error talking to server: {0}\n'.format(err))
+      sys.stderr.write(result[1])
+    except protocol.ProtocolError:
+      result = (253, u'Invalid response from server. Malformed data?\n')
+    except socket.error as err:
+      result = (254, u'Error talking to server: {0}\n'.format(err))
+      sys.stderr.write(result[1])
+
+    for (count, _, _) in packets:
+      counts.append(count)
+    for count in counts:
+      chunk = list(items[offset:offset + count])
+      offset += count
+      retarray.append(result + (chunk,))
+    return retarray
+
+  def __spool_packets(self, packets, summary):
+    """
+    Append the payload of every packet to the spool, in order, and account
+    for them.
+    """
+    for (count, packet, payload) in packets:
+      self.spool.append(protocol.unpack(packet) if payload is None else payload)
+      summary.counters['spooled'] += count
+    self.spool.flush()
+
+  @staticmethod
+  def _printable(mydata):
+    """
+    Render a request for an error message.  Requests travel as bytes or as
+    views on an encoder buffer, so they are only decoded when needed.
+    """
+    if isinstance(mydata, (bytes, bytearray, memoryview)):
+      mydata = bytes(mydata)
+      if mydata.startswith(protocol.ZBX_SIGNATURE):
+        mydata = protocol.unpack(mydata)
+      return mydata.decode('utf-8', 'replace')
+    return mydata
+
+  def __send(self, mydata, **kwargs):
     """
     This method is the real send function, however, it requires that
     the data already be cooked, as such it is recommended that the 'send'
     method be used instead and it will call this private method.
+
+    When the request is already framed, it is passed as 'packet' and sent
+    as is, otherwise mydata is framed here.  The data is sent over a pooled
+    connection (see zabbix.transport), so consecutive sends to the same
+    server reuse the same socket for as long as the server keeps it open.
+    Targets that refuse the connection are failed over, see 'targets'.
     """
-    socket.setdefaulttimeout(5)
-    data_length = len(mydata)
-    data_header = '{0}{1}'.format(struct.pack('i', data_length), '\0\0\0\0')
-    data_to_send = 'ZBXD\1{0}{1}'.format(data_header, mydata)
+    data_to_send = kwargs.get('packet', None)
+    if data_to_send is None:
+      data_to_send = protocol.pack(
+          mydata,
+          compress_threshold=self.compress_threshold if self.compress else None
+          )
 
     try:
-      sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-      sock.connect((self.zabbix_serv, self.zabbix_port))
-    except Exception as err:
+      (_, response_raw) = self.targets.request(data_to_send)
+    except transport.ConnectError as err:
       err_message = u'Error talking to server: {0}\n'.format(err)
       sys.stderr.write(err_message)
       return 255, err_message
-    else:
-      sock.send(data_to_send)
-
-    try:
-      response_header = sock.recv(5)
-    except Exception as err:
+    except protocol.ProtocolError as err:
+      err_message = u'Invalid response from server. Malformed data?\n---\n{0}\n---\n'.format(
+          self._printable(mydata)
+          )
+      return 253, err_message
+    except socket.error as err:
       err_message = u'Error talking to server: {0}\n'.format(err)
       sys.stderr.write(err_message)
       return 254, err_message
 
-    if not response_header == 'ZBXD\1':
-      err_message = u'Invalid response from server. Malformed data?\n---\n{0}\n---\n'.format(mydata)
-      return 253, err_message
-
-    response_data_header = sock.recv(8)
+    return self._parse_response(mydata, response_raw)
 
-    response_data_header = response_data_header[:4]
-    response_len = struct.unpack('i', response_data_header)[0]
-    response_raw = sock.recv(response_len)
-    sock.close()
-    response = json.loads(response_raw)
+  def _parse_response(self, mydata, response_raw):
+    """
+    Turn the raw response to a request into a (retcode, response) tuple;
+      0 -- The server accepted every item.
+      1 -- The server reported failed items.
+      2 -- The response could not be parsed.
+    """
+    response = json.loads(response_raw.decode('utf-8'))
     match = re.match(
         r'^.*failed.+?(\d+).*$',
         response['info'].lower() if 'info' in response else ''
@@ -224,11 +597,80 @@ class Sender(object):
       fails = int(match.group(1))
       if fails > 0:
         if self.verbose is True:
-          err_message = u'Failures reported by zabbix when sending:\n{0}\n'.format(mydata)
+          err_message = u'Failures reported by zabbix when sending:\n{0}\n'.format(
+              self._printable(mydata)
+              )
           sys.stderr.write(err_message)
         return 1, response
       return 0, response
 
+  def now(self):
+    """
+    Return the (clock, ns) pair items and requests are stamped with, ns being
+    None unless the ns option is enabled.  See clock_source.
+
+      >>> import zabbix
+      >>> zabbix.Sender(read_config=False, zabbix_time=499162920, ns=True).now()
+      (499162920, 0)
+      >>> (clock, ns) = zabbix.Sender(read_config=False, ns=True).now()
+      >>> 0 <= ns < 1000000000
+      True
+    """
+    if self.clock_source == 'fixed':
+      return self.zabbix_time, 0 if self.ns else None
+
+    (clock, ns) = divmod(time.time_ns(), 1000000000)
+    return clock, ns if self.ns else None
+
+  @property
+  def coalesced(self):
+    """
+    Number of items dropped by the coalesce policy since the item buffer was
+    created.
+    """
+    return self.__list_item__.dropped
+
+  @property
+  def pool(self):
+    """
+    The process wide connection pool for the current zabbix_serv and
+    zabbix_port.  Its stats() method reports how often connections were
+    opened versus reused.
+    """
+    return transport.get_pool(
+        self.zabbix_serv,
+        self.zabbix_port,
+        **self.__pool_options
+        )
+
+  @property
+  def targets(self):
+    """
+    The TargetSet (see zabbix.transport) requests are sent through.  It
+    keeps the health of every target between sends, and is rebuilt when
+    zabbix_targets, zabbix_serv, zabbix_port or balance are changed.
+    """
+    targets = [(self.zabbix_serv, int(self.zabbix_port))] + [
+      x for x in parse_targets(self.zabbix_targets, self.zabbix_port)[1:]
+      if x != (self.zabbix_serv, int(self.zabbix_port))
+      ]
+    if self.__targets is None or \
+        self.__targets.targets != targets or \
+        self.__targets.balance != self.balance:
+      self.__targets = transport.TargetSet(
+          targets,
+          balance=self.balance,
+          **self.__pool_options
+          )
+    return self.__targets
+
+  def target_stats(self):
+    """
+    Return the request count, error count, latency and health of every
+    target, keyed by (server, port).  See zabbix.transport.TargetSet.stats().
+    """
+    return self.targets.stats()
+
   def add_item(self, **kwargs):
     """
     This will add an item to the Zabbix item object.  We will use the same
@@ -247,7 +689,10 @@ class Sender(object):
 
     clock         -- (Integer) This is the current epoch time when the item is
                      collected. This is optional and will default to the
-                     zabbix_time value.
+                     time given by now().
+
+    ns            -- (Integer) Nanoseconds part of clock. This is optional;
+                     when clock is not given either, it is taken from now().
 
     host          -- (String) This is the Zabbix client / agent name that the
                      class will send this item as. This is optional and will
@@ -267,10 +712,11 @@ class Sender(object):
       >>> monitor.add_item(key='myKey1',value='16535')
       True
 
-    This package also supports adding multiple items. Each item must have
-    a different key, unless they have different zabbix_host entries.  If you
-    use the same key for the same host, it will overwrite the previous item
-    value.  This has been tested with 650 items without issue.
+    This package also supports adding multiple items. By default every item
+    is sent, even when the same key is used more than once for the same host.
+    Instantiate the Sender with coalesce='last' to only keep the latest value
+    of a host / key pair instead.  This has been tested with 650 items without
+    issue.
       >>> monitor.add_item(key='myKey1',value='16535')
       True
       >>> monitor.add_item(key='myKey1',value='16534',zabbix_host='client2.example.org')
@@ -311,7 +757,19 @@ class Sender(object):
     adding item key/value pairs to the list of items to send to the Zabbix
     server.
 
-    @TODO: Fix the add_item to eliminate duplicate host / key tuples.
+    With coalescing enabled, repeated host / key pairs replace each other;
+      >>> monitor = zabbix.Sender(
+      ...   zabbix_serv='zabbix.example.org',
+      ...   zabbix_host='client1.example.org',
+      ...   zabbix_time=epochtime1,
+      ...   coalesce='last'
+      ...   )
+      >>> monitor.add_item(key='myKey1',value='16535')
+      True
+      >>> monitor.add_item(key='myKey1',value='16536')
+      True
+      >>> [x['value'] for x in monitor.__list_item__], monitor.coalesced
+      (['16536'], 1)
     """
     if 'key' not in kwargs:
       return False
@@ -319,20 +777,81 @@ class Sender(object):
     if 'value' not in kwargs:
       return False
 
-    obj_data = {
-      'host': kwargs.get('zabbix_host', self.zabbix_host),
-      'key': kwargs.get('key'),
-      'value': kwargs.get('value'),
-      'clock': kwargs.get('clock', self.zabbix_time)
-      }
-
-    self.__list_item__.append(obj_data)
+    clock = kwargs.get('clock', None)
+    ns = kwargs.get('ns', None)
+    if clock is None:
+      (clock, now_ns) = self.now()
+      ns = now_ns if ns is None else ns
+
+    self.__list_item__.append(
+        kwargs.get('zabbix_host', self.zabbix_host),
+        kwargs.get('key'),
+        kwargs.get('value'),
+        clock,
+        ns
+        )
     return True
 
+  def add_items(self, items):
+    """
+    Bulk version of add_item, for collectors that gather many values at once.
+    The items are either dicts using the add_item keyword arguments (key,
+    value, and optionally clock, zabbix_host and ns), or (key, value[,
+    clock[, zabbix_host[, ns]]]) tuples.  Items without a clock are all
+    stamped with the same now().  Returns the number of items added.
+
+      >>> import zabbix
+      >>> monitor = zabbix.Sender(
+      ...   zabbix_serv='zabbix.example.org',
+      ...   zabbix_host='client1.example.org',
+      ...   zabbix_time=499162920
+      ...   )
+      >>> monitor.add_items([
+      ...   ('myKey1', '16535'),
+      ...   ('myKey2', '16534', 499162921),
+      ...   {'key': 'myKey1', 'value': '16533', 'zabbix_host': 'client2.example.org'},
+      ...   ('myKey3', '16532', 499162921, None, 500000000),
+      ...   ])
+      4
+      >>> monitor.__list_item__[1]['clock']
+      499162921
+      >>> monitor.__list_item__[3]['ns']
+      500000000
+    """
+    def normalize(item):
+      if isinstance(item, dict):
+        return (
+          item.get('zabbix_host', None),
+          item['key'],
+          item['value'],
+          item.get('clock', None),
+          item.get('ns', None)
+          )
+      item = tuple(item) + (None, None, None)
+      return (item[3], item[0], item[1], item[2], item[4])
+
+    (clock, ns) = self.now()
+    return self.__list_item__.add_items(
+        (normalize(x) for x in items),
+        host=self.zabbix_host,
+        clock=clock,
+        ns=ns
+        )
+
   def send(self, **kwargs):
     """
     This function will determine the proper way to send the values to the
     Zabbix server, or print if 'print_values' is specified.
+
+    Large batches are split into several requests of at most chunk_items
+    items / chunk_bytes bytes (both can be overridden per call), which are
+    sent one after the other over the same pooled connection.  The single
+    (retcode, response) tuple returned for a bulk send combines the counters
+    of every request, see __send_chunked.
+
+    With iterate_values, the items are sent iterate_items at a time instead,
+    and the (retcode, response, items) tuple of every request is returned,
+    see __send_pipelined.
     """
     print_values = kwargs.get('print_values', False)
     iterate_values = kwargs.get('iterate_values', False)
@@ -342,16 +861,10 @@ class Sender(object):
       # return (1, u'No items to send to the server.\n', '')
       return
 
-    retarray = []
-    if not iterate_values:
-      (retcode, retstring) = self.__send(self.__build_object(build='item'))
-      retarray.append((retcode, retstring))
-    else:
-      for item in self.__dict_lld__:
-        (retcode, retstring) = self.__send(self.__build_object(build='item'))
-        retarray.append((retcode, retstring, item))
+    if iterate_values:
+      return self.__send_pipelined(self.__list_item__, **kwargs)
 
-    return retarray
+    return [self.__send_chunked(self.__list_item__, **kwargs)]
 
   def add_lld(self, **kwargs):
     """
@@ -497,7 +1010,9 @@ class Sender(object):
 
   def send_lld(self, **kwargs):
     """
-    This function will send the LLD data to the Zabbix server / proxy.
+    This function will send the LLD data to the Zabbix server / proxy.  Each
+    (host, key) pair is sent as one discovery item, chunked in the same way
+    as the regular items sent by send().
     """
     print_values = kwargs.get('print_values', False)
     iterate_values = kwargs.get('iterate_values', False)
@@ -506,16 +1021,11 @@ class Sender(object):
       self.__print_values('lld')
       return (1, u'No items to send to the server.\n', '')
 
-    retarray = []
-    if not iterate_values:
-      (retcode, retstring) = self.__send(self.__build_object(build='lld'))
-      retarray.append((retcode, retstring))
-    else:
-      for item in self.__dict_lld__:
-        (retcode, retstring) = self.__send(self.__build_object(build='lld'))
-        retarray.append((retcode, retstring, item))
+    lld_items = list(self._lld_items())
+    if iterate_values:
+      return self.__send_pipelined(lld_items, **kwargs)
 
-    return retarray
+    return [self.__send_chunked(lld_items, **kwargs)]
 
 
 if __name__ == '__main__':
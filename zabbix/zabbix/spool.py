@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+A durable, append-only spool for requests that could not be delivered to the
+Zabbix server.
+
+The spool is a directory of numbered segment files.  Every record holds one
+request payload, prefixed with a small header;
+    length   -- (4 bytes) Length of the payload.
+    crc32    -- (4 bytes) CRC32 of the payload.
+    clock    -- (8 bytes) Time, in microseconds, the record was spooled.
+
+Records are only ever appended, so replaying the segments oldest first
+replays them in clock order.  A segment is deleted once every record in it
+has been delivered, and a small cursor file remembers how far into the
+oldest segment a replay got.  The cursor is saved as often as appended
+records are fsync()ed (see fsync_every and fsync_interval), and whenever a
+replay stops; delivery is at least once, and a crash in the middle of a
+replay only sends the records delivered since the last save again.
+
+    >>> import tempfile
+    >>> import zabbix.spool
+    >>> spool = zabbix.spool.Spool(spool_dir=tempfile.mkdtemp())
+    >>> spool.append(b'{"request": "sender data", "data": []}')
+    >>> spool.append(b'{"request": "sender data", "data": []}')
+    >>> spool.stats()['records']
+    2
+    >>> delivered = []
+    >>> spool.replay(lambda payload: delivered.append(payload) or True)['records']
+    2
+    >>> spool.stats()['records']
+    0
+"""
+import glob
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+
+SPOOL_RECORD = struct.Struct('<IIq')
+SPOOL_SUFFIX = '.spool'
+
+
+class Spool(object):
+  """
+  The class object supports the following keyword arguments at instantiation;
+    spool_dir     -- (String) Directory holding the segment files.  It is
+                     created if needed. ** REQUIRED **
+
+    segment_bytes -- (Integer) Size at which a segment is closed and a new one
+                     started.  Defaults to 4194304 (4 MiB).
+
+    max_bytes     -- (Integer) Upper bound for the whole spool.  When it is
+                     exceeded the oldest segments are dropped, and counted as
+                     such.  Defaults to 268435456 (256 MiB).
+
+    fsync_every   -- (Integer) fsync() the current segment after this many
+                     records.  Defaults to 64.
+
+    fsync_interval -- (Number) ... or after this many seconds, whichever
+                     comes first.  Defaults to 1.
+  """
+
+  def __init__(self, **kwargs):
+    self.spool_dir = kwargs['spool_dir']
+    self.segment_bytes = int(kwargs.get('segment_bytes', 4194304))
+    self.max_bytes = int(kwargs.get('max_bytes', 268435456))
+    self.fsync_every = int(kwargs.get('fsync_every', 64))
+    self.fsync_interval = float(kwargs.get('fsync_interval', 1))
+
+    if not os.path.isdir(self.spool_dir):
+      os.makedirs(self.spool_dir)
+
+    self.__lock = threading.RLock()
+    self.__fd = None
+    self.__fd_seq = None
+    self.__fd_size = 0
+    self.__unsynced = 0
+    self.__synced_at = time.time()
+    self.__cursor = self.__read_cursor()
+    self.__counters = {
+      'appended': 0,
+      'dropped': 0,
+      'corrupt': 0,
+      }
+    self.__last_replay = {}
+
+  # Segment bookkeeping
+
+  def __path(self, seq):
+    return os.path.join(self.spool_dir, '{0:016d}{1}'.format(seq, SPOOL_SUFFIX))
+
+  def __segments(self):
+    """
+    Sequence numbers of every segment on disk, oldest first.
+    """
+    retval = []
+    for path in glob.glob(os.path.join(self.spool_dir, '*' + SPOOL_SUFFIX)):
+      name = os.path.basename(path)[:-len(SPOOL_SUFFIX)]
+      if name.isdigit():
+        retval.append(int(name))
+    return sorted(retval)
+
+  def __read_cursor(self):
+    try:
+      with open(os.path.join(self.spool_dir, 'cursor'), 'r') as f:
+        (seq, offset) = f.read().split()
+        return (int(seq), int(offset))
+    except (IOError, OSError, ValueError):
+      return (0, 0)
+
+  def __write_cursor(self):
+    path = os.path.join(self.spool_dir, 'cursor')
+    with open(path + '.tmp', 'w') as f:
+      f.write('{0} {1}\n'.format(*self.__cursor))
+      f.flush()
+      os.fsync(f.fileno())
+    os.rename(path + '.tmp', path)
+
+  def __sync(self):
+    if self.__fd is not None and self.__unsynced:
+      os.fsync(self.__fd)
+    self.__unsynced = 0
+    self.__synced_at = time.time()
+
+  def __seal(self):
+    """
+    Close the segment being written, so it can be replayed.
+    """
+    if self.__fd is not None:
+      self.__sync()
+      os.close(self.__fd)
+      self.__fd = None
+      self.__fd_seq = None
+      self.__fd_size = 0
+
+  def __open_segment(self):
+    segments = self.__segments()
+    seq = segments[-1] + 1 if segments else max(self.__cursor[0], 1)
+    self.__fd = os.open(
+        self.__path(seq),
+        os.O_WRONLY | os.O_CREAT | os.O_APPEND,
+        0o600
+        )
+    self.__fd_seq = seq
+    self.__fd_size = 0
+
+  def __enforce_limit(self):
+    """
+    Drop the oldest sealed segments until the spool fits in max_bytes.
+    """
+    segments = [x for x in self.__segments() if x != self.__fd_seq]
+    total = self.__size()
+    while segments and total > self.max_bytes:
+      seq = segments.pop(0)
+      path = self.__path(seq)
+      size = os.path.getsize(path)
+      records = sum(1 for _ in self.__iter_segment(seq, 0))
+      os.unlink(path)
+      total -= size
+      self.__counters['dropped'] += records
+      logging.warning(
+          'Spool over %d bytes, dropped %d records from segment %d',
+          self.max_bytes,
+          records,
+          seq
+          )
+
+  def __size(self):
+    return sum(os.path.getsize(self.__path(x)) for x in self.__segments())
+
+  def __iter_segment(self, seq, offset):
+    """
+    Yield (payload, next_offset, clock) for every record of a segment from
+    offset onward.  A truncated record, left behind by a crash in the middle
+    of a write, ends the segment.
+    """
+    with open(self.__path(seq), 'rb') as f:
+      f.seek(offset)
+      while True:
+        header = f.read(SPOOL_RECORD.size)
+        if len(header) < SPOOL_RECORD.size:
+          return
+        (length, crc, clock) = SPOOL_RECORD.unpack(header)
+        payload = f.read(length)
+        if len(payload) < length:
+          return
+        offset += SPOOL_RECORD.size + length
+        if zlib.crc32(payload) & 0xffffffff != crc:
+          self.__counters['corrupt'] += 1
+          continue
+        yield payload, offset, clock
+
+  # Public interface
+
+  def append(self, payload, clock=None):
+    """
+    Append one payload (str or any bytes-like object) to the spool.
+    """
+    if not isinstance(payload, (bytes, bytearray, memoryview)):
+      payload = payload.encode('utf-8')
+    if clock is None:
+      clock = time.time()
+
+    record = SPOOL_RECORD.pack(
+        len(payload),
+        zlib.crc32(payload) & 0xffffffff,
+        int(clock * 1000000)
+        ) + payload
+
+    with self.__lock:
+      if self.__fd is not None and self.__fd_size + len(record) > self.segment_bytes:
+        self.__seal()
+        self.__enforce_limit()
+      if self.__fd is None:
+        self.__open_segment()
+
+      os.write(self.__fd, record)
+      self.__fd_size += len(record)
+      self.__unsynced += 1
+      self.__counters['appended'] += 1
+
+      if self.__unsynced >= self.fsync_every or \
+          time.time() - self.__synced_at >= self.fsync_interval:
+        self.__sync()
+
+  def flush(self):
+    """
+    fsync() whatever has been appended so far.
+    """
+    with self.__lock:
+      self.__sync()
+
+  def replay(self, handler):
+    """
+    Hand every spooled payload, oldest first, to handler(payload).  The
+    handler returns True once the payload has been delivered; the first
+    False stops the replay, leaving that payload and everything after it in
+    the spool.  Only one record is held in memory at a time, however large
+    the spool has grown.
+
+    Returns the replay statistics; records, bytes, seconds, records_per_sec,
+    bytes_per_sec and whether the spool was drained ('complete').
+    """
+    started = time.time()
+    retval = {
+      'records': 0,
+      'bytes': 0,
+      'complete': True,
+      }
+
+    with self.__lock:
+      self.__seal()
+      unsaved = 0
+      saved_at = time.time()
+      try:
+        for seq in self.__segments():
+          offset = self.__cursor[1] if self.__cursor[0] == seq else 0
+          for (payload, next_offset, _) in self.__iter_segment(seq, offset):
+            if not handler(payload):
+              retval['complete'] = False
+              break
+            self.__cursor = (seq, next_offset)
+            retval['records'] += 1
+            retval['bytes'] += len(payload)
+
+            unsaved += 1
+            if unsaved >= self.fsync_every or \
+                time.time() - saved_at >= self.fsync_interval:
+              self.__write_cursor()
+              unsaved = 0
+              saved_at = time.time()
+
+          if not retval['complete']:
+            break
+          os.unlink(self.__path(seq))
+          self.__cursor = (seq + 1, 0)
+      finally:
+        # Also when the handler raised, so what was delivered stays delivered.
+        if retval['records']:
+          self.__write_cursor()
+
+    retval['seconds'] = time.time() - started
+    retval['records_per_sec'] = retval['records'] / max(retval['seconds'], 1e-9)
+    retval['bytes_per_sec'] = retval['bytes'] / max(retval['seconds'], 1e-9)
+    if retval['records']:
+      logging.info(
+          'Replayed %d spooled records (%d bytes) at %.1f records/s',
+          retval['records'],
+          retval['bytes'],
+          retval['records_per_sec']
+          )
+    self.__last_replay = retval
+    return retval
+
+  def stats(self):
+    """
+    Return the spool counters; records and bytes currently spooled, the
+    number of segments, records appended / dropped (over max_bytes) /
+    corrupt since instantiation, and the statistics of the last replay.
+    """
+    with self.__lock:
+      segments = self.__segments()
+      records = 0
+      for seq in segments:
+        offset = self.__cursor[1] if self.__cursor[0] == seq else 0
+        records += sum(1 for _ in self.__iter_segment(seq, offset))
+
+      retval = dict(self.__counters)
+      retval['records'] = records
+      retval['bytes'] = self.__size()
+      retval['segments'] = len(segments)
+      retval['last_replay'] = dict(self.__last_replay)
+    return retval
+
+  def pending(self):
+    """
+    Cheap check for anything left to replay.
+    """
+    with self.__lock:
+      return self.__fd is not None or bool(self.__segments())
+
+  def close(self):
+    with self.__lock:
+      self.__seal()
+
+
+if __name__ == '__main__':
+  import doctest
+  doctest.testmod()
@@ -0,0 +1,507 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Local fakes of a Zabbix trapper, of agents and of the API frontend, for the
+doctests of this package and for the benchmarks in bench/.  They implement
+just enough of each protocol to be talked to by the real clients; nothing
+here is meant to be used in production.
+"""
+import json
+import queue
+import random
+import socket
+import socketserver
+import threading
+import time
+
+from zabbix import protocol
+
+
+class FakeTrapper(object):
+  """
+  A minimal threaded Zabbix trapper.  It accepts 'sender data' requests,
+  answers every one of them with a success response (compressed when the
+  request was), and counts the bytes it saw on the wire.  'active checks'
+  requests are answered from the active_checks argument.
+
+  The class object supports the following keyword arguments at instantiation;
+    keep_open     -- (Boolean) Keep the connection open after a response,
+                     instead of closing it like a stock Zabbix trapper does.
+                     Defaults to True.
+
+    link_mbps     -- (Number) Simulate a link of this many megabits per second
+                     by delaying every request by its size on the wire.
+                     Defaults to 0 (no delay).
+
+    rtt_ms        -- (Number) Simulate a network round trip of this many
+                     milliseconds by holding every response back for that
+                     long, while the requests that follow are read and
+                     answered as usual.  Defaults to 0 (no delay).
+
+    active_checks -- (Dictionary) The active checks of every known host, as
+                     lists of {'key': ..., 'delay': ...} dicts.  The list is
+                     left out of the response when the agent already has its
+                     config_revision.  Defaults to no hosts.
+
+      >>> import zabbix.tools._fakes
+      >>> trapper = zabbix.tools._fakes.FakeTrapper()
+      >>> (host, port) = trapper.start()
+      >>> trapper.stop()
+  """
+
+  def __init__(self, **kwargs):
+    self.keep_open = kwargs.get('keep_open', True)
+    self.link_mbps = float(kwargs.get('link_mbps', 0))
+    self.rtt_ms = float(kwargs.get('rtt_ms', 0))
+    self.active_checks = kwargs.get('active_checks', {})
+    self.config_revision = 1
+    self.bytes_in = 0
+    self.bytes_out = 0
+    self.requests = 0
+    self.items = 0
+    self.__lock = threading.Lock()
+    self.__server = None
+
+  def __delayed_writer(self, sock, responses):
+    while True:
+      (due, response) = responses.get()
+      if response is None:
+        return
+      time.sleep(max(due - time.time(), 0))
+      try:
+        sock.sendall(response)
+      except socket.error:
+        return
+
+  def __handle(self, sock):
+    responses = None
+    if self.rtt_ms:
+      responses = queue.Queue()
+      writer = threading.Thread(target=self.__delayed_writer, args=(sock, responses))
+      writer.daemon = True
+      writer.start()
+
+    try:
+      self.__serve(sock, responses)
+    finally:
+      if responses is not None:
+        responses.put((0, None))
+        writer.join()
+
+  def __serve(self, sock, responses):
+    while True:
+      try:
+        header = protocol.recv_exact(sock, protocol.ZBX_HEADER_LEN)
+      except (protocol.ProtocolError, socket.error):
+        return
+      (signature, flags, datalen, reserved) = protocol.ZBX_HEADER.unpack(header)
+      data = protocol.recv_exact(sock, datalen)
+      request = json.loads(protocol.unpack(header + data).decode('utf-8'))
+
+      if self.link_mbps:
+        time.sleep((len(header) + len(data)) * 8 / (self.link_mbps * 1e6))
+
+      items = len(request.get('data') or [])
+      if request.get('request') == 'active checks':
+        response = self.__active_checks(request)
+      else:
+        response = {
+          'response': 'success',
+          'info': 'processed: {0}; failed: 0; total: {0}; seconds spent: 0.000010'.format(items)
+          }
+      response = protocol.pack(
+          json.dumps(response),
+          compress_threshold=0 if flags & protocol.ZBX_FLAG_COMPRESS else None
+          )
+      if responses is None:
+        sock.sendall(response)
+      else:
+        responses.put((time.time() + self.rtt_ms / 1000.0, response))
+
+      with self.__lock:
+        self.bytes_in += len(header) + len(data)
+        self.bytes_out += len(response)
+        self.requests += 1
+        self.items += items
+
+      if not self.keep_open:
+        return
+
+  def __active_checks(self, request):
+    host = request.get('host')
+    if host not in self.active_checks:
+      return {'response': 'failed', 'info': 'host [{0}] not found'.format(host)}
+    response = {'response': 'success', 'config_revision': self.config_revision}
+    if request.get('config_revision') != self.config_revision:
+      response['data'] = self.active_checks[host]
+    return response
+
+  def start(self):
+    """
+    Start listening on a random local port and return (host, port).
+    """
+    handle_request = self.__handle
+
+    class Handler(socketserver.BaseRequestHandler):
+      def handle(self):
+        handle_request(self.request)
+
+    socketserver.ThreadingTCPServer.allow_reuse_address = True
+    self.__server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), Handler)
+    self.__server.daemon_threads = True
+    thread = threading.Thread(target=self.__server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return self.__server.server_address
+
+  def stop(self):
+    self.__server.shutdown()
+    self.__server.server_close()
+
+  def reset(self):
+    with self.__lock:
+      self.bytes_in = self.bytes_out = self.requests = self.items = 0
+
+
+class FakeAgent(object):
+  """
+  A pool of minimal Zabbix agents, all served by one asyncio event loop
+  running in a thread of its own.  Every agent answers agent.ping and
+  system.uptime, echoes the parameter of echo[<value>], and reports every
+  other key as not supported.
+
+  The class object supports the following keyword arguments at instantiation;
+    agents        -- (Integer) Number of agents, each listening on a port of
+                     its own.  Defaults to 10.
+
+    delay_ms      -- (Number) Milliseconds every agent takes to answer.
+                     Defaults to 0.
+
+      >>> import zabbix.get
+      >>> import zabbix.tools._fakes
+      >>> agents = zabbix.tools._fakes.FakeAgent(agents=2)
+      >>> addresses = agents.start()
+      >>> zabbix.get.query_agent(query_host=addresses[0][0], query_port=addresses[0][1])
+      (0, 1)
+      >>> sorted(x.value for x in zabbix.get.poll_agents(addresses, keys=['echo[x]']))
+      ['x', 'x']
+      >>> agents.stop()
+  """
+
+  def __init__(self, **kwargs):
+    self.agents = int(kwargs.get('agents', 10))
+    self.delay_ms = float(kwargs.get('delay_ms', 0))
+    self.requests = 0
+    self.__loop = None
+    self.__servers = []
+    self.__started = time.time()
+
+  def __answer(self, key):
+    if key == 'agent.ping':
+      return b'1'
+    if key == 'system.uptime':
+      return str(int(time.time() - self.__started)).encode('ascii')
+    if key.startswith('echo[') and key.endswith(']'):
+      return key[5:-1].encode('utf-8')
+    return b'ZBX_NOTSUPPORTED\x00Unsupported item key.'
+
+  async def __handle(self, reader, writer):
+    import asyncio
+
+    try:
+      key = (await protocol.read_packet_async(reader)).decode('utf-8').strip()
+      if self.delay_ms:
+        await asyncio.sleep(self.delay_ms / 1000.0)
+      writer.write(protocol.pack(self.__answer(key)))
+      await writer.drain()
+      self.requests += 1
+    except (protocol.ProtocolError, socket.error):
+      pass
+    finally:
+      writer.close()
+
+  def start(self):
+    """
+    Start the agents on random local ports and return their (host, port)
+    addresses.
+    """
+    import asyncio
+
+    started = threading.Event()
+    handle = self.__handle
+
+    async def serve():
+      for _ in range(self.agents):
+        self.__servers.append(await asyncio.start_server(handle, '127.0.0.1', 0, backlog=1024))
+      started.set()
+
+    def run():
+      self.__loop = asyncio.new_event_loop()
+      self.__loop.run_until_complete(serve())
+      self.__loop.run_forever()
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    started.wait()
+    return [x.sockets[0].getsockname()[:2] for x in self.__servers]
+
+  def stop(self):
+    def shutdown():
+      for server in self.__servers:
+        server.close()
+      self.__loop.stop()
+    self.__loop.call_soon_threadsafe(shutdown)
+
+
+class FakeFrontend(object):
+  """
+  A minimal threaded Zabbix frontend, answering JSON-RPC requests over
+  HTTP/1.1 with keep-alive.  It knows apiinfo.version, user.login /
+  user.logout, <object>.get, returning the objects it was handed (see __get
+  for the parameters it honours), and <object>.create / update / delete on
+  the same objects;  every other method is reported as not found.  JSON-RPC
+  batches are answered call by call, in reverse order.
+
+  The class object supports the following keyword arguments at instantiation;
+    objects       -- (Dictionary) The objects of every type, e.g.
+                     {'host': [{'hostid': '10084', 'host': 'Zabbix server'}]}.
+                     Defaults to none.
+
+    users         -- (Dictionary) User name to password.  Defaults to the
+                     stock Admin / zabbix.
+
+    version       -- (String) The API version reported.  Defaults to 6.0.0.
+
+    delay_ms      -- (Number) Milliseconds every HTTP request takes, batch or
+                     not.  Defaults to 0.
+
+    tokens        -- (List) API tokens accepted as sessions.  Defaults to
+                     none.
+
+  Like Zabbix 7.2 and later, a frontend of version 7.2 or later refuses the
+  'auth' member of requests.  The session of the last request, from the
+  Authorization header and from the 'auth' member, is kept in last_auth.
+
+      >>> import zabbix.tools._fakes
+      >>> frontend = zabbix.tools._fakes.FakeFrontend()
+      >>> url = frontend.start()
+      >>> frontend.stop()
+  """
+
+  def __init__(self, **kwargs):
+    self.objects = kwargs.get('objects', {})
+    self.users = kwargs.get('users', {'Admin': 'zabbix'})
+    self.version = kwargs.get('version', '6.0.0')
+    self.delay_ms = float(kwargs.get('delay_ms', 0))
+    self.sessions = set(kwargs.get('tokens', []))
+    self.last_auth = (None, None)
+    self.requests = 0
+    self.batches = 0
+    self.connections = 0
+    self.__lock = threading.Lock()
+    self.__next_ids = {}
+    self.__server = None
+
+  def expire_sessions(self):
+    """
+    Log every user out, as a frontend restart or session timeout does.
+    """
+    with self.__lock:
+      self.sessions.clear()
+
+  def __login(self, params):
+    user = params.get('username', params.get('user', None))
+    if user not in self.users or self.users[user] != params.get('password', None):
+      raise ValueError(-32500, 'Application error.', 'Incorrect user name or password or account is temporarily blocked.')
+    session = '{0:032x}'.format(random.getrandbits(128))
+    with self.__lock:
+      self.sessions.add(session)
+    return session
+
+  @staticmethod
+  def __get(rows, params):
+    """
+    The subset of <object>.get the client relies on:  <field>ids filters,
+    exact match filters, time_from / time_till on clock, sortfield /
+    sortorder on numeric fields, limit and output.
+    """
+    for (name, value) in params.get('filter', {}).items():
+      wanted = set(str(x) for x in (value if isinstance(value, list) else [value]))
+      rows = [x for x in rows if str(x.get(name, None)) in wanted]
+    for (name, value) in params.items():
+      if name.endswith('ids') and value is not None:
+        wanted = set(str(x) for x in (value if isinstance(value, list) else [value]))
+        rows = [x for x in rows if str(x.get(name[:-1], None)) in wanted]
+    if params.get('time_from', None) is not None:
+      rows = [x for x in rows if int(x['clock']) >= int(params['time_from'])]
+    if params.get('time_till', None) is not None:
+      rows = [x for x in rows if int(x['clock']) <= int(params['time_till'])]
+
+    sortfield = params.get('sortfield', None)
+    if sortfield:
+      fields = sortfield if isinstance(sortfield, list) else [sortfield]
+      rows = sorted(
+          rows,
+          key=lambda x: [int(x[y]) for y in fields],
+          reverse=params.get('sortorder', 'ASC') == 'DESC'
+          )
+    if params.get('limit', None):
+      rows = rows[:int(params['limit'])]
+
+    output = params.get('output', 'extend')
+    if isinstance(output, list):
+      rows = [dict((x, row[x]) for x in output if x in row) for row in rows]
+    return list(rows)
+
+  def __write(self, object_type, action, params):
+    """
+    <object>.create / update / delete, answered like the frontend does with
+    {'<field>ids': [...]}.  Created objects get ids counting up from the
+    highest one in use.
+    """
+    import zabbix.api
+
+    field = zabbix.api.id_field(object_type)
+    rows = self.objects[object_type]
+    params = params if isinstance(params, list) else [params]
+    if action == 'create':
+      if object_type not in self.__next_ids:
+        self.__next_ids[object_type] = max([int(x[field]) for x in rows] + [10000]) + 1
+      next_id = self.__next_ids[object_type]
+      self.__next_ids[object_type] += len(params)
+      created = [dict(x, **{field: str(next_id + index)}) for (index, x) in enumerate(params)]
+      rows.extend(created)
+      return {field + 's': [x[field] for x in created]}
+
+    existing = dict((x[field], x) for x in rows)
+    ids = [str(x[field]) if action == 'update' else str(x) for x in params]
+    if any(x not in existing for x in ids):
+      raise ValueError(-32500, 'Application error.', 'No permissions to referred object or it does not exist!')
+    if action == 'update':
+      for (objectid, changes) in zip(ids, params):
+        existing[objectid].update((x, y) for (x, y) in changes.items() if x != field)
+    else:
+      self.objects[object_type] = [x for x in rows if x[field] not in set(ids)]
+    return {field + 's': ids}
+
+  def call(self, method, params, auth):
+    """
+    The result of one call, or ValueError(code, message, data).
+    """
+    if method == 'apiinfo.version':
+      return self.version
+    if method == 'user.login':
+      return self.__login(params)
+
+    with self.__lock:
+      if auth not in self.sessions:
+        raise ValueError(-32602, 'Invalid params.', 'Session terminated, re-login, please.')
+      if method == 'user.logout':
+        self.sessions.discard(auth)
+        return True
+
+    (object_type, _, action) = method.partition('.')
+    if action == 'get' and object_type in self.objects:
+      return self.__get(self.objects[object_type], params)
+    if action in ('create', 'update', 'delete') and object_type in self.objects:
+      with self.__lock:
+        return self.__write(object_type, action, params)
+    raise ValueError(-32601, 'Method not found.', 'Incorrect API "{0}".'.format(object_type))
+
+  def __answer_batch(self, requests, auth):
+    if not requests:
+      return {
+        'jsonrpc': '2.0',
+        'error': {'code': -32600, 'message': 'Invalid request.', 'data': 'Empty batch.'},
+        'id': None
+        }
+    with self.__lock:
+      self.batches += 1
+    return [self.__answer(x, auth) for x in reversed(requests)]
+
+  def __connected(self):
+    with self.__lock:
+      self.connections += 1
+
+  def __answer(self, request, auth):
+    with self.__lock:
+      self.requests += 1
+      self.last_auth = (auth, request.get('auth', None))
+
+    response = {'jsonrpc': '2.0', 'id': request.get('id', None)}
+    try:
+      version = tuple(int(x) for x in self.version.split('.')[:2])
+      if 'auth' in request and version >= (7, 2):
+        raise ValueError(-32602, 'Invalid params.', 'Invalid parameter "/": unexpected parameter "auth".')
+      response['result'] = self.call(
+          request.get('method', None),
+          request.get('params', {}),
+          request.get('auth', auth)
+          )
+    except ValueError as err:
+      (code, message, data) = err.args
+      response['error'] = {'code': code, 'message': message, 'data': data}
+    return response
+
+  def start(self):
+    """
+    Start listening on a random local port and return the API URL.
+    """
+    import http.server
+
+    answer = self.__answer
+    answer_batch = self.__answer_batch
+    frontend_delay = self.delay_ms / 1000.0
+    connected = self.__connected
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+      protocol_version = 'HTTP/1.1'
+
+      def setup(self):
+        http.server.BaseHTTPRequestHandler.setup(self)
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        connected()
+
+      def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        auth = self.headers.get('Authorization', '')[len('Bearer '):] or None
+        try:
+          if frontend_delay:
+            time.sleep(frontend_delay)
+          request = json.loads(body.decode('utf-8'))
+          if isinstance(request, list):
+            response = answer_batch(request, auth)
+          else:
+            response = answer(request, auth)
+        except ValueError:
+          response = {
+            'jsonrpc': '2.0',
+            'error': {'code': -32700, 'message': 'Parse error.', 'data': 'Invalid JSON.'},
+            'id': None
+            }
+        data = json.dumps(response).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+      def log_message(self, *args):
+        pass
+
+    self.__server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    self.__server.daemon_threads = True
+    thread = threading.Thread(target=self.__server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return 'http://{0}:{1}/api_jsonrpc.php'.format(*self.__server.server_address)
+
+  def stop(self):
+    self.__server.shutdown()
+    self.__server.server_close()
+
+
+if __name__ == '__main__':
+  import doctest
+  doctest.testmod()
@@ -0,0 +1,506 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Bulk export of item history and trends through the Zabbix API.
+
+The time range is cut into partitions, and the items into groups of the
+same value type;  every (partition, group) pair is a part, fetched by one
+of several threads with ZabbixAPI.pages() and streamed into files of its
+own, so memory use depends on the page size only.  A part is written under
+a temporary name and renamed once complete, then recorded in the
+checkpoint file of the output directory, along with the settings of the
+export;  an interrupted export started again with the same settings skips
+the parts already recorded, and one with other settings is refused.
+
+Parts are written as CSV, or column by column as raw arrays ('bin') or
+NumPy .npy files ('npy'), 8 bytes per value.  Both binary formats are
+written with the array module, NumPy is only needed to read .npy files
+back, and load_column() reads either without it;
+    >>> import tempfile
+    >>> import zabbix.api
+    >>> import zabbix.tools._fakes
+    >>> import zabbix.tools.history_export
+    >>> frontend = zabbix.tools._fakes.FakeFrontend(objects={
+    ...   'item': [
+    ...     {'itemid': '23296', 'value_type': '0'},
+    ...     {'itemid': '23297', 'value_type': '3'},
+    ...     ],
+    ...   'history': [
+    ...     {'itemid': str(23296 + x % 2), 'clock': str(1700000000 + 600 * x), 'ns': '0', 'value': str(x)}
+    ...     for x in range(12)
+    ...     ],
+    ...   })
+    >>> api = zabbix.api.ZabbixAPI(zabbix_url=frontend.start(), zabbix_user='Admin')
+    >>> export = zabbix.tools.history_export.HistoryExport(
+    ...   api,
+    ...   output_dir=tempfile.mkdtemp(),
+    ...   time_from=1700000000,
+    ...   time_till=1700007199,
+    ...   partition=3600,
+    ...   fmt='npy',
+    ...   )
+    >>> [x.name for x in export.plan(['23296', '23297'])]
+    ['history-0-1700000000-0000', 'history-3-1700000000-0000', 'history-0-1700003600-0000', 'history-3-1700003600-0000']
+    >>> summary = export.run(['23296', '23297'])
+    >>> summary['parts'], summary['resumed'], summary['rows']
+    (4, 0, 12)
+    >>> import os
+    >>> zabbix.tools.history_export.load_column(
+    ...   os.path.join(export.output_dir, 'history-0-1700000000-0000.value.npy'))
+    array('d', [0.0, 2.0, 4.0])
+    >>> summary = export.run(['23296', '23297'])
+    >>> summary['parts'], summary['resumed'], summary['rows']
+    (0, 4, 0)
+    >>> export.run(['23296']) #doctest: +ELLIPSIS
+    Traceback (most recent call last):
+    ...
+    zabbix.tools.history_export.CheckpointError: ... holds an export with other settings (differing: itemids), use another output directory
+    >>> frontend.stop()
+"""
+import array
+import ast
+import collections
+import concurrent.futures
+import csv
+import datetime
+import json
+import os
+import struct
+import sys
+import threading
+import time
+
+CHECKPOINT = 'checkpoint.json'
+FORMATS = ('csv', 'bin', 'npy')
+
+HISTORY_COLUMNS = ('itemid', 'clock', 'ns', 'value')
+TREND_COLUMNS = ('itemid', 'clock', 'num', 'value_min', 'value_avg', 'value_max')
+
+# Array type of the value columns of the numeric value types (float and
+# unsigned);  every other column is a signed 64 bit integer.
+NUMERIC_TYPES = {0: 'd', 3: 'Q'}
+
+# NumPy dtype of every array type, and the size the .npy header is padded
+# to, so it can be rewritten with the final length in place.
+NPY_DTYPES = {'d': 'f8', 'q': 'i8', 'Q': 'u8'}
+NPY_HEADER_SIZE = 128
+NPY_MAGIC = b'\x93NUMPY\x01\x00'
+
+Part = collections.namedtuple('Part', ('name', 'value_type', 'itemids', 'time_from', 'time_till'))
+Part.__doc__ = """
+One unit of work of an export:  the rows of itemids, all of value_type,
+between time_from and time_till (both included).
+"""
+
+
+class CheckpointError(ValueError):
+  """
+  The output directory holds the checkpoint of an export with other
+  settings.
+  """
+  pass
+
+
+def parse_time(value):
+  """
+  A UNIX timestamp, or an ISO 8601 date or date and time in local time, as
+  a timestamp.
+
+    >>> parse_time('1700000000')
+    1700000000
+  """
+  try:
+    return int(value)
+  except ValueError:
+    return int(time.mktime(datetime.datetime.fromisoformat(value).timetuple()))
+
+
+def npy_header(typecode, length):
+  """
+  The .npy (version 1.0) header of a one dimensional array, padded to
+  NPY_HEADER_SIZE bytes.
+  """
+  order = '<' if sys.byteorder == 'little' else '>'
+  header = "{{'descr': '{0}{1}', 'fortran_order': False, 'shape': ({2},), }}".format(
+      order, NPY_DTYPES[typecode], length)
+  header = header.ljust(NPY_HEADER_SIZE - len(NPY_MAGIC) - 3) + '\n'
+  return NPY_MAGIC + struct.pack('<H', len(header)) + header.encode('latin-1')
+
+
+def load_column(path, typecode=None):
+  """
+  Read a column written by a 'bin' or 'npy' export back into an array;  the
+  type of a 'bin' column is recorded in the checkpoint file.
+  """
+  with open(path, 'rb') as f:
+    data = f.read()
+  if data.startswith(NPY_MAGIC):
+    (length,) = struct.unpack('<H', data[8:10])
+    header = ast.literal_eval(data[10:10 + length].decode('latin-1'))
+    typecode = dict((y, x) for (x, y) in NPY_DTYPES.items())[header['descr'][1:]]
+    data = data[10 + length:]
+  column = array.array(typecode)
+  column.frombytes(data)
+  return column
+
+
+class CSVWriter(object):
+  """
+  Writes the rows of a part to <name>.csv, with a header line.
+  """
+
+  def __init__(self, path, columns, value_type):
+    self.columns = columns
+    self.paths = {path + '.csv': path + '.csv.tmp'}
+    self.__file = open(path + '.csv.tmp', 'w', newline='')
+    self.__writer = csv.writer(self.__file)
+    self.__writer.writerow(columns)
+
+  def write(self, rows):
+    columns = self.columns
+    self.__writer.writerows([row.get(x, '') for x in columns] for row in rows)
+
+  def close(self):
+    self.__file.close()
+
+  def types(self):
+    return {}
+
+
+class ArrayWriter(object):
+  """
+  Writes the rows of a part column by column, to <name>.<column>.bin, or
+  .npy files when npy is set.  Every page is converted into one array per
+  column and appended to its file.
+  """
+
+  def __init__(self, path, columns, value_type, npy=False):
+    self.columns = columns
+    self.npy = npy
+    self.typecodes = [
+      NUMERIC_TYPES[value_type] if x.startswith('value') else 'q'
+      for x in columns
+      ]
+    self.paths = collections.OrderedDict()
+    self.__files = []
+    self.__length = 0
+    for (column, typecode) in zip(columns, self.typecodes):
+      final = '{0}.{1}.{2}'.format(path, column, 'npy' if npy else 'bin')
+      self.paths[final] = final + '.tmp'
+      f = open(final + '.tmp', 'wb')
+      if npy:
+        f.write(npy_header(typecode, 0))
+      self.__files.append(f)
+
+  def write(self, rows):
+    for (column, typecode, f) in zip(self.columns, self.typecodes, self.__files):
+      convert = float if typecode == 'd' else int
+      array.array(typecode, [convert(row[column]) for row in rows]).tofile(f)
+    self.__length += len(rows)
+
+  def close(self):
+    for (typecode, f) in zip(self.typecodes, self.__files):
+      if self.npy:
+        f.seek(0)
+        f.write(npy_header(typecode, self.__length))
+      f.close()
+
+  def types(self):
+    return dict(zip(self.columns, self.typecodes))
+
+
+WRITERS = {
+  'csv': CSVWriter,
+  'bin': ArrayWriter,
+  'npy': lambda path, columns, value_type: ArrayWriter(path, columns, value_type, npy=True),
+  }
+
+
+class HistoryExport(object):
+  """
+  Export the history or trends of items with a ZabbixAPI client.
+
+  The class object supports the following keyword arguments at instantiation;
+    output_dir    -- (String) Directory the parts and the checkpoint file
+                     are written to.  Defaults to the current directory.
+
+    time_from     -- (Integer) First second exported.  Defaults to a day
+                     ago.
+
+    time_till     -- (Integer) Last second exported.  Defaults to now.
+
+    trends        -- (Boolean) Export trends rather than history.  Defaults
+                     to False.
+
+    fmt           -- (String) One of 'csv', 'bin' or 'npy'.  The binary
+                     formats take numeric items only.  Defaults to csv.
+
+    partition     -- (Integer) Seconds of every part.  Defaults to a day.
+
+    items_per_part -- (Integer) Items of every part.  Defaults to 100.
+
+    workers       -- (Integer) Parts fetched at once.  Defaults to 4.
+
+    page_size     -- (Integer) Rows asked for per request.  Defaults to
+                     10000.
+
+    verbose       -- (Boolean) Report every finished part on stderr.
+                     Defaults to False.
+  """
+
+  def __init__(self, api, **kwargs):
+    now = int(time.time())
+    self.api = api
+    self.output_dir = kwargs.get('output_dir', '.')
+    self.time_from = int(kwargs.get('time_from', now - 86400))
+    self.time_till = int(kwargs.get('time_till', now))
+    self.trends = bool(kwargs.get('trends', False))
+    self.fmt = kwargs.get('fmt', 'csv')
+    self.partition = int(kwargs.get('partition', 86400))
+    self.items_per_part = int(kwargs.get('items_per_part', 100))
+    self.workers = int(kwargs.get('workers', 4))
+    self.page_size = int(kwargs.get('page_size', 10000))
+    self.verbose = kwargs.get('verbose', False)
+
+    if self.fmt not in FORMATS:
+      raise ValueError('Unknown format {0!r}, expected one of {1}'.format(self.fmt, ', '.join(FORMATS)))
+    if not os.path.isdir(self.output_dir):
+      os.makedirs(self.output_dir)
+
+    self.kind = 'trend' if self.trends else 'history'
+    self.columns = TREND_COLUMNS if self.trends else HISTORY_COLUMNS
+    self.checkpoint = os.path.join(self.output_dir, CHECKPOINT)
+    self.__lock = threading.Lock()
+
+  def value_types(self, itemids):
+    """
+    Ask for the value type of every item, and return an {itemid: type}
+    dict.
+    """
+    items = self.api.request('item.get', {
+      'itemids': list(itemids),
+      'output': ['itemid', 'value_type'],
+      'webitems': True,
+      })
+    return dict((x['itemid'], int(x['value_type'])) for x in items)
+
+  def plan(self, itemids):
+    """
+    Return the parts of an export, partition by partition.  Items whose
+    value type the format can not hold, e.g. text in a binary format or
+    in trends, are left out.
+    """
+    value_types = self.value_types(itemids)
+    groups = collections.defaultdict(list)
+    for itemid in sorted(value_types, key=int):
+      value_type = value_types[itemid]
+      if value_type in NUMERIC_TYPES or (self.fmt == 'csv' and not self.trends):
+        groups[value_type].append(itemid)
+
+    parts = []
+    for start in range(self.time_from, self.time_till + 1, self.partition):
+      end = min(start + self.partition - 1, self.time_till)
+      for value_type in sorted(groups):
+        members = groups[value_type]
+        for (index, offset) in enumerate(range(0, len(members), self.items_per_part)):
+          parts.append(Part(
+              '{0}-{1}-{2}-{3:04d}'.format(self.kind, value_type, start, index),
+              value_type,
+              members[offset:offset + self.items_per_part],
+              start,
+              end
+              ))
+    return parts
+
+  def settings(self, itemids):
+    """
+    The settings that decide the parts of an export and their content, as
+    recorded in the checkpoint file.
+    """
+    return {
+      'kind': self.kind,
+      'format': self.fmt,
+      'itemids': sorted(set(u'{0}'.format(x) for x in itemids), key=int),
+      'time_from': self.time_from,
+      'time_till': self.time_till,
+      'partition': self.partition,
+      'items_per_part': self.items_per_part,
+      }
+
+  def done(self, itemids):
+    """
+    The parts recorded in the checkpoint file, as a {name: details} dict.
+    Raises CheckpointError when the file belongs to an export with other
+    settings, whose parts may hold other data under the same names.
+    """
+    try:
+      with open(self.checkpoint, 'r') as f:
+        checkpoint = json.load(f)
+    except (IOError, OSError, ValueError):
+      return {}
+
+    recorded = checkpoint.get('export', {})
+    settings = self.settings(itemids)
+    differ = sorted(x for x in settings if recorded.get(x, None) != settings[x])
+    if differ:
+      raise CheckpointError('{0} holds an export with other settings (differing: {1}), use another output directory'.format(
+          self.checkpoint, ', '.join(differ)))
+    return checkpoint.get('parts', {})
+
+  def __record(self, settings, done, part, details):
+    """
+    Add a finished part to the checkpoint file, replacing it atomically.
+    """
+    with self.__lock:
+      done[part.name] = details
+      temp_path = self.checkpoint + '.tmp'
+      with open(temp_path, 'w') as f:
+        json.dump({
+          'export': settings,
+          'columns': self.columns,
+          'parts': done,
+          }, f, indent=1, sort_keys=True)
+      os.rename(temp_path, self.checkpoint)
+
+  def export_part(self, part):
+    """
+    Fetch and write one part, and return the number of rows written.
+    """
+    params = {
+      'itemids': part.itemids,
+      'time_from': part.time_from,
+      'time_till': part.time_till,
+      }
+    if self.trends:
+      params['output'] = list(self.columns)
+    else:
+      params['history'] = part.value_type
+      params['output'] = 'extend'
+
+    writer = WRITERS[self.fmt](os.path.join(self.output_dir, part.name), self.columns, part.value_type)
+    rows = 0
+    try:
+      for page in self.api.pages(self.kind + '.get', params, page_size=self.page_size):
+        writer.write(page)
+        rows += len(page)
+    finally:
+      writer.close()
+    for (final, temp_path) in writer.paths.items():
+      os.rename(temp_path, final)
+    return rows, writer.types()
+
+  def run(self, itemids):
+    """
+    Export every part not recorded in the checkpoint file yet, workers at a
+    time, and return a summary dict:  the parts exported and resumed, the
+    rows written, the seconds taken and the rows per second.  A part that
+    fails is raised once the others are done, and CheckpointError when the
+    output directory holds an export with other settings.
+    """
+    started = time.time()
+    itemids = list(itemids)
+    settings = self.settings(itemids)
+    done = self.done(itemids)
+    planned = self.plan(itemids)
+    parts = [x for x in planned if x.name not in done]
+    summary = {'parts': 0, 'resumed': len(planned) - len(parts), 'rows': 0}
+
+    def run_part(part):
+      part_started = time.time()
+      (rows, types) = self.export_part(part)
+      details = {'rows': rows, 'seconds': round(time.time() - part_started, 3)}
+      if types:
+        details['types'] = types
+      self.__record(settings, done, part, details)
+      with self.__lock:
+        summary['parts'] += 1
+        summary['rows'] += rows
+        if self.verbose:
+          elapsed = time.time() - started
+          sys.stderr.write('{0}: {1} rows, {2}/{3} parts, {4:.0f} rows/s\n'.format(
+              part.name, rows, summary['parts'], len(parts), summary['rows'] / max(elapsed, 1e-6)))
+      return rows
+
+    errors = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+      for future in [executor.submit(run_part, x) for x in parts]:
+        if future.exception() is not None:
+          errors.append(future.exception())
+    if errors:
+      raise errors[0]
+
+    summary['seconds'] = time.time() - started
+    summary['rows_per_second'] = summary['rows'] / max(summary['seconds'], 1e-6)
+    return summary
+
+
+def parse_arguments(argv=None):
+  """
+  Collect and collate command line arguments.
+  """
+  import argparse
+
+  parser = argparse.ArgumentParser(
+      description='Export the history or trends of Zabbix items through the API.'
+      )
+  parser.add_argument(
+      '-u', '--url',
+      help='URL of api_jsonrpc.php, e.g. http://localhost/zabbix/api_jsonrpc.php',
+      dest='zabbix_url',
+      required=True,
+      )
+  parser.add_argument('-U', '--user', dest='zabbix_user', default='Admin', help='Default is Admin')
+  parser.add_argument('-P', '--password', dest='zabbix_pass', default='zabbix', help='Default is zabbix')
+  parser.add_argument('-t', '--token', dest='zabbix_token', default=None, help='API token, instead of a user')
+  parser.add_argument(
+      '-i', '--itemids',
+      help='Comma separated item ids, may be given more than once',
+      action='append',
+      required=True,
+      )
+  parser.add_argument('-f', '--from', dest='time_from', help='Timestamp or ISO date, default is a day ago')
+  parser.add_argument('-T', '--till', dest='time_till', help='Timestamp or ISO date, default is now')
+  parser.add_argument('--trends', action='store_true', help='Export trends instead of history')
+  parser.add_argument('-F', '--format', dest='fmt', choices=FORMATS, default='csv', help='Default is csv')
+  parser.add_argument('-o', '--output-dir', default='.', help='Default is the current directory')
+  parser.add_argument('-w', '--workers', type=int, default=4, help='Parts fetched at once, default is 4')
+  parser.add_argument('-p', '--partition', type=int, default=86400, help='Seconds per part, default is 86400')
+  parser.add_argument('--items-per-part', type=int, default=100, help='Default is 100')
+  parser.add_argument('--page-size', type=int, default=10000, help='Rows per request, default is 10000')
+  parser.add_argument('-v', '--verbose', action='store_true', help='Report every part')
+  arguments = vars(parser.parse_args(argv))
+
+  arguments['itemids'] = [y for x in arguments['itemids'] for y in x.split(',') if y]
+  for name in ('time_from', 'time_till'):
+    if arguments[name] is None:
+      del arguments[name]
+    else:
+      arguments[name] = parse_time(arguments[name])
+  return arguments
+
+
+def main(argv=None):
+  from zabbix.api import ZabbixAPI, ZabbixAPIException
+
+  arguments = parse_arguments(argv)
+  api = ZabbixAPI(**dict((x, y) for (x, y) in arguments.items() if y is not None))
+  export = HistoryExport(api, **arguments)
+  try:
+    summary = export.run(arguments['itemids'])
+  except CheckpointError as err:
+    sys.stderr.write(u'{0}\n'.format(err))
+    return 1
+  except (ZabbixAPIException, IOError, OSError) as err:
+    sys.stderr.write(u'Export failed, run again to resume: {0}\n'.format(err))
+    return 1
+  finally:
+    api.close()
+
+  print('{0} rows in {1} parts ({2} resumed), {3:.1f}s, {4:.0f} rows/s'.format(
+      summary['rows'], summary['parts'], summary['resumed'],
+      summary['seconds'], summary['rows_per_second']))
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -1,43 +1,210 @@
 #!/usr/bin/env python3
 """
+Parsers for key = value configuration files, such as the Zabbix agent
+configuration.
+
+Files are read as bytes, in large blocks, and every block is matched by a
+single compiled regex, rather than being split and stripped line by line in
+Python;
+    >>> import io
+    >>> import zabbix.tools.parse_file
+    >>> stream = io.BytesIO(
+    ...   b'# Comment\\n'
+    ...   b'Server = 127.0.0.1 # the local server\\n'
+    ...   b'; Another comment\\n'
+    ...   b'Hostname=client1.example.org\\r\\n'
+    ...   b'not a setting\\n'
+    ...   )
+    >>> list(zabbix.tools.parse_file.iter_kvp(stream))
+    [(b'Server', b'127.0.0.1'), (b'Hostname', b'client1.example.org')]
+
+A whole directory tree is parsed by a pool of worker processes with
+parse_tree(), into a {filename: {key: value}} mapping in which every key is
+stored only once.
 """
+import fnmatch
+import os
+import re
+import sys
 
+BLOCK_SIZE = 1 << 20
 
-def __read_file(**kwargs):
-  import os
-  should_filter = lambda x,y: x.lstrip().startswith(y) or x == ''
+# Lines starting with one of these characters are comments, and everything
+# after a '#' is a comment too, unless inline_comments is False.
+COMMENT_CHARS = b'#;'
 
-  filename = kwargs.get('filename', '/dev/null')
-  filter_by = kwargs.get('filter_by', ('#', ';'))
+__patterns = {}
 
-  retval = []
-  if os.access(filename, os.R_OK):
-    with open(filename, 'r') as f:
-        retval = [x.rstrip('\n') for x in f if not should_filter(x, filter_by)]
 
-  return retval
+def kvp_pattern(comment_chars=COMMENT_CHARS, inline_comments=True):
+  """
+  The compiled regex matching one 'key = value' line, with the key and the
+  value as groups, trailing comment removed.  Lines starting with one of
+  comment_chars are not matched.  With inline_comments False, only whole
+  lines are comments and a '#' further on is part of the value, as the
+  Zabbix daemons read their own configuration files;
+    >>> kvp_pattern(b'#', inline_comments=False).findall(b'\\nUserParameter=a,echo 1 # 2\\n# x=1')
+    [(b'UserParameter', b'a,echo 1 # 2')]
 
+  Every match starts at the newline before the line, a literal the regex
+  engine scans for much faster than it tries '^' at every position;  the
+  data must therefore start with a newline.  The groups still carry
+  surrounding white space, which is cheaper to strip afterwards than to
+  match lazily.
+  """
+  if (comment_chars, inline_comments) not in __patterns:
+    leading = re.escape(comment_chars) if comment_chars else b''
+    inline = b'#' if inline_comments else b''
+    __patterns[(comment_chars, inline_comments)] = re.compile(
+        br'\n[ \t]*([^=\r\n' + inline + leading + br' \t][^=\r\n' + inline + br']*)' +
+        br'=([^\r\n' + inline + br']*)'
+        )
+  return __patterns[(comment_chars, inline_comments)]
 
-# def parse_file_yaml(**kwargs):
-#   import yaml
-#   retval = yaml.load('\n'.join(__read_file(**kwargs)))
-#   return retval
 
+def iter_kvp(stream, **kwargs):
+  """
+  Yield a (key, value) tuple of bytes for every setting in a binary stream,
+  in file order.  The stream is read block_size bytes at a time, so files of
+  any size are parsed in constant memory.
 
-def parse_file_kvp(**kwargs):
+  The function supports the following keyword arguments;
+    block_size    -- (Integer) Bytes read at a time.  Defaults to 1 MiB.
+
+    comment_chars -- (Bytes) Characters that start a comment line.  Defaults
+                     to '#' and ';'.
+
+    inline_comments -- (Boolean) Whether a '#' after the start of a line
+                     starts a comment as well.  Defaults to True.
+  """
+  block_size = int(kwargs.get('block_size', BLOCK_SIZE))
+  findall = kvp_pattern(
+      kwargs.get('comment_chars', COMMENT_CHARS),
+      kwargs.get('inline_comments', True)
+      ).findall
+
+  remainder = b'\n'
+  while True:
+    block = stream.read(block_size)
+    if not block:
+      break
+    block = remainder + block
+    end = block.rfind(b'\n')
+    remainder = block[end:]
+    for (key, value) in findall(block, 0, end):
+      yield key.rstrip(), value.strip()
+
+  for (key, value) in findall(remainder):
+    yield key.rstrip(), value.strip()
+
+
+def parse_bytes(data, **kwargs):
+  """
+  Parse a whole file held in memory into a {key: value} dict of str, the
+  last value of a repeated key winning.
+
+    >>> parse_bytes(b'Timeout=3\\nTimeout = 30\\n')
+    {'Timeout': '30'}
+  """
+  encoding = kwargs.get('encoding', 'utf-8')
+  findall = kvp_pattern(
+      kwargs.get('comment_chars', COMMENT_CHARS),
+      kwargs.get('inline_comments', True)
+      ).findall
+  return {
+    key.rstrip().decode(encoding, 'replace'): value.strip().decode(encoding, 'replace')
+    for (key, value) in findall(b'\n' + data)
+    }
+
+
+def parse_file(filename, **kwargs):
+  """
+  Parse one file into a {key: value} dict of str, see parse_bytes and
+  iter_kvp for the keyword arguments.  A file that can not be read parses
+  as an empty dict.  Files smaller than a block are parsed in one go.
+  """
+  encoding = kwargs.get('encoding', 'utf-8')
+  block_size = int(kwargs.get('block_size', BLOCK_SIZE))
+  try:
+    with open(filename, 'rb') as f:
+      if os.fstat(f.fileno()).st_size < block_size:
+        return parse_bytes(f.read(), **kwargs)
+      return dict(
+        (key.decode(encoding, 'replace'), value.decode(encoding, 'replace'))
+        for (key, value) in iter_kvp(f, **kwargs)
+        )
+  except (IOError, OSError):
+    return {}
+
+
+def _parse_file_worker(filename):
+  """
+  parse_file() as run by the parse_tree() workers;  must not be private to
+  be picklable.
+  """
+  return filename, parse_file(filename)
+
+
+def iter_tree(path, pattern='*'):
+  """
+  Yield the name of every regular file below path that matches pattern, in
+  a stable order.
+  """
+  for (dirpath, dirnames, filenames) in os.walk(path):
+    dirnames.sort()
+    for filename in sorted(fnmatch.filter(filenames, pattern)):
+      yield os.path.join(dirpath, filename)
+
+
+def parse_tree(path, pattern='*', **kwargs):
+  """
+  Parse every file below path that matches pattern, and return a
+  {filename: {key: value}} dict.  Keys are interned, so the many copies of
+  the same setting names share a single string.
+
+  The function supports the following keyword arguments;
+    workers       -- (Integer) Number of worker processes.  Defaults to the
+                     number of CPUs;  1 parses in this process.
+
+    chunk_size    -- (Integer) Files handed to a worker at a time.  Defaults
+                     to 64.
+  """
+  workers = int(kwargs.get('workers', 0) or os.cpu_count() or 1)
+  chunk_size = int(kwargs.get('chunk_size', 64))
+  intern = sys.intern
+
+  filenames = iter_tree(path, pattern)
   retval = {}
-  for line in __read_file(**kwargs):
-    if '#' in line:
-      line = line.split('#', 1)[0]
-    if '=' in line:
-      option, value = line.split('=', 1)
-      option = option.strip()
-      value = value.strip()
-      retval[option] = value
+  if workers == 1:
+    results = (_parse_file_worker(x) for x in filenames)
+    pool = None
+  else:
+    import multiprocessing
+    pool = multiprocessing.Pool(workers)
+    results = pool.imap_unordered(_parse_file_worker, filenames, chunk_size)
+
+  try:
+    for (filename, conf) in results:
+      retval[filename] = dict(zip(map(intern, conf), conf.values()))
+  finally:
+    if pool is not None:
+      pool.close()
+      pool.join()
   return retval
 
 
+def parse_file_kvp(**kwargs):
+  """
+  The historical interface to parse_file();  takes the file name as the
+  'filename' keyword argument, and the comment prefixes as 'filter_by'.
+  """
+  filter_by = kwargs.get('filter_by', ('#', ';'))
+  return parse_file(
+      kwargs.get('filename', '/dev/null'),
+      comment_chars=''.join(x[:1] for x in filter_by).encode('utf-8')
+      )
+
+
 if __name__ == '__main__':
   import doctest
   doctest.testmod()
-
@@ -0,0 +1,506 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Streaming reader for zabbix_sender style input files.
+
+Every line holds one value, as whitespace delimited fields;
+    <host> <key> <value>
+    <host> <key> <timestamp> <value>     (with_timestamps)
+    <host> <key> <timestamp> <ns> <value>  (with_timestamps and with_ns)
+
+The rules are those of zabbix_sender;
+  * A field may be enclosed in double quotes, inside which a backslash
+    escapes a double quote or another backslash.
+  * An unquoted value is the rest of the line, spaces included.
+  * A host of '-' stands for the default host.
+  * Blank lines are ignored.
+
+Lines are parsed one at a time as the file is read, so memory use does not
+depend on the size of the input.
+
+    >>> import io
+    >>> import zabbix.tools.sender_input
+    >>> reader = zabbix.tools.sender_input.InputReader(io.BytesIO(
+    ...   b'client1.example.org myKey1 16535\\n'
+    ...   b'- "my key[a b]" "say \\\\"hi\\\\""\\n'
+    ...   b'\\n'
+    ...   b'- myKey3 free form text\\n'
+    ...   ))
+    >>> list(reader)
+    [('myKey1', '16535', None, 'client1.example.org', None), ('my key[a b]', 'say "hi"', None, None, None), ('myKey3', 'free form text', None, None, None)]
+    >>> reader.stats()['lines'], reader.stats()['items']
+    (4, 3)
+"""
+import collections
+import io
+import mmap
+import multiprocessing
+import os
+import re
+import selectors
+import sys
+import time
+
+
+class InputError(ValueError):
+  """
+  A line that does not follow the input file format.
+  """
+
+  def __init__(self, line_number, message):
+    ValueError.__init__(self, u'[line {0}] {1}'.format(line_number, message))
+    self.line_number = line_number
+    self.reason = message
+
+
+QUOTED = re.compile(r'"((?:[^"\\]|\\["\\]|\\(?!["\\]))*)"')
+ESCAPED = re.compile(r'\\(["\\])')
+
+
+def __quoted(line, start):
+  """
+  Parse the quoted field starting at line[start], return (field, end).
+  """
+  match = QUOTED.match(line, start)
+  if match is None:
+    raise ValueError('Missing closing quote')
+  return ESCAPED.sub(r'\1', match.group(1)), match.end()
+
+
+def __field(line, start):
+  """
+  Parse the field starting at line[start], quoted or not, and return
+  (field, end).
+  """
+  if line[start] == '"':
+    (field, end) = __quoted(line, start)
+    if end < len(line) and not line[end].isspace():
+      raise ValueError('Unexpected character after closing quote')
+    return field, end
+
+  end = start
+  while end < len(line) and not line[end].isspace():
+    end += 1
+  return line[start:end], end
+
+
+def __skip_space(line, start):
+  while start < len(line) and line[start].isspace():
+    start += 1
+  return start
+
+
+def parse_line(line, with_timestamps=False, with_ns=False):
+  """
+  Split one (str) line into a (host, key, clock, ns, value) tuple.  host is
+  None for '-', clock is None without timestamps and ns is None without
+  with_ns (which only applies along with with_timestamps).  Raises
+  ValueError for lines that do not follow the format.
+
+    >>> parse_line('client1.example.org myKey1 499162920 16535', True)
+    ('client1.example.org', 'myKey1', 499162920, None, '16535')
+    >>> parse_line('client1.example.org myKey1 499162920 250000000 16535', True, True)
+    ('client1.example.org', 'myKey1', 499162920, 250000000, '16535')
+    >>> parse_line('- "myKey2" "a \\\\\\\\ b"')
+    (None, 'myKey2', None, None, 'a \\\\ b')
+  """
+  line = line.rstrip('\r\n')
+  names = ('host', 'key')
+  if with_timestamps:
+    names += ('timestamp', 'ns') if with_ns else ('timestamp',)
+
+  if '"' not in line:
+    fields = line.split(None, len(names))
+    if len(fields) <= len(names):
+      raise ValueError(u"'{0}' required".format(
+          (names + ('value',))[len(fields)]
+          ))
+  else:
+    fields = []
+    index = __skip_space(line, 0)
+    for name in names:
+      if index >= len(line):
+        raise ValueError(u"'{0}' required".format(name))
+      (field, index) = __field(line, index)
+      fields.append(field)
+      index = __skip_space(line, index)
+
+    if index >= len(line):
+      raise ValueError("'value' required")
+    if line[index] == '"':
+      (value, end) = __quoted(line, index)
+      if line[end:].strip():
+        raise ValueError('Too many parameters')
+      fields.append(value)
+    else:
+      fields.append(line[index:])
+
+  (clock, ns) = (None, None)
+  if with_timestamps:
+    if not fields[2].isdigit():
+      raise ValueError(u'Invalid timestamp: {0}'.format(fields[2]))
+    clock = int(fields[2])
+    if with_ns:
+      if not fields[3].isdigit() or int(fields[3]) > 999999999:
+        raise ValueError(u'Invalid nanoseconds: {0}'.format(fields[3]))
+      ns = int(fields[3])
+
+  return (
+    None if fields[0] == '-' else fields[0],
+    fields[1],
+    clock,
+    ns,
+    fields[-1]
+    )
+
+
+def open_input(filename):
+  """
+  Open an input file for reading, '-' being standard input.  The stream is
+  binary; lines are decoded by InputReader.
+  """
+  if filename == '-':
+    return sys.stdin.buffer
+  return open(filename, 'rb')
+
+
+class InputReader(object):
+  """
+  Iterate over the items of an input stream (binary, see open_input) as
+  (key, value, clock, host, ns) tuples, the tuple layout Sender.add_items()
+  takes.  Invalid lines raise InputError, which carries the line number,
+  as zabbix_sender stops at the first invalid line too.
+
+  The class object supports the following keyword arguments at instantiation;
+    with_timestamps -- (Boolean) Every line carries a timestamp between the
+                     key and the value.  Defaults to False.
+
+    with_ns       -- (Boolean) ... and nanoseconds after the timestamp.
+                     Defaults to False.
+
+    encoding      -- (String) Encoding of the input.  Defaults to 'utf-8'.
+  """
+
+  def __init__(self, stream, **kwargs):
+    self.stream = stream
+    self.with_timestamps = kwargs.get('with_timestamps', False)
+    self.with_ns = kwargs.get('with_ns', False)
+    self.encoding = kwargs.get('encoding', 'utf-8')
+    self.started = None
+    self.lines = 0
+    self.bytes = 0
+    self.items = 0
+
+  def __parse(self, raw_line):
+    """
+    Account for one raw line and parse it, None for a blank line.
+    """
+    self.lines += 1
+    self.bytes += len(raw_line)
+    if not raw_line.strip():
+      return None
+
+    try:
+      (host, key, clock, ns, value) = parse_line(
+          raw_line.decode(self.encoding),
+          self.with_timestamps,
+          self.with_ns
+          )
+    except (ValueError, UnicodeDecodeError) as err:
+      raise InputError(self.lines, err)
+
+    self.items += 1
+    return (key, value, clock, host, ns)
+
+  def __iter__(self):
+    self.started = self.started or time.time()
+    for raw_line in self.stream:
+      item = self.__parse(raw_line)
+      if item is not None:
+        yield item
+
+  def __timed_lines(self, timeout):
+    """
+    Read the stream as data arrives, yielding every complete raw line, and
+    None whenever timeout() seconds went by without one.  timeout() returns
+    None to wait for as long as it takes.
+    """
+    fd = self.stream.fileno()
+    selector = selectors.SelectSelector()
+    selector.register(fd, selectors.EVENT_READ)
+    pending = b''
+    try:
+      while True:
+        if not selector.select(timeout()):
+          yield None
+          continue
+        data = os.read(fd, 65536)
+        if not data:
+          break
+        lines = (pending + data).split(b'\n')
+        pending = lines.pop()
+        for raw_line in lines:
+          yield raw_line + b'\n'
+    finally:
+      selector.close()
+    if pending:
+      yield pending
+
+  def batches(self, size, max_latency=None):
+    """
+    Yield the items as lists of at most size items.
+
+    With max_latency (seconds), the stream is read as data arrives, which
+    needs a stream with a file descriptor (a pipe, a terminal or a file),
+    and a batch is also yielded once its first item has waited max_latency
+    seconds, however small it is.
+
+    An invalid line ends the batches; the items read before it are yielded
+    first, then InputError is raised.
+    """
+    self.started = self.started or time.time()
+    batch = []
+    deadline = None
+
+    def timeout():
+      return None if deadline is None else max(deadline - time.time(), 0)
+
+    try:
+      if max_latency is None:
+        for item in self:
+          batch.append(item)
+          if len(batch) >= size:
+            yield batch
+            batch = []
+      else:
+        for raw_line in self.__timed_lines(timeout):
+          item = None if raw_line is None else self.__parse(raw_line)
+          if item is not None:
+            batch.append(item)
+            deadline = deadline or time.time() + max_latency
+          if batch and (len(batch) >= size or time.time() >= deadline):
+            yield batch
+            batch = []
+            deadline = None
+    except InputError:
+      if batch:
+        yield batch
+      raise
+
+    if batch:
+      yield batch
+
+  def stats(self):
+    """
+    Return the number of lines, bytes and items read so far, the seconds
+    spent and the resulting lines_per_sec / bytes_per_sec.
+    """
+    seconds = time.time() - self.started if self.started else 0.0
+    return {
+      'lines': self.lines,
+      'bytes': self.bytes,
+      'items': self.items,
+      'seconds': seconds,
+      'lines_per_sec': self.lines / max(seconds, 1e-9),
+      'bytes_per_sec': self.bytes / max(seconds, 1e-9),
+      }
+
+
+def iter_blocks(filename, block_bytes):
+  """
+  Cut the input into blocks of about block_bytes bytes that end on a line
+  boundary.  A regular file is memory mapped to find the boundaries, and
+  yields (filename, start, end) tuples, so only the offsets travel to the
+  workers.  Anything else (standard input, pipes) is read block by block,
+  and yields (None, data) tuples.
+  """
+  if filename != '-' and os.path.isfile(filename):
+    with open(filename, 'rb') as f:
+      size = os.fstat(f.fileno()).st_size
+      if not size:
+        return
+      with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        start = 0
+        while start < size:
+          end = mapped.find(b'\n', min(start + block_bytes, size) - 1)
+          end = size if end < 0 else end + 1
+          yield (filename, start, end)
+          start = end
+    return
+
+  stream = open_input(filename)
+  pending = b''
+  while True:
+    data = stream.read(block_bytes)
+    if not data:
+      break
+    data = pending + data
+    cut = data.rfind(b'\n') + 1
+    if not cut:
+      pending = data
+      continue
+    (data, pending) = (data[:cut], data[cut:])
+    yield (None, data)
+  if pending:
+    yield (None, pending)
+
+
+_worker_sender = None
+_worker_options = {}
+
+
+def _init_worker(sender_options, reader_options):
+  global _worker_sender, _worker_options
+  from zabbix.sender import Sender
+  _worker_sender = Sender(**sender_options)
+  _worker_options = reader_options
+
+
+def _encode_block(block):
+  """
+  Parse and encode one block in a worker.  Returns the encoded requests as
+  (count, packet) tuples, the lines / bytes / items counters, and the
+  (line number within the block, message) of an invalid line, if any.
+  """
+  (filename, start, end) = block if block[0] is not None else (None, 0, 0)
+  if filename is None:
+    data = block[1]
+  else:
+    with open(filename, 'rb') as f:
+      f.seek(start)
+      data = f.read(end - start)
+
+  reader = InputReader(io.BytesIO(data), **_worker_options)
+  error = None
+  try:
+    _worker_sender.add_items(reader)
+  except InputError as err:
+    error = (err.line_number, u'{0}'.format(err.reason))
+
+  packets = [
+    (count, bytes(packet))
+    for (count, packet, _) in _worker_sender._iter_packets(
+        _worker_sender.__list_item__
+        )
+    ]
+  _worker_sender.__list_item__.clear()
+  return packets, reader.lines, reader.bytes, reader.items, error
+
+
+class ParallelEncoder(object):
+  """
+  Parse and encode an input file in a pool of worker processes, for files
+  too large for a single core to keep up with.
+
+  The input is cut into blocks on line boundaries (see iter_blocks), every
+  worker turns whole blocks into ready to send requests, and the requests
+  come back in input order, so the values of every host reach the server in
+  the order they were written.  Only a few blocks per worker are in flight
+  at any time, which keeps memory use bounded.
+
+  The class object supports the following keyword arguments at instantiation;
+    workers       -- (Integer) Number of worker processes.  Defaults to the
+                     number of CPUs.
+
+    block_bytes   -- (Integer) Approximate size of a block.  Defaults to
+                     4194304 (4 MiB).
+
+    with_timestamps -- (Boolean) See InputReader.
+
+    with_ns       -- (Boolean) See InputReader.
+
+    sender        -- (Sender) The sender the requests are meant for.  The
+                     workers take its default host and clock, and the way it
+                     chunks and compresses requests.
+
+  Usage example;
+      >>> import zabbix
+      >>> monitor = zabbix.Sender(read_config=False, zabbix_host='client1.example.org')
+      >>> encoder = ParallelEncoder(workers=4, sender=monitor)
+      >>> monitor.send_packets(encoder.packets('/path/to/input')) #doctest: +SKIP
+
+  An invalid line ends the requests early, and is kept as an InputError in
+  'error'.
+  """
+
+  def __init__(self, **kwargs):
+    self.workers = int(kwargs.get('workers', 0) or multiprocessing.cpu_count())
+    self.block_bytes = int(kwargs.get('block_bytes', 4194304))
+    sender = kwargs['sender']
+    self.sender_options = {
+      'read_config': False,
+      'zabbix_host': sender.zabbix_host,
+      'zabbix_time': sender.zabbix_time,
+      'clock_source': sender.clock_source,
+      'ns': sender.ns,
+      'chunk_items': sender.chunk_items,
+      'chunk_bytes': sender.chunk_bytes,
+      'compress': sender.compress,
+      'compress_threshold': sender.compress_threshold,
+      }
+    self.reader_options = {
+      'with_timestamps': kwargs.get('with_timestamps', False),
+      'with_ns': kwargs.get('with_ns', False),
+      }
+    self.started = None
+    self.lines = 0
+    self.bytes = 0
+    self.items = 0
+    self.error = None
+
+  def packets(self, filename):
+    """
+    Yield (count, packet, None) tuples, in input order, for
+    Sender.send_packets.  When a block holds an invalid line, the requests
+    encoded from the lines before it are the last ones yielded.
+    """
+    self.started = self.started or time.time()
+    pool = multiprocessing.Pool(
+        self.workers,
+        _init_worker,
+        (self.sender_options, self.reader_options)
+        )
+    try:
+      in_flight = collections.deque()
+      blocks = iter_blocks(filename, self.block_bytes)
+      while True:
+        while len(in_flight) < self.workers * 2:
+          block = next(blocks, None)
+          if block is None:
+            break
+          in_flight.append(pool.apply_async(_encode_block, (block,)))
+        if not in_flight:
+          break
+
+        (packets, lines, size, items, error) = in_flight.popleft().get()
+        if error is not None:
+          self.error = InputError(self.lines + error[0], error[1])
+        self.lines += lines
+        self.bytes += size
+        self.items += items
+        for (count, packet) in packets:
+          yield count, packet, None
+        if error is not None:
+          break
+    finally:
+      pool.terminate()
+      pool.join()
+
+  def stats(self):
+    """
+    The same counters as InputReader.stats().
+    """
+    seconds = time.time() - self.started if self.started else 0.0
+    return {
+      'lines': self.lines,
+      'bytes': self.bytes,
+      'items': self.items,
+      'seconds': seconds,
+      'lines_per_sec': self.lines / max(seconds, 1e-9),
+      'bytes_per_sec': self.bytes / max(seconds, 1e-9),
+      }
+
+
+if __name__ == '__main__':
+  import doctest
+  doctest.testmod()
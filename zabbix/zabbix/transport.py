@@ -0,0 +1,513 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Pooled TCP transport used by the Zabbix sender.
+
+Opening a new socket for every payload is expensive when a single collector
+pushes tens of thousands of values a minute; the connection setup and the
+TIME_WAIT sockets left behind end up costing more than the data itself.  The
+ConnectionPool keeps connections to a single server / port open for as long as
+the trapper allows it, and transparently reconnects when the other end closes
+them.
+
+Pools are shared process wide, and keyed by (zabbix_serv, zabbix_port);
+    >>> import zabbix.transport
+    >>> pool = zabbix.transport.get_pool('server1.example.org', 10051)
+    >>> pool is zabbix.transport.get_pool('server1.example.org', 10051)
+    True
+    >>> pool.stats() == {
+    ...   'opened': 0, 'reused': 0, 'closed': 0, 'retried': 0, 'idle': 0
+    ...   }
+    True
+"""
+import collections
+import itertools
+import logging
+import select
+import socket
+import threading
+import time
+
+from zabbix import protocol
+
+
+class ConnectError(socket.error):
+  """
+  Unable to open a connection to the Zabbix server.
+  """
+  pass
+
+
+class ConnectionPool(object):
+  """
+  A small pool of persistent connections to one Zabbix server / proxy.
+
+  The class object supports the following keyword arguments at instantiation;
+    max_size      -- (Integer) Maximum number of idle connections kept open.
+                     Defaults to 4.
+
+    max_idle      -- (Number) Seconds an idle connection is kept before it is
+                     closed instead of reused.  Defaults to 30.
+
+    timeout       -- (Number) Socket timeout in seconds, applied per socket
+                     rather than process wide.  Defaults to 5.
+  """
+
+  def __init__(self, zabbix_serv, zabbix_port, **kwargs):
+    self.zabbix_serv = zabbix_serv
+    self.zabbix_port = int(zabbix_port)
+
+    self.max_size = int(kwargs.get('max_size', 4))
+    self.max_idle = float(kwargs.get('max_idle', 30))
+    self.timeout = kwargs.get('timeout', 5)
+
+    self.closes_connections = False
+    self.__idle = collections.deque()
+    self.__lock = threading.Lock()
+    self.__stats = {
+      'opened': 0,
+      'reused': 0,
+      'closed': 0,
+      'retried': 0,
+      }
+
+  def __count(self, counter):
+    with self.__lock:
+      self.__stats[counter] += 1
+
+  def __connect(self):
+    """
+    Open a brand new connection to the server.
+    """
+    try:
+      sock = socket.create_connection(
+          (self.zabbix_serv, self.zabbix_port),
+          timeout=self.timeout
+          )
+    except socket.error as err:
+      raise ConnectError(err)
+
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    self.__count('opened')
+    return sock
+
+  def __discard(self, sock):
+    try:
+      sock.close()
+    except socket.error:
+      pass
+    self.__count('closed')
+
+  @staticmethod
+  def __is_alive(sock):
+    """
+    An idle connection should have nothing to read.  If it is readable, the
+    server has either closed it or sent something we did not ask for, and in
+    both cases it can not be reused.
+    """
+    try:
+      readable = select.select([sock], [], [], 0)[0]
+    except (socket.error, ValueError):
+      return False
+    return not readable
+
+  def acquire(self):
+    """
+    Return a (socket, reused) tuple, preferring a live idle connection over
+    opening a new one.
+    """
+    now = time.time()
+    while True:
+      with self.__lock:
+        if not self.__idle:
+          break
+        (sock, released) = self.__idle.pop()
+
+      if now - released > self.max_idle or not self.__is_alive(sock):
+        self.__discard(sock)
+        continue
+
+      self.__count('reused')
+      return sock, True
+
+    return self.__connect(), False
+
+  def release(self, sock, reusable=True):
+    """
+    Hand a connection back to the pool, or close it if it can not be reused
+    or the pool is full.
+    """
+    if reusable:
+      with self.__lock:
+        if len(self.__idle) < self.max_size:
+          self.__idle.append((sock, time.time()))
+          return
+    self.__discard(sock)
+
+  @staticmethod
+  def __unread(err, sending):
+    """
+    Whether the failure err shows that the server closed the connection
+    without reading the request; a reset or broken pipe while sending, or the
+    connection going away before the first byte of the response.
+    """
+    if isinstance(err, protocol.ConnectionClosed):
+      return True
+    return sending and isinstance(err, (BrokenPipeError, ConnectionResetError))
+
+  def request(self, packet):
+    """
+    Send one framed packet and return the payload of the response.  When a
+    reused connection turns out to have been closed by the server before it
+    read the request, the request is retried once over a fresh connection.
+    Timeouts and broken or partial responses are raised as is, the server
+    may well have processed the request already.
+    """
+    (sock, reused) = self.acquire()
+    while True:
+      sending = True
+      try:
+        sock.sendall(packet)
+        sending = False
+        response = protocol.read_packet(sock)
+      except (socket.error, protocol.ProtocolError) as err:
+        self.release(sock, reusable=False)
+        if not reused or not self.__unread(err, sending):
+          raise
+        logging.debug('Pooled connection went away, reconnecting: %s', err)
+        self.__count('retried')
+        (sock, reused) = (self.__connect(), False)
+        continue
+
+      self.release(sock)
+      return response
+
+  def pipeline(self, packets, window=8):
+    """
+    Send an iterable of framed packets over a single connection, keeping up
+    to 'window' of them in flight instead of waiting for every response
+    before sending the next request.  Yields the response payloads in
+    request order.
+
+    The first request on a connection is always sent on its own.  A server
+    that closes the connection cleanly right after an answer, like a stock
+    Zabbix trapper does, has not read the requests sent after it; they are
+    sent again over a new connection, and the pool sends one request per
+    connection to that server from then on.  Any other failure (a timeout, a
+    reset, a bad response) is raised, and the requests that were not answered
+    yet are left to the caller.  A connection left with requests in flight,
+    because of an error or because the caller stopped early, is closed.
+    """
+    window = max(int(window), 1)
+    pending = collections.deque()
+    packets = iter(packets)
+    (sock, reused) = self.acquire()
+    answered = 0
+    try:
+      while True:
+        try:
+          limit = window if answered and not self.closes_connections else 1
+          while len(pending) < limit:
+            packet = next(packets, None)
+            if packet is None:
+              break
+            if sock is None:
+              (sock, reused) = (self.__connect(), False)
+            # Kept until answered, in case it has to be sent again.
+            pending.append(bytes(packet))
+            try:
+              sock.sendall(pending[-1])
+            except (BrokenPipeError, ConnectionResetError):
+              # The server went away; whether it read anything is told by
+              # what comes back below.
+              break
+          if not pending:
+            break
+          response = protocol.read_packet(sock)
+        except (socket.error, protocol.ProtocolError) as err:
+          if sock is not None:
+            self.release(sock, reusable=False)
+            sock = None
+          if not pending or not isinstance(err, protocol.ConnectionClosed):
+            raise
+          if answered and not err.reset:
+            logging.debug('%s:%s closes connections after answering, not pipelining', self.zabbix_serv, self.zabbix_port)
+            self.closes_connections = True
+          elif not answered and reused:
+            logging.debug('Pooled connection went away, reconnecting: %s', err)
+          else:
+            raise
+          self.__count('retried')
+          (sock, reused) = (self.__connect(), False)
+          answered = 0
+          # Only the first unanswered request goes out on the new connection,
+          # the others are queued again in front of the remaining packets.
+          packets = itertools.chain(list(pending)[1:], packets)
+          pending = collections.deque([pending[0]])
+          sock.sendall(pending[0])
+          continue
+
+        pending.popleft()
+        answered += 1
+        yield response
+
+        if self.closes_connections and not pending:
+          self.release(sock, reusable=False)
+          (sock, reused, answered) = (None, False, 0)
+    finally:
+      if sock is not None:
+        self.release(sock, reusable=not pending)
+
+  def close(self):
+    """
+    Close every idle connection held by the pool.
+    """
+    with self.__lock:
+      idle = list(self.__idle)
+      self.__idle.clear()
+    for (sock, _) in idle:
+      self.__discard(sock)
+
+  def stats(self):
+    """
+    Return the pool counters;
+      opened  -- Connections opened.
+      reused  -- Requests served by an already open connection.
+      closed  -- Connections closed (expired, dead or surplus).
+      retried -- Requests replayed after a reused connection went away.
+      idle    -- Connections currently waiting in the pool.
+    """
+    with self.__lock:
+      retval = dict(self.__stats)
+      retval['idle'] = len(self.__idle)
+    return retval
+
+
+class TargetSet(object):
+  """
+  Several servers / proxies that can all take the same data, each with its
+  own pool and health record.
+
+  The class object supports the following keyword arguments at instantiation,
+  the remaining ones are handed to the pools (see ConnectionPool);
+    balance       -- (String) 'failover' sends every request to the first
+                     healthy target, in the order given.  'spread' sends
+                     consecutive requests to consecutive healthy targets.
+                     Defaults to 'failover'.
+
+    backoff_min   -- (Number) Seconds a target is avoided after a failed
+                     connection.  Doubles with every consecutive failure.
+                     Defaults to 1.
+
+    backoff_max   -- (Number) Upper bound for the backoff.  Defaults to 60.
+
+  Only connection failures fail over to the next target; once a request has
+  been written, the server may have processed it, so any later error is
+  reported instead of repeating the request elsewhere.  When every target is
+  backing off, the one due first is tried anyway.
+
+    >>> import zabbix.transport
+    >>> targets = zabbix.transport.TargetSet(
+    ...   [('proxy1.example.org', 10051), ('proxy2.example.org', 10051)],
+    ...   balance='spread'
+    ...   )
+    >>> targets.order()
+    [('proxy1.example.org', 10051), ('proxy2.example.org', 10051)]
+    >>> targets.order()
+    [('proxy2.example.org', 10051), ('proxy1.example.org', 10051)]
+    >>> targets.failure(('proxy1.example.org', 10051), 'Connection refused')
+    >>> targets.order()
+    [('proxy2.example.org', 10051)]
+  """
+
+  def __init__(self, targets, **kwargs):
+    self.targets = [(host, int(port)) for (host, port) in targets]
+    self.balance = kwargs.pop('balance', 'failover')
+    if self.balance not in ('failover', 'spread'):
+      raise ValueError('Unknown balance mode: {0!r}'.format(self.balance))
+    self.backoff_min = float(kwargs.pop('backoff_min', 1))
+    self.backoff_max = float(kwargs.pop('backoff_max', 60))
+    self.pool_options = kwargs
+
+    self.__lock = threading.Lock()
+    self.__next = 0
+    self.__health = {}
+    for target in self.targets:
+      self.__health[target] = {
+        'requests': 0,
+        'errors': 0,
+        'consecutive_errors': 0,
+        'latency_last': None,
+        'latency_avg': None,
+        'last_error': None,
+        'retry_at': 0.0,
+        }
+
+  def order(self):
+    """
+    The targets to try for the next request, best first.  Targets backing
+    off are left out, unless all of them are.
+    """
+    now = time.time()
+    with self.__lock:
+      retval = [x for x in self.targets if self.__health[x]['retry_at'] <= now]
+      if not retval and self.targets:
+        retval = [min(self.targets, key=lambda x: self.__health[x]['retry_at'])]
+
+      if self.balance == 'spread' and retval:
+        start = self.__next % len(retval)
+        retval = retval[start:] + retval[:start]
+        self.__next += 1
+    return retval
+
+  def success(self, target, latency):
+    with self.__lock:
+      health = self.__health[target]
+      health['requests'] += 1
+      health['consecutive_errors'] = 0
+      health['retry_at'] = 0.0
+      health['latency_last'] = latency
+      if health['latency_avg'] is None:
+        health['latency_avg'] = latency
+      else:
+        health['latency_avg'] += (latency - health['latency_avg']) * 0.2
+
+  def failure(self, target, error):
+    with self.__lock:
+      health = self.__health[target]
+      health['requests'] += 1
+      health['errors'] += 1
+      health['consecutive_errors'] += 1
+      health['last_error'] = u'{0}'.format(error)
+      backoff = min(
+          self.backoff_max,
+          self.backoff_min * 2 ** (health['consecutive_errors'] - 1)
+          )
+      health['retry_at'] = time.time() + backoff
+
+  def request(self, packet):
+    """
+    Send one framed packet to the best target that accepts a connection,
+    and return a (target, response payload) tuple.  Raises ConnectError when
+    no target could be reached.
+    """
+    error = ConnectError('No targets to send to')
+    for target in self.order():
+      pool = get_pool(target[0], target[1], **self.pool_options)
+      started = time.time()
+      try:
+        response = pool.request(packet)
+      except ConnectError as err:
+        logging.debug('Unable to reach %s:%s, failing over: %s', target[0], target[1], err)
+        self.failure(target, err)
+        error = err
+        continue
+      except (socket.error, protocol.ProtocolError) as err:
+        self.failure(target, err)
+        raise
+
+      self.success(target, time.time() - started)
+      return target, response
+
+    raise error
+
+  def pipeline(self, packets, window=8):
+    """
+    The pipelined equivalent of request(); yields a (target, response
+    payload) tuple per packet, in order (see ConnectionPool.pipeline).
+    Every packet goes to the same target, the best one that accepts a
+    connection.  Failures after the first request was sent are raised.
+    """
+    sent = []
+
+    def counted(packets):
+      for packet in packets:
+        sent.append(None)
+        yield packet
+
+    packets = counted(packets)
+    error = ConnectError('No targets to send to')
+    for target in self.order():
+      pool = get_pool(target[0], target[1], **self.pool_options)
+      answered = 0
+      started = time.time()
+      try:
+        for response in pool.pipeline(packets, window):
+          answered += 1
+          now = time.time()
+          self.success(target, now - started)
+          started = now
+          yield target, response
+      except ConnectError as err:
+        self.failure(target, err)
+        if sent:
+          raise
+        logging.debug('Unable to reach %s:%s, failing over: %s', target[0], target[1], err)
+        error = err
+        continue
+      except (socket.error, protocol.ProtocolError) as err:
+        self.failure(target, err)
+        raise
+      return
+
+    raise error
+
+  def stats(self):
+    """
+    Return a dict of per target statistics, keyed by (host, port);
+      requests           -- Requests attempted.
+      errors             -- Requests that failed.
+      consecutive_errors -- Failures since the last success.
+      latency_last       -- Seconds taken by the last successful request.
+      latency_avg        -- Moving average of the above.
+      last_error         -- The last error message.
+      healthy            -- False while the target is backing off.
+      pool               -- The pool statistics, see ConnectionPool.stats().
+    """
+    now = time.time()
+    retval = {}
+    with self.__lock:
+      for target in self.targets:
+        health = dict(self.__health[target])
+        health['healthy'] = health.pop('retry_at') <= now
+        retval[target] = health
+
+    for target in retval:
+      retval[target]['pool'] = get_pool(
+          target[0],
+          target[1],
+          **self.pool_options
+          ).stats()
+    return retval
+
+
+__pools = {}
+__pools_lock = threading.Lock()
+
+
+def get_pool(zabbix_serv, zabbix_port, **kwargs):
+  """
+  Return the process wide pool for (zabbix_serv, zabbix_port), creating it
+  with the given keyword arguments the first time it is requested.
+  """
+  pool_key = (zabbix_serv, int(zabbix_port))
+  with __pools_lock:
+    if pool_key not in __pools:
+      __pools[pool_key] = ConnectionPool(zabbix_serv, zabbix_port, **kwargs)
+    return __pools[pool_key]
+
+
+def close_pools():
+  """
+  Close and forget every pool, e.g. before forking.
+  """
+  with __pools_lock:
+    pools = list(__pools.values())
+    __pools.clear()
+  for pool in pools:
+    pool.close()
+
+
+if __name__ == '__main__':
+  import doctest
+  doctest.testmod()